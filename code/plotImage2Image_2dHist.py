@@ -1,30 +1,19 @@
+import os
 import nibabel as nib
 import numpy as np
 import matplotlib.pyplot as plt
 
-from scipy.stats import spearmanr
+from scipy.stats import spearmanr, rankdata
 from matplotlib.ticker import NullFormatter
+from matplotlib.figure import Figure
+from matplotlib.gridspec import GridSpec
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-def plotImage2Image_2dHist( MapX, MapY, thresholdX=None, thresholdY=None, logY=None, logX=None, filterX=None, filterY=None, bins=100 ):
-
-    # load image files.
-    img = nib.load(MapX)
-    img2 = nib.load(MapY)
-    
-
-    # get image data.
-    img_data = img.get_data()
-    img2_data = img2.get_data()
-
-    
-    # vectorize image data.
-    x_data = img_data.reshape((img_data.shape[0]*img_data.shape[1]*img_data.shape[2],-1))
-    y_data = img2_data.reshape((img2_data.shape[0]*img2_data.shape[1]*img2_data.shape[2],-1))
-    
+def getVoxelMask( x_data, y_data, thresholdX=None, thresholdY=None, filterX=None, filterY=None ):
 
     # decide which points to include
     x_in = np.isfinite(x_data)
-    y_in = np.isfinite(x_data)
+    y_in = np.isfinite(y_data)
 
     if thresholdX != None:
         x_thr = x_data>float(thresholdX)
@@ -44,76 +33,313 @@ def plotImage2Image_2dHist( MapX, MapY, thresholdX=None, thresholdY=None, logY=N
     else:
         y_fil = True
 
-    y = y_data[x_in & y_in & x_thr & y_thr & x_fil & y_fil ]
-    x = x_data[x_in & y_in & x_thr & y_thr & x_fil & y_fil ]
+    return x_in & y_in & x_thr & y_thr & x_fil & y_fil
 
 
-    # log scale if you like.
-    if logY != None:
-        y = np.log(y)
-    if logX != None:
-        x = np.log(x)
-    
+def iterVoxelSlabs( MapX, MapY, slabSize ):
+
+    # load image headers only; the data stays on disk behind the array proxy.
+    img = nib.load(MapX)
+    img2 = nib.load(MapY)
+    if img.shape != img2.shape:
+        raise ValueError( MapX + ' and ' + MapY + ' do not have the same shape.' )
+
+    # nifti data is stored fortran-ordered, so slabs along the last axis
+    # (slices for 3D, volumes for 4D) are contiguous on disk.
+    nSlabs = img.shape[-1]
+    for start in range(0, nSlabs, slabSize):
+        stop = min(start+slabSize, nSlabs)
+        x_slab = np.asanyarray(img.dataobj[..., start:stop]).ravel()
+        y_slab = np.asanyarray(img2.dataobj[..., start:stop]).ravel()
+        yield x_slab, y_slab
+
+
+def streamVoxelPairs( MapX, MapY, slabSize, thresholdX=None, thresholdY=None, logY=None, logX=None, filterX=None, filterY=None ):
+
+    for x_slab, y_slab in iterVoxelSlabs( MapX, MapY, slabSize ):
+        keep = getVoxelMask( x_slab, y_slab, thresholdX, thresholdY, filterX, filterY )
+        x = x_slab[keep].astype(np.float64)
+        y = y_slab[keep].astype(np.float64)
+        if logY != None:
+            y = np.log(y)
+        if logX != None:
+            x = np.log(x)
+        if x.size:
+            yield x, y
+
+
+def streaming2dHist( MapX, MapY, slabSize, bins=100, rhoBins=None, **maskArgs ):
+
+    # first pass: data range and pearson moments, merged slab by slab
+    # (Chan et al.'s pairwise update, so we never hold more than one slab).
+    n = 0
+    meanX = meanY = 0.0
+    ssX = ssY = coXY = 0.0
+    xmin = ymin = np.inf
+    xmax = ymax = -np.inf
+    for x, y in streamVoxelPairs( MapX, MapY, slabSize, **maskArgs ):
+        m = x.size
+        mx = x.mean()
+        my = y.mean()
+        dx = x-mx
+        dy = y-my
+        deltaX = mx-meanX
+        deltaY = my-meanY
+        total = n+m
+        ssX += np.dot(dx, dx) + deltaX*deltaX*n*m/total
+        ssY += np.dot(dy, dy) + deltaY*deltaY*n*m/total
+        coXY += np.dot(dx, dy) + deltaX*deltaY*n*m/total
+        meanX += deltaX*m/total
+        meanY += deltaY*m/total
+        n = total
+        xmin = min(xmin, x.min())
+        xmax = max(xmax, x.max())
+        ymin = min(ymin, y.min())
+        ymax = max(ymax, y.max())
+
+    if n == 0:
+        raise ValueError( 'No voxels survive the threshold/filter settings.' )
+
+    # use the same edges np.histogram2d would have picked for the whole data.
+    if xmin == xmax:
+        xmin, xmax = xmin-0.5, xmax+0.5
+    if ymin == ymax:
+        ymin, ymax = ymin-0.5, ymax+0.5
+    xedges = np.linspace(xmin, xmax, bins+1)
+    yedges = np.linspace(ymin, ymax, bins+1)
+
+    # second pass: accumulate the 2D histogram, and optionally a finer one for rho.
+    H = np.zeros((bins,bins))
+    Hrho = None
+    if rhoBins != None:
+        Hrho = np.zeros((rhoBins,rhoBins))
+        rhoRange = [[xmin,xmax],[ymin,ymax]]
+    for x, y in streamVoxelPairs( MapX, MapY, slabSize, **maskArgs ):
+        H += np.histogram2d( x, y, bins=(xedges,yedges) )[0]
+        if Hrho is not None:
+            Hrho += np.histogram2d( x, y, bins=rhoBins, range=rhoRange )[0]
+
+    r = coXY/np.sqrt(ssX*ssY)
+    return H, xedges, yedges, r, Hrho
+
+
+def histogramSpearman( H ):
+
+    # rank each bin by the midrank of the voxels it holds, then take the
+    # count-weighted pearson correlation of those ranks. this costs O(bins^2)
+    # no matter how many voxels went into H.
+    if H is None:
+        raise ValueError( 'histogramSpearman needs a joint histogram; streaming2dHist only makes one when rhoBins is given.' )
+    H = np.asarray(H, dtype=np.float64)
+    n = H.sum()
+    cx = H.sum(axis=1)
+    cy = H.sum(axis=0)
+    rx = np.cumsum(cx) - (cx-1)/2.0
+    ry = np.cumsum(cy) - (cy-1)/2.0
+    dx = rx - (n+1)/2.0
+    dy = ry - (n+1)/2.0
+    num = np.dot(dx, np.dot(H, dy))
+    rho = num / np.sqrt(np.dot(cx, dx*dx)*np.dot(cy, dy*dy))
+
+    # a voxel's true rank is within half a bin's count of its midrank, which
+    # bounds how far the exact (untied) rho can be from num/(n(n^2-1)/12).
+    hx = np.maximum(cx-1, 0)/2.0
+    hy = np.maximum(cy-1, 0)/2.0
+    slack = np.dot(np.abs(dx), np.dot(H, hy)) + np.dot(hx, np.dot(H, np.abs(dy))) + np.dot(hx, np.dot(H, hy))
+    scale = n*(n*n-1)/12.0
+    lower = max((num-slack)/scale, -1.0)
+    upper = min((num+slack)/scale, 1.0)
+    rho = min(max(rho, lower), upper)
+    return rho, max(rho-lower, upper-rho)
+
+
+class Hist2dFigure:
+    """The three panel 2D histogram layout, built once and redrawn with new data.
+
+    """
+    def __init__( self, fig, bins=100 ):
+
+        # define some gridding.
+        self.fig = fig
+        grid = GridSpec(9,9)
+        self.axHist2d = fig.add_subplot( grid[1:9,0:8] )
+        self.axHistx  = fig.add_subplot( grid[0,0:8] )
+        self.axHisty  = fig.add_subplot( grid[1:9,8] )
+
+        # print some correlation coefficients at the top of the image.
+        self.banner = fig.text(0.05,.95,'', style='italic', fontsize=10 )
+
+        # remove some labels
+        nullfmt   = NullFormatter()
+        self.axHistx.xaxis.set_major_formatter(nullfmt)
+        self.axHistx.yaxis.set_major_formatter(nullfmt)
+        self.axHisty.xaxis.set_major_formatter(nullfmt)
+        self.axHisty.yaxis.set_major_formatter(nullfmt)
+
+        # remove some axes lines
+        self.axHistx.spines['top'].set_visible(False)
+        self.axHistx.spines['right'].set_visible(False)
+        self.axHistx.spines['left'].set_visible(False)
+        self.axHisty.spines['top'].set_visible(False)
+        self.axHisty.spines['bottom'].set_visible(False)
+        self.axHisty.spines['right'].set_visible(False)
+
+        # remove some ticks
+        self.axHistx.set_xticks([])
+        self.axHistx.set_yticks([])
+        self.axHisty.set_xticks([])
+        self.axHisty.set_yticks([])
+
+        self.axHisty.yaxis.set_label_position("right")
+        self.bins = None
+        self.setBins( bins )
+
+    def setBins( self, bins ):
+
+        # (re)create the artists that depend on the number of bins.
+        if self.bins != None:
+            self.image.remove()
+            self.xBars.remove()
+            self.yBars.remove()
+        self.bins = bins
+        edges = np.arange(bins+1)
+        self.image = self.axHist2d.imshow(np.zeros((bins,bins)), interpolation='nearest', aspect='auto' )
+        self.xBars = self.axHistx.bar(edges[:-1], np.zeros(bins), width=1, align='edge', facecolor='blue', alpha=0.5, edgecolor='None' )
+        self.yBars = self.axHisty.barh(edges[:-1], np.zeros(bins), height=1, align='edge', facecolor='blue', alpha=0.5, edgecolor='None' )
+        self.axHist2d.set_xlim( [-0.5, bins-0.5] )
+        self.axHist2d.set_ylim( [-0.5, bins-0.5] )
+        myTicks = np.arange(0,bins,10);
+        self.axHist2d.set_xticks(myTicks)
+        self.axHist2d.set_yticks(myTicks)
+
+    def update( self, H, xedges, yedges, r, rho, rhoErr, MapX, MapY ):
+
+        if H.shape[0] != self.bins:
+            self.setBins( H.shape[0] )
+
+        # the 2D Histogram, which represents the 'scatter' plot:
+        self.image.set_data(H.T)
+        self.image.set_clim(H.min(), H.max())
+
+        # histograms for x and y seperately, from the margins of the 2D histogram.
+        xCounts = H.sum(axis=1)
+        yCounts = H.sum(axis=0)
+        for bar, left, width, count in zip(self.xBars.patches, xedges[:-1], np.diff(xedges), xCounts):
+            bar.set_x(left)
+            bar.set_width(width)
+            bar.set_height(count)
+        for bar, bottom, height, count in zip(self.yBars.patches, yedges[:-1], np.diff(yedges), yCounts):
+            bar.set_y(bottom)
+            bar.set_height(height)
+            bar.set_width(count)
+
+        if rhoErr != None:
+            rhoText = '; rho~'+str(round(rho,2))+' (+/-'+str(round(rhoErr,3))+')'
+        else:
+            rhoText = '; rho='+str(round(rho,2))
+        self.banner.set_text('r='+str(round(r,2))+rhoText)
+
+        # set axes
+        self.axHistx.set_xlim( [xedges.min(), xedges.max()] )
+        self.axHistx.set_ylim( [0, max(xCounts.max(),1)*1.05] )
+        self.axHisty.set_ylim( [yedges.min(), yedges.max()] )
+        self.axHisty.set_xlim( [0, max(yCounts.max(),1)*1.05] )
+
+        # label 2d hist axes
+        myTicks = np.arange(0,self.bins,10);
+        self.axHist2d.set_xticklabels(np.round(xedges[myTicks],2))
+        self.axHist2d.set_yticklabels(np.round(yedges[myTicks],2))
+
+        # set titles
+        self.axHist2d.set_xlabel(MapX, fontsize=16)
+        self.axHist2d.set_ylabel(MapY, fontsize=16)
+        self.axHistx.set_title(MapX, fontsize=10)
+        self.axHisty.set_ylabel(MapY, fontsize=10, rotation=-90, verticalalignment='top', horizontalalignment='center' )
+
+
+# one preallocated figure that every headless render draws into.
+_headlessFigure = None
+
+def renderImage2Image_2dHist( outFile, H, xedges, yedges, r, rho, rhoErr, MapX, MapY, format=None ):
+
+    # draw with the agg canvas directly, so no gui backend or pyplot figure
+    # manager is ever involved; outFile may be a path or a file-like buffer.
+    global _headlessFigure
+    if _headlessFigure == None:
+        fig = Figure(figsize=(8,8), facecolor='white')
+        FigureCanvasAgg(fig)
+        _headlessFigure = Hist2dFigure(fig, bins=H.shape[0])
+    _headlessFigure.update( H, xedges, yedges, r, rho, rhoErr, MapX, MapY )
+    _headlessFigure.fig.savefig( outFile, format=format, facecolor='white' )
+
+
+def image2image2dHist( MapX, MapY, thresholdX=None, thresholdY=None, logY=None, logX=None, filterX=None, filterY=None, bins=100, slabSize=None, exactRho=None, rhoBins=1000 ):
+
+    if (slabSize != None) & (exactRho != None):
+        raise ValueError( 'The exact rho needs every voxel in memory; it cannot be combined with slabSize.' )
+    if (rhoBins == None) & (exactRho == None):
+        raise ValueError( 'rho is estimated from a rhoBins x rhoBins histogram; give rhoBins, or exactRho without slabSize.' )
+
+    if slabSize != None:
+        # stream both maps through in slabs, so peak memory depends on the
+        # slab size rather than the size of the volumes.
+        H, xedges, yedges, r, Hrho = streaming2dHist( MapX, MapY, slabSize, bins=bins, rhoBins=rhoBins,
+            thresholdX=thresholdX, thresholdY=thresholdY, logY=logY, logX=logX, filterX=filterX, filterY=filterY )
+        rho, rhoErr = histogramSpearman( Hrho )
+    else:
+        # load image files.
+        img = nib.load(MapX)
+        img2 = nib.load(MapY)
+
+
+        # get image data.
+        img_data = np.asanyarray(img.dataobj)
+        img2_data = np.asanyarray(img2.dataobj)
+
+
+        # vectorize image data.
+        x_data = img_data.reshape((img_data.shape[0]*img_data.shape[1]*img_data.shape[2],-1))
+        y_data = img2_data.reshape((img2_data.shape[0]*img2_data.shape[1]*img2_data.shape[2],-1))
+
+
+        # decide which points to include
+        keep = getVoxelMask( x_data, y_data, thresholdX, thresholdY, filterX, filterY )
+        y = y_data[keep]
+        x = x_data[keep]
+
+
+        # log scale if you like.
+        if logY != None:
+            y = np.log(y)
+        if logX != None:
+            x = np.log(x)
+
+        # the 2D Histogram, which represents the 'scatter' plot:
+        H, xedges, yedges = np.histogram2d( x, y, bins=(bins,bins) )
+        r = np.corrcoef( x, y )[1][0]
+        if exactRho != None:
+            rho = spearmanr( x, y )[0]
+            rhoErr = None
+        else:
+            # rank correlation from a fine-grained joint histogram, rather
+            # than argsorting every voxel.
+            rho, rhoErr = histogramSpearman( np.histogram2d( x, y, bins=rhoBins )[0] )
+
+    return H, xedges, yedges, r, rho, rhoErr
+
+
+def plotImage2Image_2dHist( MapX, MapY, thresholdX=None, thresholdY=None, logY=None, logX=None, filterX=None, filterY=None, bins=100, slabSize=None, exactRho=None, rhoBins=1000, outFile=None, format=None ):
+
+    H, xedges, yedges, r, rho, rhoErr = image2image2dHist( MapX, MapY, thresholdX, thresholdY, logY, logX, filterX, filterY, bins, slabSize, exactRho, rhoBins )
+
+    if outFile != None:
+        renderImage2Image_2dHist( outFile, H, xedges, yedges, r, rho, rhoErr, MapX, MapY, format=format )
+        return
 
     # start with a rectangular Figure
     mainFig = plt.figure(1, figsize=(8,8), facecolor='white')
-    
-    # define some gridding.
-    axHist2d = plt.subplot2grid( (9,9), (1,0), colspan=8, rowspan=8 )
-    axHistx  = plt.subplot2grid( (9,9), (0,0), colspan=8 )
-    axHisty  = plt.subplot2grid( (9,9), (1,8), rowspan=8 )
-
-    # the 2D Histogram, which represents the 'scatter' plot:
-    H, xedges, yedges = np.histogram2d( x, y, bins=(bins,bins) )
-    axHist2d.imshow(H.T, interpolation='nearest', aspect='auto' )
-    
-    # make histograms for x and y seperately.
-    axHistx.hist(x, bins=xedges, facecolor='blue', alpha=0.5, edgecolor='None' )
-    axHisty.hist(y, bins=yedges, facecolor='blue', alpha=0.5, orientation='horizontal', edgecolor='None')
-    
-    # print some correlation coefficients at the top of the image.
-    mainFig.text(0.05,.95,'r='+str(round(np.corrcoef( x, y )[1][0],2))+'; rho='+str(round(spearmanr( x, y )[0],2)), style='italic', fontsize=10 )
-
-    # set axes
-    axHistx.set_xlim( [xedges.min(), xedges.max()] )
-    axHisty.set_ylim( [yedges.min(), yedges.max()] )
-    axHist2d.set_ylim( [ axHist2d.get_ylim()[1], axHist2d.get_ylim()[0] ] )
-
-    # remove some labels
-    nullfmt   = NullFormatter()
-    axHistx.xaxis.set_major_formatter(nullfmt)
-    axHistx.yaxis.set_major_formatter(nullfmt)
-    axHisty.xaxis.set_major_formatter(nullfmt)
-    axHisty.yaxis.set_major_formatter(nullfmt)
-
-    # remove some axes lines
-    axHistx.spines['top'].set_visible(False)
-    axHistx.spines['right'].set_visible(False)
-    axHistx.spines['left'].set_visible(False)
-    axHisty.spines['top'].set_visible(False)
-    axHisty.spines['bottom'].set_visible(False)
-    axHisty.spines['right'].set_visible(False)
-
-    # remove some ticks
-    axHistx.set_xticks([])
-    axHistx.set_yticks([])
-    axHisty.set_xticks([])
-    axHisty.set_yticks([])
-
-    # label 2d hist axes
-    myTicks = np.arange(0,bins,10);
-    axHist2d.set_xticks(myTicks)
-    axHist2d.set_yticks(myTicks)
-    axHist2d.set_xticklabels(np.round(xedges[myTicks],2))
-    axHist2d.set_yticklabels(np.round(yedges[myTicks],2))
-    
-    # set titles
-    axHist2d.set_xlabel(MapX, fontsize=16)
-    axHist2d.set_ylabel(MapY, fontsize=16)
-    axHistx.set_title(MapX, fontsize=10)
-    axHisty.yaxis.set_label_position("right")
-    axHisty.set_ylabel(MapY, fontsize=10, rotation=-90, verticalalignment='top', horizontalalignment='center' )
-    
+    Hist2dFigure( mainFig, bins=bins ).update( H, xedges, yedges, r, rho, rhoErr, MapX, MapY )
+
     # set the window title
     mainFig.canvas.set_window_title( (MapX + ' vs. ' + MapY) )
     
@@ -121,13 +347,75 @@ def plotImage2Image_2dHist( MapX, MapY, thresholdX=None, thresholdY=None, logY=N
     plt.show()
 
 
+def imageCorrelationMatrix( Maps, threshold=None, filterValue=None, log=None, method='pearson', outMatrix=None, thumbnailDir=None, bins=100 ):
+
+    # first pass: find the voxels every image shares, holding one image at a time.
+    shape = None
+    keep = True
+    for Map in Maps:
+        img = nib.load(Map)
+        if shape == None:
+            shape = img.shape
+        elif img.shape != shape:
+            raise ValueError( Map + ' does not have the same shape as ' + Maps[0] + '.' )
+        img_data = np.asanyarray(img.dataobj).ravel()
+        keep = keep & getVoxelMask( img_data, img_data, threshold, None, filterValue, None )
+        del(img_data)
+
+    # second pass: read each image again and keep only its row of shared voxels,
+    # so the full images are never all in memory next to X.
+    X = np.empty((len(Maps), np.count_nonzero(keep)))
+    if X.shape[1] < 2:
+        raise ValueError( 'Fewer than two voxels are shared by every image.' )
+    for i, Map in enumerate(Maps):
+        img_data = np.asanyarray(nib.load(Map).dataobj).ravel()
+        X[i] = img_data[keep]
+        del(img_data)
+
+    if log != None:
+        np.log(X, out=X)
+    values = X
+    if method == 'spearman':
+        # spearman is pearson on the ranks; rank each image once, not once per pair.
+        values = rankdata( X, axis=1 )
+    elif method != 'pearson':
+        raise ValueError( 'Unknown correlation method: ' + method )
+
+    # standardize each row, then one matrix product gives every pair.
+    Z = values - values.mean(axis=1)[:,np.newaxis]
+    Z /= np.sqrt((Z*Z).sum(axis=1))[:,np.newaxis]
+    R = np.dot(Z, Z.T)
+    np.clip(R, -1.0, 1.0, out=R)
+
+    if outMatrix != None:
+        np.savetxt( outMatrix, R, fmt='%.6f', delimiter='\t', header='\t'.join(Maps), comments='' )
+
+    if thumbnailDir != None:
+        # small 2D histograms for each pair, written straight to png without a figure.
+        # maps are named by their path below the directory they all share (so
+        # subj1/zstat1.nii.gz and subj2/zstat1.nii.gz don't collide), and each
+        # thumbnail starts with its pair's indices, so no two can overwrite each other.
+        top = os.path.commonprefix([ os.path.dirname(os.path.abspath(Map)) + os.sep for Map in Maps ])
+        top = top[:top.rfind(os.sep)+1]
+        names = [ os.path.relpath(os.path.abspath(Map), top) for Map in Maps ]
+        names = [ os.path.join( os.path.dirname(name), os.path.basename(name).split('.')[0] ).replace(os.sep, '_') for name in names ]
+        for i in range(len(Maps)):
+            for j in range(i+1, len(Maps)):
+                H = np.histogram2d( X[i], X[j], bins=(bins,bins) )[0]
+                thumbnail = os.path.join( thumbnailDir, '%d_%d_' % (i, j) + names[i] + '_vs_' + names[j] + '.png' )
+                plt.imsave( thumbnail, np.log1p(H.T)[::-1], cmap='viridis' )
+
+    return R
+
+
 
 if __name__ == '__main__':
     import argparse
+    import sys
     
     parser = argparse.ArgumentParser(description='Plot two images against each other with a 2D histogram.')
-    parser.add_argument('-x','--MapX', help='X axis image',default=None, required=True)
-    parser.add_argument('-y','--MapY', help='Y axis image',default=None, required=True)
+    parser.add_argument('-x','--MapX', help='X axis image',default=None, required=False)
+    parser.add_argument('-y','--MapY', help='Y axis image',default=None, required=False)
     parser.add_argument('-b','--bins', help='Number of Histogram Bins',default=100, required=False, type=int)
     parser.add_argument('-tx','--thresholdX', help='Lower Threshold for X',default=None, required=False, type=int)
     parser.add_argument('-ty','--thresholdY', help='Lower Threshold for Y',default=None, required=False, type=int)
@@ -135,8 +423,29 @@ if __name__ == '__main__':
     parser.add_argument('-fy','--filterY', help='Exclude Number for Y',default=None, required=False, type=int)
     parser.add_argument('-lx','--logX', help='LogY Flag', default=None, required=False, action='store_true')
     parser.add_argument('-ly','--logY', help='LogY Flag', default=None, required=False, action='store_true')
-    args = parser.parse_args()
+    parser.add_argument('-rb','--rhoBins', help='Number of Histogram Bins used to estimate rho',default=1000, required=False, type=int)
+    parser.add_argument('-er','--exactRho', help='Exact rho Flag', default=None, required=False, action='store_true')
+    parser.add_argument('-s','--slabSize', help='Stream the images in slabs of this many slices (or volumes, for 4D images)',default=None, required=False, type=int)
+    parser.add_argument('-out','--outFile', help='Write the plot to this png/svg file instead of showing it',default=None, required=False)
+    parser.add_argument('-m','--Maps', help='Correlate every pair of these images instead of plotting X against Y',default=None, required=False, nargs='+')
+    parser.add_argument('-c','--method', help='Correlation for --Maps (pearson or spearman)',default='pearson', required=False, choices=['pearson','spearman'])
+    parser.add_argument('-o','--outMatrix', help='Where to write the --Maps correlation matrix',default=None, required=False)
+    parser.add_argument('-td','--thumbnailDir', help='Directory for a 2D histogram thumbnail of each --Maps pair',default=None, required=False)
+    parser.add_argument('-t','--threshold', help='Lower Threshold for every --Maps image',default=None, required=False, type=int)
+    parser.add_argument('-f','--filterValue', help='Exclude Number for every --Maps image',default=None, required=False, type=int)
+    parser.add_argument('-l','--log', help='Log Flag for every --Maps image', default=None, required=False, action='store_true')
+    args = vars(parser.parse_args())
 
-    plotImage2Image_2dHist( **vars(args) )   
+    batchArgs = ['Maps','method','outMatrix','thumbnailDir','threshold','filterValue','log']
+    if args['Maps'] != None:
+        R = imageCorrelationMatrix( bins=args['bins'], **dict( (k, args[k]) for k in batchArgs ) )
+        if args['outMatrix'] == None:
+            np.savetxt( sys.stdout, R, fmt='%.3f', delimiter='\t' )
+    elif (args['MapX'] == None) | (args['MapY'] == None):
+        parser.error( 'either --MapX and --MapY, or --Maps, is required' )
+    else:
+        for k in batchArgs:
+            del(args[k])
+        plotImage2Image_2dHist( **args )   
 
 
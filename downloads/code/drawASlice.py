@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
-# import alot of libraries... 
+# import alot of libraries...
 # If these aren't installed, you will have to install them. :-/
 import sys
 import os
+import io
+import argparse
+import collections
+import multiprocessing
 import nibabel as nib
 import numpy as np
 import matplotlib
@@ -12,51 +16,228 @@ import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import subprocess
 
-def main(argv):
-    sliceNum = argv[1]
-    dim = int(argv[2])
-    outf = argv[3]
-    rate = int(argv[4])
-    in_files = argv[5:]
-
-    # Prepare to pipe to ffmpeg
-    cmdstring = ('ffmpeg',
-        '-y',
-        '-f','image2pipe',
-        '-r', '%d' % rate,
-        '-vcodec', 'png',
-        '-s', '320x280',
-        '-i', 'pipe:', outf
-        )
-    # setup a ffmpeg pipe... 
-    p = subprocess.Popen(cmdstring, stdin=subprocess.PIPE)
-
-    # setup a the fig and main axis to plot on
-    fig = plt.figure(facecolor='black', figsize=(4, 3), dpi=80)
-    ax = plt.Axes(fig, [0., 0., 1., 1.])
-    ax.set_axis_off()
-    fig.add_axes(ax)
-
-    # for each image in the input list
-    for i, f in enumerate(in_files):
-        # read the image
+# each process (the main one, or a pool worker) keeps its own figure to draw on.
+_frameAxes = None
+
+# ...and the last image it opened, so the frames of a 4D image share one
+# header read and one open file.
+_lastImage = (None, None)
+
+# which array axis each dim slices along.
+DIM_AXIS = {1: 1, 2: 0, 3: 2}
+
+# the grayscale colormap as a 256 entry uint8 RGB lookup table.
+GRAY_LUT = (cm.Greys_r(np.linspace(0, 1, 256))[:, :3]*255).round().astype(np.uint8)
+
+# the size of the movie, as matplotlib draws it (4x3 inches at 80 dpi).
+FRAME_SIZE = (320, 240)
+
+def loadImage(f):
+    global _lastImage
+    if _lastImage[0] == f:
+        return _lastImage[1]
+    # only read the header; the data stays on disk behind the array proxy.
+    # keeping .nii.gz files open lets nibabel use indexed_gzip (when it is
+    # installed), which caches seek points instead of re-inflating from the
+    # start of the file for every read.
+    if f.endswith('.gz'):
+        img = nib.load(f, keep_file_open=True)
+    else:
         img = nib.load(f)
-        img_data = img.get_data()
-        # find the right slice to draw
-        if dim==1:
-            toDraw = img_data[:,sliceNum,:];
-        elif dim==2:
-            toDraw = img_data[sliceNum,:,:];
-        elif dim==3:
-            toDraw = img_data[:,:,sliceNum];
-        # orient appropriately?
-        toDraw=np.rot90(toDraw)
-        
-        # show the image 
-        im = ax.imshow(toDraw, cmap = cm.Greys_r, interpolation='nearest')
-        plt.show()
-        # write to the pipe...
-        plt.savefig(p.stdin, format='png', facecolor=fig.get_facecolor(), edgecolor='none', dpi=(80) )
+    _lastImage = (f, img)
+    return img
+
+def sliceIndex(sliceNum, dim):
+    # find the right slice to draw
+    if dim==1:
+        return (slice(None), sliceNum, slice(None))
+    elif dim==2:
+        return (sliceNum, slice(None), slice(None))
+    elif dim==3:
+        return (slice(None), slice(None), sliceNum)
+
+def readData(img, index, volume):
+    # read just the bytes of index (in one volume of a 4D image) from the image
+    if volume is not None:
+        index = index + (volume,)
+    return np.asanyarray(img.dataobj[index])
+
+def getSlice(f, sliceNum, dim, volume=None):
+    img = loadImage(f)
+    toDraw = readData(img, sliceIndex(sliceNum, dim), volume)
+    # orient appropriately?
+    return np.rot90(toDraw)
+
+def getMontage(f, panels, volume=None):
+    # a single plane only needs that plane read from disk
+    if len(panels) == 1:
+        sliceNum, dim = panels[0]
+        return getSlice(f, sliceNum, dim, volume)
+
+    # otherwise read the volume once and cut every panel out of it
+    img = loadImage(f)
+    img_data = readData(img, (slice(None),)*3, volume)
+    toDraw = [ np.rot90(img_data[sliceIndex(sliceNum, dim)]).astype(np.float64) for sliceNum, dim in panels ]
+
+    # lay the panels out side by side, centred vertically on a nan (black) background
+    height = max([ panel.shape[0] for panel in toDraw ])
+    for i, panel in enumerate(toDraw):
+        top = (height-panel.shape[0])//2
+        toDraw[i] = np.pad(panel, ((top, height-panel.shape[0]-top), (0, 0)), mode='constant', constant_values=np.nan)
+    return np.hstack(toDraw)
+
+def rawFrame(toDraw):
+    # scale each frame to its own range, like imshow does, and look the
+    # result up in the colormap; nans are drawn black.
+    toDraw = np.asarray(toDraw, dtype=np.float64)
+    finite = np.isfinite(toDraw)
+    if finite.any():
+        lo = toDraw[finite].min()
+        hi = toDraw[finite].max()
+    else:
+        lo = hi = 0.0
+    scale = 255.0/(hi-lo) if hi > lo else 0.0
+    idx = np.zeros(toDraw.shape, dtype=np.uint8)
+    idx[finite] = np.clip((toDraw[finite]-lo)*scale, 0, 255).astype(np.uint8)
+    rgb = GRAY_LUT[idx]
+    rgb[~finite] = 0
+    return rgb
+
+def renderFrame(job):
+    global _frameAxes
+    f, volume, panels, png = job
+    toDraw = getMontage(f, panels, volume)
+    if not png:
+        return rawFrame(toDraw)
+
+    # setup a the fig and main axis to plot on, once per process
+    if _frameAxes is None:
+        fig = plt.figure(facecolor='black', figsize=(4, 3), dpi=80)
+        _frameAxes = plt.Axes(fig, [0., 0., 1., 1.])
+        _frameAxes.set_axis_off()
+        fig.add_axes(_frameAxes)
+    ax = _frameAxes
+    fig = ax.figure
+
+    # show the image, replacing the last frame's
+    for im in ax.images:
+        im.remove()
+    ax.imshow(toDraw, cmap = cm.Greys_r, interpolation='nearest')
+    # encode the frame as png
+    frame = io.BytesIO()
+    fig.savefig(frame, format='png', facecolor=fig.get_facecolor(), edgecolor='none', dpi=(80) )
+    return frame.getvalue()
+
+def orderedFrames(jobs, nJobs, maxPending):
+    # render in the calling process
+    if nJobs == 1:
+        for job in jobs:
+            yield renderFrame(job)
+        return
+
+    # render in a pool, but hand frames back in order; at most maxPending
+    # frames are queued or waiting to be written at any time.
+    pool = multiprocessing.Pool(nJobs)
+    try:
+        pending = collections.deque()
+        for job in jobs:
+            if len(pending) >= maxPending:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(renderFrame, (job,)))
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+def main(argv):
+    global _lastImage
+    parser = argparse.ArgumentParser(description='Make a flipbook movie of one slice from each image, or from each volume of a 4D image.')
+    parser.add_argument('sliceNum', help='Slice to draw', type=int)
+    parser.add_argument('dim', help='Dimension to slice along (1, 2 or 3)', type=int, choices=[1,2,3])
+    parser.add_argument('outf', help='Output movie')
+    parser.add_argument('rate', help='Frame rate', type=int)
+    parser.add_argument('in_files', help='Images, one frame per 3D image or per volume of a 4D image', nargs='+')
+    parser.add_argument('-s','--slices', help='More slices along dim to show next to sliceNum', default=[], type=int, nargs='+')
+    parser.add_argument('-o','--ortho', help='Also show the other two planes through the centre of the image', action='store_true')
+    parser.add_argument('-j','--jobs', help='Number of processes used to render frames', default=1, type=int)
+    parser.add_argument('-p','--png', help='Draw each frame with matplotlib and pipe png images to ffmpeg', action='store_true')
+    parser.add_argument('-b','--buffer', help='Most frames to render ahead of the movie encoder', default=None, type=int)
+    args = parser.parse_args(argv[1:])
+    sliceNum = args.sliceNum
+    dim = args.dim
+    outf = args.outf
+    rate = args.rate
+    in_files = args.in_files
+    maxPending = args.buffer
+    if maxPending is None:
+        maxPending = 4*args.jobs
+
+    # the planes drawn in each frame
+    panels = [ (s, dim) for s in [sliceNum] + args.slices ]
+    if args.ortho:
+        shape = loadImage(in_files[0]).shape
+        for d in (1, 2, 3):
+            if d != dim:
+                panels.append( (shape[DIM_AXIS[d]]//2, d) )
+
+    # for each image in the input list, and each volume of 4D images
+    jobs = []
+    frameFiles = []
+    for f in in_files:
+        img = loadImage(f)
+        if len(img.shape) > 3:
+            volumes = range(img.shape[3])
+        else:
+            volumes = [None]
+        for volume in volumes:
+            jobs.append( (f, volume, panels, args.png) )
+            frameFiles.append( f if volume is None else '%s[%d]' % (f, volume) )
+
+    # close the headers we opened, so pool workers don't share a file offset
+    del(img)
+    _lastImage = (None, None)
+    frames = orderedFrames(jobs, args.jobs, maxPending)
+
+    if args.png:
+        # Prepare to pipe to ffmpeg
+        cmdstring = ('ffmpeg',
+            '-y',
+            '-f','image2pipe',
+            '-r', '%d' % rate,
+            '-vcodec', 'png',
+            '-s', '320x280',
+            '-i', 'pipe:', outf
+            )
+        # setup a ffmpeg pipe...
+        p = subprocess.Popen(cmdstring, stdin=subprocess.PIPE)
+        for frame in frames:
+            # write to the pipe...
+            p.stdin.write(frame)
+    else:
+        # raw rgb frames; ffmpeg scales them into the same letterboxed
+        # 320x240 frame matplotlib would have drawn.
+        first = next(frames)
+        height, width = first.shape[:2]
+        cmdstring = ('ffmpeg',
+            '-y',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'rgb24',
+            '-s', '%dx%d' % (width, height),
+            '-r', '%d' % rate,
+            '-i', 'pipe:',
+            '-vf', 'scale=%d:%d:force_original_aspect_ratio=decrease:flags=neighbor,pad=%d:%d:(ow-iw)/2:(oh-ih)/2' % (FRAME_SIZE*2),
+            outf
+            )
+        p = subprocess.Popen(cmdstring, stdin=subprocess.PIPE)
+        p.stdin.write(first.tobytes())
+        for i, frame in enumerate(frames):
+            if frame.shape != first.shape:
+                p.stdin.close()
+                p.wait()
+                raise ValueError('%s has a %dx%d slice, but the movie is %dx%d' % (frameFiles[i+1], frame.shape[1], frame.shape[0], width, height))
+            p.stdin.write(frame.tobytes())
+    p.stdin.close()
+    p.wait()
 
 if __name__ == '__main__':
     main(sys.argv)
@@ -8,6 +8,9 @@
                 Module and translates it into the files needed
                 to submit a Condor DAG.
 
+  Usage:        loni2condor.py --input=FILENAME --output=DIR_NAME, or, from python,
+                translate( xmlFile, outDir ) and translateMany( [(xmlFile, outDir), ...] ).
+
   Resources:    Condor: http://www.cs.wisc.edu/condor
                 LONI Pipeline: http://www.loni.ucla.edu/Software/
 """
@@ -16,10 +19,30 @@ __author__ = 'Andrew S. Fox'
 
 import sys
 from optparse import OptionParser
-import xml.dom.minidom
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 import re
 import os
+import hashlib
+import heapq
+import time
+import subprocess
+import json
+import csv
+import math
+import copy
+import array
+from multiprocessing.pool import ThreadPool
+
+
+class LONIPipelineError(Exception):
+    """A LONI Pipeline that can't be translated into a Condor DAG (i.e. it refers to a module that
+       doesn't exist, or has a cycle).  The message is what should be reported.
 
+    """
+    pass;
 
 class LONIFile:
     """ A File/Variable that is used by a LONI Pipeline Module
@@ -34,7 +57,7 @@ class LONIFile:
         Variables:
         PARENT_INPUT -- LONI Modules using this LONI File as an input.
         PARENT_OUTPUT -- LONI Modules using this LONI File as an output.
-        fileList -- The list of files represented by this LONI File.
+        fileList -- The list of files represented by this LONI File; either a list or a LONIFileList.
         needsParsing -- '1' if this LONI File requires some parsing, '0' if not.
         PARAMS -- A dict that contains XML parameters of the LONI File; all parameters are set to their defaults.
 
@@ -87,43 +110,355 @@ class LONIFile:
 
         """
         self.PARENT_OUTPUT.append( parent );
-    def checkFilePermissions( self ):
+    def getFilenameTemplate( self ):
+        """Return the compiled LONIFilenameTemplate for this file's FILENAME.
+
+        """
+        return LONIFilenameTemplate.compile( self.PARAMS['FILENAME'], self.isInput == 1 );
+    def checkFilePermissions( self, checker=None ):
         """Check the File Permissions
         
+        Arguments:
+        checker -- A FilePermissionChecker to queue the checks on, so that many files can be checked
+                   (and reported) together.  If it is not given, this file is checked and reported on its own.
+
         Notes: This function does not currently work properly... it produces many false positives.
 
         """
         if( self.PARAMS['CHECK'].lower() == 'true' ):
             if( self.PARAMS['TYPE'].lower() == 'file' ):
-                errorCode = 0;
+                report = 0;
+                if( checker == None ):
+                    checker = FilePermissionChecker();
+                    report = 1;
                 if( (self.PARAMS['READFROM'] == '') & (self.isInput == 1) ):
-                    for file in self.fileList:
-                        if( os.access(file, os.R_OK ) != True ):
-                            print "Error: Can't read from "+file
-                            errorCode = 1;
+                    checker.add( self.fileList, 'read' );
+                elif( self.PARAMS['OVERWRITING'].lower() != "true" ):
+                    checker.add( self.fileList, 'create' );
                 else:
-                    for file in self.fileList:
-                        if( os.access( file, os.F_OK ) == True ):
-                            if( self.PARAMS['OVERWRITING'].lower() != "true" ):
-                                print "Error: "+file+" already exists.";
-                                errorCode = 2;
-                            else:
-                                if( os.access( file, os.W_OK ) != True ):
-                                    print "Error: Can't write to "+file
-                                    errorCode = 1;
-                        else:
-                            file_dir = re.search( r'(\S*)[\\|/]\S+s*$', file );
-                            file_dir = file_dir.group(1);
-                            if( os.access( file_dir, os.W_OK ) != True ):
-                                print "Error: Can't create files in "+file_dir
-                                errorCode = 1; 
-    
-                if( errorCode == 1 ):
-                    print "\nThe Condor files will be created, but you will need to fix this before execution. \n";
-                elif( errorCode == 2 ):
-                    print "The Condor files will be created, but this is a serious error and you MUST fix this before execution or risk destroying data."
+                    checker.add( self.fileList, 'write' );
+                if( report == 1 ):
+                    checker.report();
             
 
+class FilePermissionChecker:
+    """Checks that many files can be read or written, one directory at a time.
+
+    """
+    numThreads = 16;
+    maxExamples = 5;
+    def __init__(self, probed=None):
+        """Create a new, empty, checker.
+
+        Arguments:
+        probed -- A dict of directories already probed (see below), to share with other checkers.
+
+        Variables:
+        directories -- A dict mapping each directory to the (filename, mode) pairs to check in it.
+        queued -- The (filename, mode) pairs already queued, so a file referred to twice is checked once.
+        probed -- A dict mapping each directory already probed to (names, writable, readable, stamp), where names
+                  is the set of entries in the directory (None if it can't be listed), and stamp is when
+                  the directory was last changed (see directoryStamp), so a stale probe can be told apart.
+        skipped -- Files that should not be checked after all.
+
+        """
+        self.directories = {};
+        self.queued = set();
+        if( probed == None ):
+            probed = {};
+        self.probed = probed;
+        self.skipped = set();
+    def add( self, fileList, mode ):
+        """Queue some files to be checked.
+
+        Arguments:
+        fileList -- The paths of the files.
+        mode -- 'read' if the files must be readable, 'write' if they must be writable (or creatable),
+                and 'create' if they must not already exist.
+
+        """
+        for file in fileList:
+            if( (file, mode) in self.queued ):
+                continue;
+            self.queued.add( (file, mode) );
+            directory, name = os.path.split( file );
+            self.directories.setdefault( directory, [] ).append( (file, name, mode) );
+    def skip( self, fileList ):
+        """Don't check some files after all (i.e. the outputs of Jobs that won't run again).
+
+        Arguments:
+        fileList -- The paths of the files.
+
+        """
+        self.skipped.update( fileList );
+    def directoryStamp( directory ):
+        """Return (modification time, change time) of a directory, or None if it doesn't exist.
+           Adding or removing files changes the first, and a chmod the second.
+
+        """
+        try:
+            info = os.stat( directory or '.' );
+        except OSError:
+            return None;
+        return ( info.st_mtime, info.st_ctime );
+    directoryStamp = staticmethod( directoryStamp );
+    def probeDirectory( self, directory ):
+        """List a directory once, and check whether it is writable, and whether the files in it can be read.
+
+        Arguments:
+        directory -- The directory to probe ('' is the current directory).
+
+        """
+        stamp = self.directoryStamp( directory );
+        try:
+            names = set( os.listdir( directory or '.' ) );
+        except OSError:
+            names = None;
+        return ( names, os.access( directory or '.', os.W_OK ), os.access( directory or '.', os.R_OK | os.X_OK ), stamp );
+    def checkDirectory( self, directory ):
+        """Check the files queued in one directory.
+
+        Arguments:
+        directory -- The directory to check.
+
+        Returns:
+        A list of (problem, file) pairs, where problem is 'read', 'write', 'exists' or 'create'.
+
+        """
+        # a probe shared with an earlier translation is redone if the directory has changed since.
+        if( (not self.probed.has_key( directory )) or (self.probed[directory][3] != self.directoryStamp( directory )) ):
+            self.probed[directory] = self.probeDirectory( directory );
+        names, writable, readable, stamp = self.probed[directory];
+        problems = [];
+        for file, name, mode in self.directories[directory]:
+            if( file in self.skipped ):
+                continue;
+            if( (names == None) or (name == '') ):
+                exists = os.access( file, os.F_OK );
+            else:
+                exists = name in names;
+            if( mode == 'read' ):
+                # missing files are found from the directory listing, so only inputs that exist
+                # cost a system call of their own.
+                if( (not exists) or (not readable) or (os.access( file, os.R_OK ) != True) ):
+                    problems.append( ('read', file) );
+            elif( exists ):
+                if( mode == 'create' ):
+                    problems.append( ('exists', file) );
+                elif( os.access( file, os.W_OK ) != True ):
+                    problems.append( ('write', file) );
+            elif( not writable ):
+                problems.append( ('create', file) );
+        return problems;
+    def check( self ):
+        """Check every queued file, probing the directories concurrently, and forget them.
+
+        Returns:
+        A dict mapping each directory to its list of (problem, file) pairs.
+
+        """
+        directories = self.directories.keys();
+        directories.sort();
+        if( len(directories) > 1 ):
+            pool = ThreadPool( min( self.numThreads, len(directories) ) );
+            try:
+                results = pool.map( self.checkDirectory, directories );
+            finally:
+                pool.close();
+        else:
+            results = map( self.checkDirectory, directories );
+        self.directories = {};
+        self.queued = set();
+        return dict( zip( directories, results ) );
+    def report( self ):
+        """Check every queued file, and print one report of the problems found.
+
+        Returns:
+        0 if there were no problems, 2 if files would be overwritten, and 1 otherwise.
+
+        """
+        messages = { 'read':"Can't read from",
+            'write':"Can't write to",
+            'exists':"These files already exist:",
+            'create':"Can't create files" };
+        errorCode = 0;
+        results = self.check();
+        directories = results.keys();
+        directories.sort();
+        for directory in directories:
+            byProblem = {};
+            for problem, file in results[directory]:
+                byProblem.setdefault( problem, [] ).append( os.path.basename( file ) or file );
+            for problem in [ 'read', 'write', 'exists', 'create' ]:
+                if( not byProblem.has_key( problem ) ):
+                    continue;
+                files = byProblem[problem];
+                examples = ', '.join( files[:self.maxExamples] );
+                if( len(files) > self.maxExamples ):
+                    examples = examples+', ... ('+str(len(files) - self.maxExamples)+' more)';
+                print "Error: "+messages[problem]+" "+str(len(files))+" file(s) in "+(directory or '.')+": "+examples;
+                if( problem == 'exists' ):
+                    errorCode = 2;
+                elif( errorCode == 0 ):
+                    errorCode = 1;
+        if( errorCode == 1 ):
+            print "\nThe Condor files will be created, but you will need to fix this before execution. \n";
+        elif( errorCode == 2 ):
+            print "The Condor files will be created, but this is a serious error and you MUST fix this before execution or risk destroying data."
+        return errorCode;
+
+
+class LONIFileList:
+    """A read-only list of file names that is only worked out as it is read, so that long
+       LONI File lists don't have to be held in memory until the DAG is written.
+
+    """
+    blockSize = 256;
+    def __len__( self ):
+        return self.length;
+    def __getitem__( self, index ):
+        if( isinstance( index, slice ) ):
+            return [ self.item( i ) for i in xrange( *index.indices( self.length ) ) ];
+        if( index < 0 ):
+            index = index + self.length;
+        if( (index < 0) or (index >= self.length) ):
+            raise IndexError( 'file list index out of range' );
+        return self.item( index );
+    def __iter__( self ):
+        for index in xrange( self.length ):
+            yield self.item( index );
+    def __eq__( self, other ):
+        if( not isinstance( other, (list, LONIFileList) ) ):
+            return False;
+        return (len(other) == self.length) and (list( self ) == list( other ));
+    def __ne__( self, other ):
+        return not self.__eq__( other );
+    def fingerprintOf( fileList ):
+        """Return a hash of where the names in a file list come from, without working them out.
+
+        Arguments:
+        fileList -- A list or a LONIFileList.
+
+        """
+        if( isinstance( fileList, LONIFileList ) ):
+            return fileList.digest;
+        return hashlib.sha1( 'names\0'+'\0'.join( fileList ) ).hexdigest();
+    fingerprintOf = staticmethod( fingerprintOf );
+
+class BroadcastFileList(LONIFileList):
+    """The same file, once for each execution.
+
+    """
+    def __init__( self, fileName, length ):
+        """Arguments:
+        fileName -- The file.
+        length -- The number of executions.
+
+        """
+        self.fileName = fileName;
+        self.length = length;
+        self.digest = hashlib.sha1( ''.join([ 'broadcast\0', fileName, '\0', str(length) ]) ).hexdigest();
+    def item( self, index ):
+        return self.fileName;
+
+class TemplateFileList(LONIFileList):
+    """The file names a LONIFilenameTemplate expands into, for the file lists it refers to.
+
+    """
+    def __init__( self, template, length, varLists, outFileLists ):
+        """Arguments:
+        template -- The LONIFilenameTemplate.
+        length -- The number of file names.
+        varLists -- A dict from each ${n} index to the file list it refers to.
+        outFileLists -- A dict from each -OutFile<n> index to the file list it refers to.
+
+        """
+        self.template = template;
+        self.length = length;
+        self.varLists = varLists;
+        self.outFileLists = outFileLists;
+        # the lists this one is derived from were made first, so this doesn't recurse.
+        digest = hashlib.sha1( ''.join([ 'template\0', template.filename, '\0', str(length), '\0' ]) );
+        for kind, lists in ( ('var', varLists), ('out', outFileLists) ):
+            for index, fileList in sorted( lists.items() ):
+                digest.update( ''.join([ kind, str(index), '=', self.fingerprintOf( fileList ), '\0' ]) );
+        self.digest = digest.hexdigest();
+        self.block = ( 0, [] );
+    def item( self, index ):
+        start, names = self.block;
+        if( (index < start) or (index >= start + len(names)) ):
+            # work out the next few names at once: they are usually read in order, and the
+            # lists this one is derived from then work out their own names a block at a time
+            # too, instead of once for each list derived from them.
+            start = index;
+            stop = min( index + self.blockSize, self.length );
+            names = [ self.template.expandOne( i, self.varLists, self.outFileLists ) for i in xrange( start, stop ) ];
+            self.block = ( start, names );
+        return names[index - start];
+
+class ListFileList(LONIFileList):
+    """The files in a .list file, which are read from the file again as they are needed; only
+       where each one starts in the file is kept.
+
+    Note:
+    Any line beginning with a $ # or % is ignored.
+
+    """
+    isComment = re.compile( r'^[$|#|%]' );
+    def __init__( self, filename ):
+        """Find the files in a .list file.
+
+        Arguments:
+        filename -- The .list file.
+
+        Variables:
+        offsets -- Where each file's line starts in the .list file.
+        digest -- A hash of the .list file.
+        block -- The index of the first of the files read last, and those files.
+
+        """
+        self.filename = filename;
+        self.offsets = array.array( 'l' );
+        digest = hashlib.sha1();
+        offset = 0;
+        listFile = open( filename );
+        try:
+            for line in listFile:
+                digest.update( line );
+                if( self.isComment.search( line ) == None ):
+                    self.offsets.append( offset );
+                offset = offset + len(line);
+        finally:
+            listFile.close();
+        self.length = len(self.offsets);
+        self.digest = hashlib.sha1( 'list\0'+digest.hexdigest() ).hexdigest();
+        self.block = ( 0, [] );
+    def item( self, index ):
+        start, lines = self.block;
+        if( (index < start) or (index >= start + len(lines)) ):
+            # read the next few files at once, since they are usually read in order.
+            start = index;
+            stop = min( index + self.blockSize, self.length );
+            listFile = open( self.filename );
+            try:
+                listFile.seek( self.offsets[start] );
+                if( stop < self.length ):
+                    text = listFile.read( self.offsets[stop] - self.offsets[start] );
+                else:
+                    text = listFile.read();
+            finally:
+                listFile.close();
+            lines = [];
+            for i in xrange( start, stop ):
+                begin = self.offsets[i] - self.offsets[start];
+                end = text.find( '\n', begin );
+                if( end == -1 ):
+                    end = len(text);
+                lines.append( text[begin:end].strip() );
+            self.block = ( start, lines );
+        return lines[index - start];
+
+
 class LONIModule:
     """A LONI Module that represents a commandline argument.
 
@@ -208,6 +543,298 @@ class LONIModule:
         """
         return len(self.INFILE);
 
+class LONIModuleIndex:
+    """An index of every Module in a LONI Pipeline, for looking Modules up by name.
+
+    """
+    def __init__(self):
+        """Create a new, empty, Module index.
+
+        Variables:
+        byName -- A dict mapping each Module name to the first Module (in traversal order) with that name.
+        suffixTrie -- A dict, keyed by the last character of a Module name, of tries over the reversed names.
+        modules -- Every Module, in traversal order.
+
+        """
+        self.byName = {};
+        self.suffixTrie = {};
+        self.modules = [];
+    def add(self, module):
+        """Add a Module to the index.  Modules must be added in traversal (pre)order.
+
+        Arguments:
+        module -- The LONI Module to add.
+
+        """
+        name = module.PARAMS['NAME'];
+        if( not self.byName.has_key( name ) ):
+            self.byName[name] = module;
+        # READFROM matching ignores trailing whitespace, and allows the last
+        # character to be repeated, so file each name under its last character
+        # with that character's trailing run removed.
+        stripped = name.rstrip();
+        if( stripped != '' ):
+            lastChar = stripped[-1];
+            base = stripped.rstrip( lastChar );
+            run = len(stripped) - len(base);
+            node = self.suffixTrie.setdefault( lastChar, [ {}, [] ] );
+            entry = ( run, module );
+            node[1].append( entry );
+            for char in reversed( base ):
+                node = node[0].setdefault( char, [ {}, [] ] );
+                node[1].append( entry );
+        self.modules.append( module );
+    def getByName(self, name):
+        """Return the Module named 'name', or -1 if there isn't one.
+
+        Arguments:
+        name -- The name of the Module to return.
+
+        """
+        return self.byName.get( name, -1 );
+    def getByPartialName(self, name):
+        """Return the first Module whose name ends with 'name', or -1 if there isn't one.
+
+        Description:
+        This matches the same Modules as the regular expression '.*?'+name+'+\s*$',
+        i.e. the last character of 'name' may be repeated, and trailing whitespace is ignored.
+
+        Arguments:
+        name -- The (partial) name of the Module to return.
+
+        """
+        if( name == '' ):
+            return -1;
+        lastChar = name[-1];
+        if( lastChar.isspace() ):
+            # the repeated character runs into the trailing whitespace; this
+            # is rare enough to just check every Module.
+            myName = re.sub(r'(?P<badChar>[\.\*\+\?\\\(\)\[\]\{\}\|\$\^])', r'\\\g<badChar>', name );
+            searchString = re.compile( '.*?'+myName+'+\s*$' );
+            for module in self.modules:
+                if( searchString.match( module.PARAMS['NAME'] ) ):
+                    return module;
+            return -1;
+        base = name[:-1].rstrip( lastChar );
+        minRun = len(name) - len(base);
+        node = self.suffixTrie.get( lastChar );
+        for char in reversed( base ):
+            if( node == None ):
+                return -1;
+            node = node[0].get( char );
+        if( node == None ):
+            return -1;
+        # entries are in traversal order, so the first long enough run wins.
+        for run, module in node[1]:
+            if( run >= minRun ):
+                return module;
+        return -1;
+
+
+class LONIFilenameTemplate:
+    """A LONI FILENAME (i.e. ${1:b}, -OutFile0, + and -), compiled once so it can be expanded for whole file lists.
+
+    """
+    # ${n} and ${n:f}, etc., as they are found...
+    findVars = re.compile(r'\$\{(?P<parent>\d+)\:?(?P<filepart>[fdrbe]?)\}', re.IGNORECASE );
+    findOutFiles = re.compile( r'\-OutFile(?P<parentIndex>\d+)' );
+    # ...and as they are replaced.
+    replaceVars = re.compile(r'\$\{(?P<parent>\d+)(?:\:(?P<filepart>[fdrbe]))?\}' );
+    replaceVarsAndOutFiles = re.compile(r'\$\{(?P<parent>\d+)(?:\:(?P<filepart>[fdrbe]))?\}|\-OutFile(?P<parentIndex>\d+)' );
+
+    # The ways LONI splits a path into a directory, base and extension.
+    parseWholePath = re.compile(r'^(?P<d>\S*(?=[\/\\]))[\\\/]?(?P<b>[^\s\\\/]+(?=[\.|\s*$]))\.?(?P<e>(?<=\.)\S*)\s*$' );
+    parseFileNamePath = re.compile(r'^[\\\/]?(?P<b>[^\s\.\\\/]+(?=[\.|\s*$]))\.?(?P<e>(?<=\.)\S*)\s*$' );
+    parseRootPath = re.compile(r'^(?P<d>\S*(?=[\/\\]))[\\\/]?(?P<b>[^\s\\\/]+(?=[\.|\s*$]))\.?\s*$' );
+    parseDirPath = re.compile(r'^(?P<d>\S*(?=[\/\\]))[\\\/]?\s*$' );
+    parseExtentionPath = re.compile(r'^(?P<e>(?<=\.)\S*)\s*$' );
+    parseBasePath = re.compile(r'^[\\\/]?(?P<b>[^\s\\\/]+(?=[\.|\s*$]))\.?\s*$' );
+    pathParsers = ( parseWholePath, parseFileNamePath, parseRootPath, parseBasePath, parseDirPath, parseExtentionPath );
+
+    # Concatenating (+) and subtracting (-) strings.
+    individuallyParse = re.compile( r'(.*?)\s+(\+|\-)\s+(.*)' )
+    # individuallyParse matches exactly when this does, but this is much quicker to rule it out.
+    hasOperator = re.compile( r'\s[\+\-]\s' )
+    getNextPart = re.compile( r'^\s*(\S+)(\s*.*)$' )
+    removeSpecialChars = re.compile( r'(?P<n>\\|\{|\}|\(|\)|\+|\?|\||\^|\.|\$)' )
+
+    # Caches shared by every template.
+    templates = {};
+    splitPaths = {};
+    stripPatterns = {};
+
+    def compile( filename, isInput ):
+        """Return the (cached) template for a FILENAME.
+
+        Arguments:
+        filename -- The FILENAME parameter of a LONI File.
+        isInput -- True for InFiles, whose -OutFile references are also replaced.
+
+        """
+        key = ( filename, isInput );
+        if( not LONIFilenameTemplate.templates.has_key( key ) ):
+            LONIFilenameTemplate.templates[key] = LONIFilenameTemplate( filename, isInput );
+        return LONIFilenameTemplate.templates[key];
+    compile = staticmethod( compile );
+
+    def __init__( self, filename, isInput ):
+        """Compile a FILENAME.
+
+        Arguments:
+        filename -- The FILENAME parameter of a LONI File.
+        isInput -- True for InFiles, whose -OutFile references are also replaced.
+
+        Variables:
+        variables -- (parent index, file part) for each ${n:p} in the FILENAME.
+        outFiles -- The index of each -OutFile<n> in the FILENAME.
+        segments -- The FILENAME split into ('text', text), ('var', index, part, text) and ('out', index, text).
+
+        """
+        self.filename = filename;
+        self.variables = [ (int(eachVar.group('parent')), eachVar.group('filepart')) for eachVar in self.findVars.finditer( filename ) ];
+        if( isInput ):
+            self.outFiles = [ int(eachOutFile.group('parentIndex')) for eachOutFile in self.findOutFiles.finditer( filename ) ];
+            replace = self.replaceVarsAndOutFiles;
+        else:
+            self.outFiles = [];
+            replace = self.replaceVars;
+        self.segments = [];
+        start = 0;
+        for eachPart in replace.finditer( filename ):
+            if( eachPart.start() > start ):
+                self.segments.append( ('text', filename[start:eachPart.start()]) );
+            if( eachPart.group('parent') != None ):
+                self.segments.append( ('var', int(eachPart.group('parent')), eachPart.group('filepart') or '', eachPart.group(0)) );
+            else:
+                self.segments.append( ('out', int(eachPart.group('parentIndex')), eachPart.group(0)) );
+            start = eachPart.end();
+        if( start < len(filename) ):
+            self.segments.append( ('text', filename[start:]) );
+
+    def splitPath( path ):
+        """Return a (cached) dict of the directory (d), base (b) and extension (e) of a path, or None.
+
+        Arguments:
+        path -- The path to split.
+
+        """
+        if( not LONIFilenameTemplate.splitPaths.has_key( path ) ):
+            # paths are usually split again straight away (i.e. for ${1:b}${1:e}), so
+            # there is no need to keep every path of every file list.
+            if( len(LONIFilenameTemplate.splitPaths) >= 4096 ):
+                LONIFilenameTemplate.splitPaths.clear();
+            curPath = None;
+            for parser in LONIFilenameTemplate.pathParsers:
+                curPath = parser.search( path );
+                if( curPath != None ):
+                    curPath = curPath.groupdict();
+                    for part in ('d', 'b', 'e'):
+                        curPath.setdefault( part, '' );
+                    break;
+            if( curPath == None ):
+                print "Error looking for variable that isn't there...", path
+            LONIFilenameTemplate.splitPaths[path] = curPath;
+        return LONIFilenameTemplate.splitPaths[path];
+    splitPath = staticmethod( splitPath );
+
+    def pathPart( path, filepart ):
+        """Return the part of a path that ${n:filepart} refers to, or None.
+
+        Arguments:
+        path -- The path of the parent file.
+        filepart -- One of f, d, r, b, e, or '' for the whole path.
+
+        """
+        if( filepart == '' ):
+            return path;
+        curPath = LONIFilenameTemplate.splitPath( path );
+        if( curPath == None ):
+            return None;
+        if( filepart == 'b' ):
+            return curPath['b'];
+        elif( filepart == 'f' ):
+            return ''.join((curPath['b'],'.', curPath['e']))
+        elif( filepart == 'd' ):
+            return ''.join([curPath['d'], '/']);
+        elif( filepart == 'r' ):
+            return ''.join((curPath['d'],'/', curPath['b']))
+        elif( filepart == 'e' ):
+            return ''.join(['.', curPath['e']]);
+    pathPart = staticmethod( pathPart );
+
+    def combineStrings( fileName ):
+        """Correctly concatanate and subtract from a string.
+
+        Arguments:
+        fileName -- The string to parse.
+
+        """
+        if( LONIFilenameTemplate.hasOperator.search( fileName ) == None ):
+            return fileName;
+        eachPart = LONIFilenameTemplate.individuallyParse.search( fileName );
+        while( eachPart != None ):
+            if( eachPart.group(2) == '+' ):
+                fileName = ''.join([eachPart.group(1), eachPart.group(3)]);
+            else:
+                nextPart = LONIFilenameTemplate.getNextPart.search( eachPart.group(3) )
+                stripEnd = LONIFilenameTemplate.stripPatterns.get( nextPart.group(1) );
+                if( stripEnd == None ):
+                    stripEnd = re.compile( LONIFilenameTemplate.removeSpecialChars.sub( '\\\\\g<n>', nextPart.group(1) ) );
+                    LONIFilenameTemplate.stripPatterns[nextPart.group(1)] = stripEnd;
+                fileName = ''.join([stripEnd.sub( '', eachPart.group(1) ), nextPart.group(2)]);
+            eachPart = LONIFilenameTemplate.individuallyParse.search( fileName );
+        return fileName;
+    combineStrings = staticmethod( combineStrings );
+
+    def expand( self, numFiles, varLists, outFileLists ):
+        """Expand the template into a list of file names, which are only worked out as they are read.
+
+        Arguments:
+        numFiles -- The number of file names to make.
+        varLists -- A dict from each ${n} index to the file list it refers to.
+        outFileLists -- A dict from each -OutFile<n> index to the file list it refers to.
+
+        Note:
+        A parent list with one file is used for every file name; where a parent list is too
+        short, or a path can't be split, the reference is left as it is.
+
+        """
+        if( [ segment for segment in self.segments if segment[0] != 'text' ] == [] ):
+            return BroadcastFileList( self.combineStrings( self.filename ), numFiles );
+        return TemplateFileList( self, numFiles, varLists, outFileLists );
+
+    def expandOne( self, fileNum, varLists, outFileLists ):
+        """Expand the template into the fileNum'th file name (see expand).
+
+        """
+        parts = [];
+        for segment in self.segments:
+            value = None;
+            if( segment[0] == 'text' ):
+                value = segment[1];
+            else:
+                if( segment[0] == 'var' ):
+                    parentList = varLists.get( segment[1] );
+                else:
+                    parentList = outFileLists.get( segment[1] );
+                if( parentList != None ):
+                    if( len(parentList) == 1 ):
+                        parentPath = parentList[0];
+                    elif( fileNum < len(parentList) ):
+                        parentPath = parentList[fileNum];
+                    else:
+                        parentPath = None;
+                    if( parentPath != None ):
+                        if( segment[0] == 'var' ):
+                            value = self.pathPart( parentPath, segment[2] );
+                        else:
+                            value = parentPath;
+                if( value == None ):
+                    value = segment[-1];
+            parts.append( value );
+        return self.combineStrings( ''.join( parts ) );
+
+
 class LONIXML(LONIModule):
     """A LONI XML Pipeline.
 
@@ -217,136 +844,124 @@ class LONIXML(LONIModule):
 
         Variables:
         numExecutions -- The nubmer of times a module will execute; starts at zero.
+        moduleIndex -- The LONIModuleIndex shared by every Module in the pipeline; set by traverse.
+        cache -- A TranslationCache to read .list files through, or None.
 
         """
         LONIModule.__init__(self, 0)
         self.numExecutions = 0;
-    def setNodeAttributes( self, node, parentName ):
+        self.moduleIndex = None;
+        self.cache = None;
+    def setNodeAttributes( self, attributes, parentName ):
         """Set the attributes of an XML node to the Module.
 
         Arguments:
-        node -- The XML Node containing the target attributes.
+        attributes -- A dict of the XML Node's attributes.
         parentName -- The name of the Parent LONI Module.
         
         """
-        attrNum = 0;
-        while( attrNum < node.attributes.length ):
-            if( node.attributes.item(attrNum).nodeName.upper() == 'NAME' ):
-                node.name = ''.join( [parentName, "/", node.attributes.item(attrNum).nodeValue ])
-                self.set_attribute( node.attributes.item(attrNum).nodeName.upper(), node.name )
+        for attrName, attrValue in attributes.iteritems():
+            if( attrName.upper() == 'NAME' ):
+                self.set_attribute( attrName.upper(), ''.join( [parentName, "/", attrValue ]) )
             else:
-                self.set_attribute( node.attributes.item(attrNum).nodeName.upper(), node.attributes.item(attrNum).nodeValue )
-            attrNum = attrNum+1;
-    def traverse( self, topnode, parentModule):
-        """Traverse the current LONI Module and explore its children, 
-           converting each XML Node into a LONI Module or LONI File.
+                self.set_attribute( attrName.upper(), attrValue )
+    def traverse( self, xmlFile ):
+        """Read a LONI XML Pipeline, converting each XML Node into a LONI Module or LONI File.
+
+        Description:
+        The XML is read incrementally, and each XML Node is discarded as soon as
+        it has been converted, so the whole document is never held in memory.
+        This Module becomes the top (pipeline) Module.
 
         Arguments:
-        topnode -- The top XML Node to be traversed.
-        parentModule -- The parent LONI Module that this Module depends on.
+        xmlFile -- The filename (or file object) of the LONI XML Pipeline.
 
         """
-        if( parentModule == '' ):   
-            parentName = '';
-        else:
-            parentName = parentModule.PARAMS['NAME'];
-        self.setNodeAttributes( topnode, parentName );
-        i = 0;
-        while( len(topnode.childNodes) > i):
-            node = topnode.childNodes[i];
-            if( node.nodeName == "Module" ):
-                newModule = LONIXML();
-                newModule.traverse( node, self );
-                self.add_child( newModule );
-            elif node.nodeName == 'InFile':
-                self.traverseInFile(node, self.PARAMS['NAME'])
-            elif node.nodeName == 'OutFile':
-                self.traverseOutFile(node, self.PARAMS['NAME'])
-            elif node.nodeName != "#text":
-                "THERE MAY BE AN ERROR IN YOUR LONI XML FILE..."
-                "\tLONI XML does not account for", node.nodeName
-            i = i+1;
-
-    def traverseInFile(self, node, parentName):
+        self.moduleIndex = LONIModuleIndex();
+        # one entry per open XML Node: the LONI Module it created, or None
+        # for Nodes whose children are not part of the pipeline.
+        nodes = [];
+        modules = [];
+        for event, node in ElementTree.iterparse( xmlFile, events=('start', 'end') ):
+            if( event == 'start' ):
+                newModule = None;
+                if( nodes == [] ):
+                    newModule = self;
+                    self.setNodeAttributes( node.attrib, '' );
+                    self.moduleIndex.add( self );
+                elif( modules[-1] != None ):
+                    parentModule = modules[-1];
+                    if( node.tag == "Module" ):
+                        newModule = LONIXML();
+                        newModule.moduleIndex = self.moduleIndex;
+                        newModule.setNodeAttributes( node.attrib, parentModule.PARAMS['NAME'] );
+                        self.moduleIndex.add( newModule );
+                    elif( node.tag == 'InFile' ):
+                        parentModule.traverseInFile( node.attrib, parentModule.PARAMS['NAME'] )
+                    elif( node.tag == 'OutFile' ):
+                        parentModule.traverseOutFile( node.attrib, parentModule.PARAMS['NAME'] )
+                nodes.append( node );
+                modules.append( newModule );
+            else:
+                nodes.pop();
+                finishedModule = modules.pop();
+                if( (finishedModule != None) & (modules != []) ):
+                    modules[-1].add_child( finishedModule );
+                # everything in this Node has been converted, so let it go.
+                node.clear();
+                if( nodes != [] ):
+                    del nodes[-1][:];
+
+    def traverseInFile(self, attributes, parentName):
         """Converts an InFile XML Node into a LONI File
 
         Arguments:
-        node -- The XML Node to be converted.
+        attributes -- A dict of the XML Node's attributes.
         parentName -- The name of the parent LONI Module.
 
         """
         item = LONIFile('INFILE')
         item.add_input(  self );
-        attrNum=0;
-        while( attrNum < node.attributes.length ):
-            item.set_attribute( node.attributes.item(attrNum).nodeName.upper(), node.attributes.item(attrNum).nodeValue )
-            attrNum = attrNum+1;        
+        for attrName, attrValue in attributes.iteritems():
+            item.set_attribute( attrName.upper(), attrValue )
         self.add_infile( item )
 
-    def traverseOutFile(self, node, parentName):
+    def traverseOutFile(self, attributes, parentName):
         """Converts an OutFile XML Node into a LONI File
 
         Arguments:
-        node -- The XML Node to be converted.
+        attributes -- A dict of the XML Node's attributes.
         parentName -- The name of the parent LONI Module.
 
         """
         item = LONIFile('OUTFILE')
         item.add_output( self );
-        attrNum=0;
-        while( attrNum < node.attributes.length ):
-            item.set_attribute( node.attributes.item(attrNum).nodeName.upper(), node.attributes.item(attrNum).nodeValue )
-            attrNum = attrNum+1;
+        for attrName, attrValue in attributes.iteritems():
+            item.set_attribute( attrName.upper(), attrValue )
         self.add_outfile( item )
 
     def getModuleByName(self, name):
-        """Traverse the each Module and it's children and return the Module named 'name'.
+        """Return the Module in this pipeline named 'name', or -1 if there isn't one.
 
         Arguments:
         name -- The name of the Module to return.
 
         """
-        returnValue=-1;
-        if( name == self.PARAMS['NAME'] ):
-            if( self.PARAMS['NAME'] != name ):
-                self.fixReadFromVar( myName, name ); 
-            name = self.PARAMS['NAME'];
-            returnValue = self;
-            return returnValue;
-        if( hasattr( self, 'CHILD' ) ):
-            i=0;
-            while( i < len(self.CHILD) ):
-                found = self.CHILD[i].getModuleByName( name )
-                if( found != -1 ):
-                    returnValue = found;
-                    return returnValue;
-                i=i+1;
-        return returnValue;
+        return self.moduleIndex.getByName( name );
 
     def getModuleByPartialReadFromName( self, curFile ):
-        """Traverse each Module and it's children and return the Module that the current file uses as input.
+        """Return the Module in this pipeline that the current file uses as input, or -1 if there isn't one.
 
         Variables:
         curFile -- The current file whos input Module should be identified.
 
+        Note:
+        The file's READFROM is replaced by the full name of the Module that was found.
+
         """
-        returnValue=-1;
-        name = curFile.PARAMS['READFROM']
-        if( name != '' ):
-            myName = re.sub(r'(?P<badChar>[\.\*\+\?\\\(\)\[\]\{\}\|\$\^])', r'\\\g<badChar>', name );
-            searchString = '.*?'+myName+'+\s*$'
-            if( re.match( searchString, self.PARAMS['NAME'] ) ):
-                curFile.PARAMS['READFROM'] = self.PARAMS['NAME']; 
-                returnValue = self;
-                return returnValue;
-            if( hasattr( self, 'CHILD' ) ):
-                i=0;
-                while( i < len(self.CHILD) ):
-                    found = self.CHILD[i].getModuleByPartialReadFromName( curFile )
-                    if( found != -1 ):
-                        returnValue = found;
-                        return returnValue;
-                    i=i+1;
+        returnValue = self.moduleIndex.getByPartialName( curFile.PARAMS['READFROM'] );
+        if( returnValue != -1 ):
+            curFile.PARAMS['READFROM'] = returnValue.PARAMS['NAME'];
         return returnValue;
 
     def completeInFiles(self, topModule):
@@ -372,7 +987,7 @@ class LONIXML(LONIModule):
                     curFile = self.INFILE[inFileNum]
                     if( isList.search( curFile.PARAMS['FILENAME'] ) != None ):
                         if( curFile.PARAMS['GROUPED'] != 'true' ):
-                            curFile.fileList = ReadListOfFiles( curFile.PARAMS['FILENAME'] );
+                            curFile.fileList = topModule.readListOfFiles( curFile.PARAMS['FILENAME'] );
                             curFile.PARENT_INPUT[0].numExecutions = len(curFile.fileList)
                             needsParsing = 0;
                         else:
@@ -402,7 +1017,7 @@ class LONIXML(LONIModule):
                 if( self.OUTFILE[outFileNum] != '' ):
                     curFile = self.OUTFILE[outFileNum]
                     if( isList.search( curFile.PARAMS['FILENAME'] ) != None ):
-                        curFile.fileList = ReadListOfFiles(curFile.PARAMS['FILENAME']);
+                        curFile.fileList = topModule.readListOfFiles( curFile.PARAMS['FILENAME'] );
                         self.numExecutions = len(curFile.fileList)
                         needsParsing = 0;
                     if( curFile.fileList == [] ):
@@ -421,227 +1036,189 @@ class LONIXML(LONIModule):
                 self.CHILD[childNum].completeInFiles(topModule)
                 childNum = childNum+1;
 
-    def parseLONIRegEx( self,curFile, parentFile, eachVar ):
-        """Parse LONI's filenaming scheme.
+    def fingerprint( self ):
+        """Return a hash of everything this Module's Condor Jobs are made from: its XML attributes,
+           its files' XML attributes, where their file lists come from (see LONIFileList.fingerprintOf)
+           and the number of executions.  No file names are worked out.
+
+        """
+        digest = hashlib.sha1();
+        for name, value in sorted( self.PARAMS.items() ):
+            digest.update( ''.join([ name, '=', value, '\0' ]) );
+        digest.update( str(self.numExecutions)+'\0' );
+        for curFile in self.INFILE + self.OUTFILE:
+            if( curFile == '' ):
+                digest.update( '\1' );
+                continue;
+            digest.update( str(curFile.isInput)+'\1' );
+            for name, value in sorted( curFile.PARAMS.items() ):
+                digest.update( ''.join([ name, '=', value, '\0' ]) );
+            digest.update( LONIFileList.fingerprintOf( curFile.fileList )+'\1' );
+        return digest.hexdigest();
+
+    def readListOfFiles( self, filename ):
+        """Return the files in a .list file, as a ListFileList, or a new empty list if there are none.
 
         Arguments:
-        parentFile -- The File that this file reads from and depends on.
-        eachVar -- The variable to parse, i.e. ${1:b},  etc.
+        filename -- The .list file.
 
         """
-        parseWholePath = re.compile(r'^(?P<d>\S*(?=[\/\\]))[\\\/]?(?P<b>[^\s\\\/]+(?=[\.|\s*$]))\.?(?P<e>(?<=\.)\S*)\s*$' );
-        parseFileNamePath = re.compile(r'^[\\\/]?(?P<b>[^\s\.\\\/]+(?=[\.|\s*$]))\.?(?P<e>(?<=\.)\S*)\s*$' );
-        parseRootPath = re.compile(r'^(?P<d>\S*(?=[\/\\]))[\\\/]?(?P<b>[^\s\\\/]+(?=[\.|\s*$]))\.?\s*$' );
-        parseDirPath = re.compile(r'^(?P<d>\S*(?=[\/\\]))[\\\/]?\s*$' );
-        parseExtentionPath = re.compile(r'^(?P<e>(?<=\.)\S*)\s*$' );
-        parseBasePath = re.compile(r'^[\\\/]?(?P<b>[^\s\\\/]+(?=[\.|\s*$]))\.?\s*$' );
-        fileNum = 0;
-        while( fileNum < len(parentFile.fileList) ):
-            thisMatch = ''.join( ['\$\{', eachVar.group('parent') ])
-            # Insert the replacement text... rather than ${1:b} etc.
-            curPath = parseWholePath.search( parentFile.fileList[fileNum] )
-            if( curPath == None ):
-                curPath = parseFileNamePath.search( parentFile.fileList[fileNum] );
-                if( curPath == None ):
-                    curPath = parseRootPath.search( parentFile.fileList[fileNum] );
-                    if( curPath == None ):
-                        curPath = parseBasePath.search( parentFile.fileList[fileNum] );
-                        if( curPath == None ):
-                            curPath = parseDirPath.search( parentFile.fileList[fileNum] );
-                            if( curPath == None ):
-                                curPath = parseExtentionPath.search( parentFile.fileList[fileNum] );
-                                if( curPath == None ):
-                                    print "Error looking for variable that isn't there...", parentFile.fileList[fileNum]
-                                else: 
-                                    curPath = curPath.groupdict() ;
-                                    curPath['b']='';
-                                    curPath['d']='';
-                            else: 
-                                curPath = curPath.groupdict() ;
-                                curPath['b']='';
-                                curPath['e']='';
-                        else: 
-                            curPath = curPath.groupdict() ;
-                            curPath['d']='';
-                            curPath['e']='';
-                    else: 
-                        curPath = curPath.groupdict() ;
-                        curPath['e']='';
-                else: 
-                    curPath = curPath.groupdict() ;
-                    curPath['d']='';
-            else: 
-                curPath = curPath.groupdict() ;
-
-            if( eachVar.group('filepart') == 'b' ):
-                curPath = curPath['b'];
-                thisMatch = ''.join([thisMatch, '\:', eachVar.group('filepart')])
-            elif( eachVar.group('filepart') == 'f' ):
-                curPath = ''.join((curPath['b'],'.', curPath['e']))
-                thisMatch = ''.join([thisMatch, '\:', eachVar.group('filepart')])
-            elif( eachVar.group('filepart') == 'd' ):
-                curPath = ''.join([curPath['d'], '/']);
-                thisMatch = ''.join([thisMatch, '\:', eachVar.group('filepart')])
-            elif( eachVar.group('filepart') == 'r' ):
-                curPath = ''.join((curPath['d'],'/', curPath['b']))
-                thisMatch = ''.join([thisMatch, '\:', eachVar.group('filepart')])
-            elif( eachVar.group('filepart') == 'e' ):
-                curPath = ''.join(['.', curPath['e']]);
-                thisMatch = ''.join([thisMatch, '\:', eachVar.group('filepart')])
-            else:
-                curPath = parentFile.fileList[fileNum];
-            thisMatch = ''.join([thisMatch, '\}'])
-            curFile.fileList[fileNum] = re.sub( thisMatch, curPath, curFile.fileList[fileNum] );
-            del(thisMatch);
-            del(curPath);
-            fileNum = fileNum+1;
-
-    def parseLONICombineStrings( self, curFile ):
-        """Correctly concatanate and subtract from strings.
-        
+        if( self.cache != None ):
+            files = self.cache.readListOfFiles( filename );
+        else:
+            files = ListFileList( filename );
+        if( len(files) == 0 ):
+            return [];
+        return files;
+
+    def getListFiles( self ):
+        """Return the .list files (read as ListFileLists) that this pipeline's file lists come from.
+
+        """
+        isList = re.compile( r'\.list$' );
+        listFiles = [];
+        for module in self.moduleIndex.modules:
+            for curFile in module.INFILE + module.OUTFILE:
+                if( (curFile != '') and (isList.search( curFile.PARAMS['FILENAME'] ) != None) ):
+                    if( (curFile.isInput == 0) or (curFile.PARAMS['GROUPED'] != 'true') ):
+                        listFiles.append( curFile.PARAMS['FILENAME'] );
+        return listFiles;
+
+    def broadcastFileList( self, curFile, parentFile ):
+        """Make a single-file LONI File as long as the LONI File it depends on.
+
         Arguments:
-        curFile -- The LONI File to parse.
-
-        """
-        individuallyParse = re.compile( r'(.*?)\s+(\+|\-)\s+(.*)' )
-        getNextPart = re.compile( r'^\s*(\S+)(\s*.*)$' )
-        removeSpecialChars = re.compile( r'(?P<n>\\|\{|\}|\(|\)|\+|\?|\||\^|\.|\$)' )
-
-        fileNum = 0;
-        while( fileNum < len(curFile.fileList) ):
-            eachPart = individuallyParse.search( curFile.fileList[fileNum] );
-            while( eachPart != None ):
-                wantedPath = '';
-                if( eachPart.group(2) == '+' ):
-                    wantedPath = ''.join([eachPart.group(1), eachPart.group(3)]);
-                elif( eachPart.group(2) == '-' ):
-                    nextPart = getNextPart.search( eachPart.group(3) )
-                    replacedSpecialChars = removeSpecialChars.sub( '\\\\\g<n>', nextPart.group(1) )
-                    stripEnd = re.compile( ''.join([ replacedSpecialChars ]) )
-                    wantedPath = stripEnd.sub( '', eachPart.group(1) );
-                    wantedPath = ''.join([wantedPath, nextPart.group(2)]);
-                else:
-                    print "Maybe I shouldn't be here... \t<-----\n"
-                    wantedPath = curFile.fileList[fileNum];
-                curFile.fileList[fileNum] = wantedPath;
-                eachPart = individuallyParse.search( curFile.fileList[fileNum] );
-            fileNum = fileNum+1;
+        curFile -- The LONI File to lengthen.
+        parentFile -- The LONI File it depends on.
+
+        Returns:
+        1 if curFile was lengthened, 0 if not.
+
+        """
+        if( (len(curFile.fileList) == 1) & (len(parentFile.fileList) > 1) ):
+            curFile.fileList = BroadcastFileList( curFile.fileList[0], len(parentFile.fileList) );
+            return 1;
+        if( (len(curFile.fileList) != len(parentFile.fileList)) & (len(parentFile.fileList) != 1) ):
+            print "Error:", curFile.PARAMS['FILENAME'], "has", len(curFile.fileList), "files, but it depends on", len(parentFile.fileList), "files."
+        return 0;
+
+    def findParentFiles( self, curFile, topModule ):
+        """Return the LONI Files that one of this Module's files refers to in its FILENAME.
+
+        Arguments:
+        curFile -- The LONI File (an INFILE or OUTFILE of this Module).
+        topModule -- The top module of the pipeline.
+
+        Returns:
+        A list of ('var', index, parentFile) for each ${n}, and ('out', index, parentFile) for each -OutFile<n>.
+
+        """
+        template = curFile.getFilenameTemplate();
+        parentFiles = [];
+        if( curFile.isInput == 1 ):
+            # ${n} refers to the n'th input of the Module curFile reads from...
+            parentModule = -1;
+            for parentIndex, filepart in template.variables:
+                if( parentModule == -1 ):
+                    parentModule = topModule.getModuleByName( curFile.PARAMS['READFROM'] )
+                    if( parentModule == -1 ):
+                        parentModule = topModule.getModuleByPartialReadFromName( curFile )
+                        if( parentModule == -1 ):
+                            parentModule = self;
+                parentFiles.append( ('var', parentIndex, parentModule.INFILE[parentIndex]) );
+            # ...and -OutFile<n> to its n'th output.
+            parentModule = -1;
+            for parentIndex in template.outFiles:
+                if( parentModule == -1 ):
+                    parentModule = topModule.getModuleByName(''.join(['/', curFile.PARAMS['READFROM']]))
+                    if( parentModule == -1 ):
+                        parentModule = topModule.getModuleByPartialReadFromName( curFile )
+                        if( parentModule == -1 ):
+                            raise LONIPipelineError( ''.join([ "The module \"", curFile.PARAMS['READFROM'], "\" does not exist.\n",
+                                "    This may be due to a pipeline within a pipeline that is not specified as such in the xml file..." ]) );
+                parentFiles.append( ('out', parentIndex, parentModule.OUTFILE[parentIndex]) );
+        else:
+            # an output's ${n} refers to the n'th input of its own Module.
+            for parentIndex, filepart in template.variables:
+                parentFiles.append( ('var', parentIndex, self.INFILE[parentIndex]) );
+        return parentFiles;
 
     def completeParse( self, topModule ):
         """Parse a pipeline and make sure that all filenames are filled in.
 
+        Description:
+        Every file that needs parsing is expanded exactly once, after the files it
+        refers to (i.e. in topological order), so the whole pipeline is parsed in
+        time linear in its size.  A file that (indirectly) refers to itself is
+        reported, along with the Modules involved.
+
         Arguments:
         topModule -- The top module to be parsed.
 
 
         """
-        checkForVar = re.compile(r'\$\{(?P<parent>\d+)\:?(?P<filepart>[fdrbe]?)\}', re.IGNORECASE );
-    
-        if( hasattr( self, 'INFILE' ) ):
-            inFileNum = 0;
-            while( inFileNum < len(self.INFILE) ):
-                if( self.INFILE[inFileNum] != '' ):
-                    curFile = self.INFILE[inFileNum];
-                    if( curFile.needsParsing == 1 ):
-                        for eachVar in checkForVar.finditer( curFile.PARAMS['FILENAME'] ) :
-                            parentModule = topModule.getModuleByName( curFile.PARAMS['READFROM'] )
-                            if( parentModule == -1 ):
-                                parentModule = topModule.getModuleByPartialReadFromName( curFile )
-                                if( parentModule == -1 ):
-                                    parentModule = self;
-                            parentFile = parentModule.INFILE[int(eachVar.group('parent'))] ;
-                            if( parentFile.needsParsing == 1 ):
-                                parentFile.PARENT_INPUT[0].completeParse( topModule );
-                            if( len(curFile.fileList) != len(parentFile.fileList) ):
-                                if( len(curFile.fileList) == 1 ):
-                                    i=1;
-                                    while( i < len(parentFile.fileList) ):
-                                        curFile.fileList.append( curFile.fileList[0] );
-                                        i=i+1;
-                                    curFile.PARENT_INPUT[0].numExecutions = len(curFile.fileList)
-                                elif( len(parentFile.fileList) == 1 ):    
-                                    i=1;
-                                    # print "Make curFile.fileList as large as parentFile.fileList"
-                                    # THE ABOVE PRINT STATEMENT IS WRONG. I SHOULD NOT.
-                            self.parseLONIRegEx( curFile, parentFile, eachVar )
-                            del(parentFile);
-                            del(parentModule);
-                        findOutFile = re.compile( r'\-OutFile(?P<parentIndex>\d+)' );
-                        for eachOutFile in findOutFile.finditer( curFile.PARAMS['FILENAME'] ):
-                            parentModule = topModule.getModuleByName(''.join(['/', curFile.PARAMS['READFROM']]))
-                            if( parentModule == -1 ):
-                                parentModule = topModule.getModuleByPartialReadFromName( curFile )
-                                if( parentModule == -1 ):
-                                    print "\nERROR:"
-                                    print "    The module \"", curFile.PARAMS['READFROM'], "\" does not exist."
-                                    print "    This may be due to a pipeline within a pipeline that is not specified as such in the xml file..."
-                                    print "    Drew should fix this sometime.\n"
-                                    sys.exit()
-                            parentFile = parentModule.OUTFILE[int(eachOutFile.group('parentIndex'))];
-
-                            if( parentFile.needsParsing == 1 ):
-                                parentModule.completeParse( topModule ); 
-                            if( len(curFile.fileList) != len(parentFile.fileList) ):
-                                if( len(curFile.fileList) == 1 ):
-                                    i=1;
-                                    while( i < len(parentFile.fileList) ):
-                                        curFile.fileList.append( curFile.fileList[0] );
-                                        i=i+1;
-                                    curFile.PARENT_INPUT[0].numExecutions = len(curFile.fileList)
-                                elif( len(parentFile.fileList) == 1 ):    
-                                    print "Make curFile.fileList as large as parentFile.fileList"
-                                    # THE ABOVE PRINT STATEMENT IS WRONG. I SHOULD NOT.
-                            fileNum = 0;
-                            while( fileNum < len(parentFile.fileList) ):
-                                thisMatch = ''.join(['-OutFile',eachOutFile.group('parentIndex')])
-                                curPath = parentFile.fileList[fileNum];
-                                curFile.fileList[fileNum] = re.sub( thisMatch, curPath, curFile.fileList[fileNum] )
-                                del(curPath)
-                                del(thisMatch)
-                                fileNum = fileNum+1;
-                            del(parentFile)
-                            del(parentModule)
-                        self.parseLONICombineStrings( curFile )
-                        curFile.needsParsing = 0;
-                    del(curFile);
-                inFileNum = inFileNum+1;
-        if( hasattr( self, 'OUTFILE' ) ):
-            outFileNum = 0;
-            while( outFileNum < len(self.OUTFILE) ):
-                if( self.OUTFILE[outFileNum] != '' ):
-                    curFile = self.OUTFILE[outFileNum];
-                    if( curFile.needsParsing == 1 ):
-                        for eachVar in checkForVar.finditer( curFile.PARAMS['FILENAME'] ) :
-                            parentFile = self.INFILE[int(eachVar.group('parent'))] ;
-                            if( parentFile.needsParsing == 1 ):
-                                print "\t\t---- POTENTIAL ERROR ----\t\t";
-                                parentFile.PARENT_INPUT[0].completeParse( topModule );
-                            if( len(curFile.fileList) != len(parentFile.fileList) ):
-                                if( len(curFile.fileList) == 1 ):
-                                    i=1;
-                                    while( i < len(parentFile.fileList) ):
-                                        curFile.fileList.append( curFile.fileList[0] );
-                                        i=i+1;
-                                elif( len(parentFile.fileList) == 1 ):    
-                                    print "Make curFile.fileList as large as parentFile.fileList"
-                                    # THE ABOVE PRINT STATEMENT IS WRONG. I SHOULD NOT.
-                            self.parseLONIRegEx( curFile, parentFile, eachVar )
-                            del(parentFile);
-                        self.parseLONICombineStrings( curFile )
-                        curFile.needsParsing = 0;
-                    del(curFile)
-                outFileNum = outFileNum+1;
-        if( hasattr( self, 'CHILD' ) ):
-            childNum = 0;
-            while( childNum < len(self.CHILD) ):
-                self.CHILD[childNum].completeParse( topModule );
-                childNum = childNum+1;
+        # every file that needs parsing, with its Module, in traversal order.
+        toParse = [];
+        for module in self.moduleIndex.modules:
+            for curFile in module.INFILE + module.OUTFILE:
+                if( (curFile != '') and (curFile.needsParsing == 1) ):
+                    toParse.append( (module, curFile) );
+        parentFiles = {};
+        for module, curFile in toParse:
+            parentFiles[id(curFile)] = module.findParentFiles( curFile, topModule );
+
+        # depth first search, so that each file comes after its parents.
+        order = [];
+        state = {};
+        for start in toParse:
+            if( state.has_key( id(start[1]) ) ):
+                continue;
+            state[id(start[1])] = 'visiting';
+            stack = [ (start, iter(parentFiles[id(start[1])])) ];
+            while( stack != [] ):
+                (module, curFile), parents = stack[-1];
+                for kind, parentIndex, parentFile in parents:
+                    if( (parentFile.needsParsing != 1) or (state.get( id(parentFile) ) == 'done') ):
+                        continue;
+                    if( state.get( id(parentFile) ) == 'visiting' ):
+                        cycle = [ entry[0] for entry, unused in stack ];
+                        cycle = cycle[ [ id(entry[1]) for entry, unused in stack ].index( id(parentFile) ): ];
+                        names = [];
+                        for cycleModule in cycle + cycle[:1]:
+                            if( (names == []) or (names[-1] != cycleModule.PARAMS['NAME']) ):
+                                names.append( cycleModule.PARAMS['NAME'] );
+                        raise LONIPipelineError( "These modules' files refer to each other in a loop, so they can not be parsed:\n    "+" -> ".join( names ) );
+                    parentModule = parentFile.PARENT_INPUT[0] if( parentFile.isInput == 1 ) else parentFile.PARENT_OUTPUT[0];
+                    state[id(parentFile)] = 'visiting';
+                    stack.append( ((parentModule, parentFile), iter(parentFiles[id(parentFile)])) );
+                    break;
+                else:
+                    stack.pop();
+                    state[id(curFile)] = 'done';
+                    order.append( (module, curFile) );
+
+        for module, curFile in order:
+            varLists = {};
+            outFileLists = {};
+            for kind, parentIndex, parentFile in parentFiles[id(curFile)]:
+                if( module.broadcastFileList( curFile, parentFile ) & (curFile.isInput == 1) ):
+                    curFile.PARENT_INPUT[0].numExecutions = len(curFile.fileList)
+                if( kind == 'var' ):
+                    varLists[parentIndex] = parentFile.fileList;
+                else:
+                    outFileLists[parentIndex] = parentFile.fileList;
+            curFile.fileList = curFile.getFilenameTemplate().expand( len(curFile.fileList), varLists, outFileLists );
+            curFile.needsParsing = 0;
 
 
 class CondorSubmitFile:
     """A Condor File that represents a LONI Module that can be submitted to Condor.
 
     """
+    # what a module that hasn't run before requests (MB, CPUs and KB).
+    defaultMemory = 1024;
+    defaultCpus = 1;
+    defaultDisk = 1048576;
     def __init__( self, dir, filename, curModule):
         """Create a new Condor Submit File and convert an existing LONI Parameter Module into 
             a Condor Submit File.
@@ -655,6 +1232,7 @@ class CondorSubmitFile:
 
         """
         self.parameters = {};
+        self.queue = "queue";
         self.dir = dir;
         self.filename = filename;
         self.description = ''.join(['No description provided for:', filename ]);
@@ -678,7 +1256,32 @@ class CondorSubmitFile:
             
         self.addParam( 'Executable', myExec.group('cmd') )
         self.addParam( 'Arguments', myArgs )
+        # the Arguments of a single execution, even once the file is clustered.
+        self.arguments = myArgs;
         
+    def requestResources( self, usage, headroom ):
+        """Request the memory, CPUs and disk the module needs, from what it used before.
+
+        Arguments:
+        usage -- The most (memory MB, CPUs, disk KB) an execution of the module used before,
+                 or None if it hasn't run; anything 0 wasn't reported, and gets the default.
+        headroom -- The fraction to add to the memory and disk that was used (i.e. 0.2 for 20% more).
+
+        """
+        memory, cpus, disk = usage or ( 0, 0.0, 0 );
+        if( memory > 0 ):
+            self.addParam( 'request_memory', str( int( math.ceil( memory*(1.0+headroom) ) ) ) );
+        else:
+            self.addParam( 'request_memory', str( self.defaultMemory ) );
+        if( cpus > 0 ):
+            self.addParam( 'request_cpus', str( max( 1, int( math.ceil( cpus-0.05 ) ) ) ) );
+        else:
+            self.addParam( 'request_cpus', str( self.defaultCpus ) );
+        if( disk > 0 ):
+            self.addParam( 'request_disk', str( int( math.ceil( disk*(1.0+headroom) ) ) ) );
+        else:
+            self.addParam( 'request_disk', str( self.defaultDisk ) );
+
     def addParam( self, paramName, param ):
         """Add a parameter to the Condor Submit File.
 
@@ -689,45 +1292,540 @@ class CondorSubmitFile:
         """
         self.parameters[paramName] = param;
 
-    def printSubmitFile( self ):
+    def printSubmitFile( self, manifest=None ):
         """Prints a the Submit File.
 
+        Arguments:
+        manifest -- A CondorManifest; if given, the file is only rewritten when it has changed.
+
         """
-        submitFile = open(''.join([self.dir, 'condorFiles/', self.filename, '.submit']), 'w' )
-        submitFile.write("################################\n");
-        submitFile.write(''.join(["#", self.filename, "\n"]));
-        submitFile.write(''.join([ "#    ", self.description, "\n"]));
-        submitFile.write("################################\n");
+        submitFile = ["################################\n"];
+        submitFile.append(''.join(["#", self.filename, "\n"]));
+        submitFile.append(''.join([ "#    ", self.description, "\n"]));
+        submitFile.append("################################\n");
         
         for paramName, param in self.parameters.iteritems(): 
-            submitFile.write( paramName+" = "+param+"\n" )
-        submitFile.write("queue");
+            submitFile.append( paramName+" = "+param+"\n" )
+        submitFile.append(self.queue);
+
+        writeCondorFile( ''.join([self.dir, 'condorFiles/', self.filename, '.submit']), ''.join( submitFile ), manifest );
+
+    def cluster( self, varNames, synopses, itemFile, numJobs ):
+        """Queue every execution of the module from this one Submit File.
+
+        Arguments:
+        varNames -- The variables each execution sets, i.e. the columns of itemFile.
+        synopses -- The synopsis (i.e. -i) for each variable, which is the same for every execution.
+        itemFile -- The file with one line of (comma separated) variable values per execution.
+        numJobs -- The number of executions.
+
+        """
+        myArgs = self.parameters['Arguments'];
+        for varName, synopsis in zip( varNames, synopses ):
+            myArgs = myArgs.replace( '$('+varName+')', synopsis+' $('+varName+')' );
+        self.addParam( 'Arguments', myArgs );
+        self.addParam( 'output', ''.join( [self.dir, "condorFiles/", self.filename, ".$(Process).output"]));
+        self.addParam( 'error', ''.join( [self.dir, "condorFiles/", self.filename, ".$(Process).error"]));
+        if( varNames == [] ):
+            self.queue = "queue "+str(numJobs);
+        else:
+            self.queue = "queue "+",".join( varNames )+" from "+itemFile;
+
+    def bundle( self, wrapper, tasksFile, numTasks, cpus ):
+        """Return a new Submit File whose Jobs each run a bundle of the module's executions.
+
+        Arguments:
+        wrapper -- The script that runs a bundle (see BUNDLE_WRAPPER).
+        tasksFile -- The file with one line per execution; each Job runs lines $(First) to $(Last).
+        numTasks -- The most executions in a bundle.
+        cpus -- How many executions of a bundle run at once, and so how many CPUs each Job requests.
 
-        submitFile.close();
+        """
+        bundled = copy.copy( self );
+        bundled.parameters = self.parameters.copy();
+        bundled.filename = self.filename+'__bundle';
+        bundled.description = ''.join(['Runs up to ', str(numTasks), ' executions of ', self.filename, ', ', str(cpus), ' at a time']);
+        bundled.queue = "queue";
+        bundled.addParam( 'Executable', wrapper );
+        bundled.addParam( 'Arguments', tasksFile+' $(First) $(Last) '+str(cpus) );
+        bundled.addParam( 'output', ''.join( [self.dir, "condorFiles/", bundled.filename, ".$(First).output"]));
+        bundled.addParam( 'error', ''.join( [self.dir, "condorFiles/", bundled.filename, ".$(First).error"]));
+        bundled.addParam( 'log', ''.join([self.dir, "condorFiles/", bundled.filename, ".log"]));
+        # each execution running at once needs its own memory, and each one leaves its files behind.
+        if( bundled.parameters.has_key( 'request_memory' ) ):
+            bundled.addParam( 'request_memory', str( int( bundled.parameters['request_memory'] )*cpus ) );
+        if( bundled.parameters.has_key( 'request_disk' ) ):
+            bundled.addParam( 'request_disk', str( int( bundled.parameters['request_disk'] )*numTasks ) );
+        bundled.addParam( 'request_cpus', str( cpus ) );
+        return bundled;
     
+# The script a bundled Job runs (see CondorDag.findBundles); it is written to condorFiles/loni2condor_bundle.py.
+BUNDLE_WRAPPER = r'''#!/usr/bin/env python
+"""Run lines FIRST to LAST of a loni2condor tasks file, SLOTS at a time.
+
+Usage: loni2condor_bundle.py TASKS_FILE FIRST LAST SLOTS
+
+Each line of the tasks file is a Job name, its output file, its error file and its command,
+separated by tabs.  The exit code of each task is printed, and the bundle fails if any task does.
+"""
+import os
+import subprocess
+import sys
+
+def main( argv ):
+    first, last, slots = int( argv[2] ), int( argv[3] ), max( 1, int( argv[4] ) );
+    tasksFile = open( argv[1] );
+    tasks = [ line.rstrip( '\n' ).split( '\t', 3 ) for line in tasksFile ][first:last+1];
+    tasksFile.close();
+    tasks.reverse();
+    running = {};
+    failed = 0;
+    while( tasks or running ):
+        while( tasks and (len(running) < slots) ):
+            job, output, error, command = tasks.pop();
+            outFile = open( output, 'w' );
+            errFile = open( error, 'w' );
+            try:
+                process = subprocess.Popen( command.split(), stdout=outFile, stderr=errFile );
+                # keep the process, or subprocess may reap it before os.wait does.
+                running[process.pid] = ( job, process );
+            except OSError:
+                errFile.write( "Error: Can't run "+command+"\n" );
+                print( job+" exited with 127" );
+                failed = failed+1;
+            outFile.close();
+            errFile.close();
+        if( not running ):
+            continue;
+        pid, status = os.wait();
+        if( pid not in running ):
+            continue;
+        job, process = running.pop( pid );
+        if( os.WIFSIGNALED( status ) ):
+            code = -os.WTERMSIG( status );
+        else:
+            code = os.WEXITSTATUS( status );
+        print( job+" exited with "+str(code) );
+        sys.stdout.flush();
+        if( code != 0 ):
+            failed = failed+1;
+    return int( failed > 0 );
+
+if __name__ == '__main__':
+    sys.exit( main( sys.argv ) );
+'''
+
+# The script that restores a Job's outputs from the result cache, or stores them in it (see CondorDag.findCachedJobs);
+# it is written to condorFiles/loni2condor_cache.py.  Its jobKey must match ResultCache.jobKey.
+CACHE_WRAPPER = r'''#!/usr/bin/env python
+"""Restore a loni2condor Job's outputs from the result cache, or store them in it.
+
+Usage: loni2condor_cache.py restore CACHE_DIR MODE JOBS_FILE JOB KEY
+       loni2condor_cache.py store CACHE_DIR MAX_MB MODE JOBS_FILE JOB RETURN
+
+JOBS_FILE maps each Job to the key of its command, its inputs and its outputs.  MODE is link, to
+hardlink files (or copy them, where they can't be linked), or copy.  store exits with RETURN (the
+Job's own exit code), and only stores the outputs of a Job that succeeded.  How much the cache holds
+is kept in its size file; only when that is more than MAX_MB is the cache scanned, and the least
+recently used entries removed until it holds no more than 90% of MAX_MB.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+def hashFile( filename ):
+    digest = hashlib.sha1();
+    try:
+        f = open( filename, 'rb' );
+    except IOError:
+        return '';
+    block = f.read( 1<<20 );
+    while( block ):
+        digest.update( block );
+        block = f.read( 1<<20 );
+    f.close();
+    return digest.hexdigest();
+
+def jobKey( commandKey, inputs ):
+    digest = hashlib.sha1( commandKey );
+    for filename in inputs:
+        inputHash = hashFile( filename );
+        if( inputHash == '' ):
+            return None;
+        digest.update( '\0'+inputHash );
+    return digest.hexdigest();
+
+def place( source, destination, mode ):
+    if( os.path.lexists( destination ) ):
+        os.remove( destination );
+    if( mode == 'link' ):
+        try:
+            os.link( source, destination );
+            return;
+        except OSError:
+            pass;
+    shutil.copy2( source, destination );
+
+def restore( cacheDir, mode, name, job, key ):
+    entry = os.path.join( cacheDir, key );
+    if( not os.path.isfile( os.path.join( entry, 'done' ) ) ):
+        sys.stderr.write( "Error: the cached outputs of "+name+" have been removed from "+cacheDir+"; translate the pipeline again.\n" );
+        return 1;
+    for i, output in enumerate( job['outputs'] ):
+        place( os.path.join( entry, str(i) ), output, mode );
+    os.utime( os.path.join( entry, 'done' ), None );
+    return 0;
+
+def entrySize( entry ):
+    return sum( [ os.path.getsize( os.path.join( entry, f ) ) for f in os.listdir( entry ) ] );
+
+def evict( cacheDir, maxBytes ):
+    entries = [];
+    total = 0;
+    for key in os.listdir( cacheDir ):
+        entry = os.path.join( cacheDir, key );
+        if( not os.path.isfile( os.path.join( entry, 'done' ) ) ):
+            continue;
+        size = entrySize( entry );
+        entries.append( (os.path.getmtime( os.path.join( entry, 'done' ) ), size, entry) );
+        total = total+size;
+    if( total > maxBytes ):
+        # leave some room, so the next few stores don't have to scan the cache again.
+        entries.sort();
+        for used, size, entry in entries:
+            if( total <= 0.9*maxBytes ):
+                break;
+            shutil.rmtree( entry, True );
+            total = total-size;
+    return total;
+
+def account( cacheDir, maxBytes, added ):
+    lock = open( os.path.join( cacheDir, 'lock' ), 'a' );
+    fcntl.flock( lock, fcntl.LOCK_EX );
+    try:
+        sizeFile = os.path.join( cacheDir, 'size' );
+        try:
+            total = int( open( sizeFile ).read() )+added;
+        except (IOError, ValueError):
+            total = None;
+        if( (total == None) or (total > maxBytes) ):
+            total = evict( cacheDir, maxBytes );
+        f = open( sizeFile, 'w' );
+        f.write( str(total) );
+        f.close();
+    finally:
+        lock.close();
+
+def store( cacheDir, maxBytes, mode, name, job, returnValue ):
+    if( returnValue != 0 ):
+        return returnValue;
+    key = jobKey( job['commandKey'], job['inputs'] );
+    if( key == None ):
+        return 0;
+    entry = os.path.join( cacheDir, key );
+    added = 0;
+    if( not os.path.isdir( entry ) ):
+        partial = entry+'.'+str(os.getpid());
+        try:
+            os.makedirs( partial );
+            for i, output in enumerate( job['outputs'] ):
+                place( output, os.path.join( partial, str(i) ), mode );
+            open( os.path.join( partial, 'done' ), 'w' ).close();
+            added = entrySize( partial );
+            os.rename( partial, entry );
+        except (IOError, OSError):
+            # the Job still succeeded, even if its outputs couldn't be cached.
+            sys.stderr.write( "Warning: couldn't cache the outputs of "+name+": "+str(sys.exc_info()[1])+"\n" );
+            shutil.rmtree( partial, True );
+            added = 0;
+    account( cacheDir, maxBytes, added );
+    return 0;
+
+def main( argv ):
+    if( argv[1] == 'restore' ):
+        jobsFile = open( argv[4] );
+        job = json.load( jobsFile )[argv[5]];
+        jobsFile.close();
+        return restore( argv[2], argv[3], argv[5], job, argv[6] );
+    jobsFile = open( argv[5] );
+    job = json.load( jobsFile )[argv[6]];
+    jobsFile.close();
+    return store( argv[2], float( argv[3] )*(1<<20), argv[4], argv[6], job, int( argv[7] ) );
+
+if __name__ == '__main__':
+    sys.exit( main( sys.argv ) );
+'''
+
 class CondorDag:
     """A Condor Directed Acyclic Graph (DAG) file that represents the dependencies between Modules.
     
     """
-    def __init__( self, startDir ):
+    def __init__( self, startDir, clustered=0, manifest=None, upToDate=None, cache=None, resources=None, headroom=0.2,
+                  runtimes=None, bundleSeconds=None, bundleCpus=1, resultCache=None ):
         """Create a new DAG File, in the start directory.
 
         Arguments:
         startDir -- The directory to start in.
+        clustered -- 1 to run each module whose executions line up one-to-one with its
+                     neighbours' as a single cluster (one JOB, queued from an item data file).
+        manifest -- A CondorManifest, to only rewrite what has changed since the last run, and to take the
+                    variables of unchanged modules' Jobs from the last run's DAG (files are always checked).
+        upToDate -- 'done' to mark Jobs whose outputs are newer than their inputs DONE, or 'prune'
+                    to leave them out of the DAG; None runs every Job.
+        cache -- A TranslationCache, to share directory permission probes with other DAGs.
+        resources -- A dict mapping each module (submit file name) to the most (memory MB, CPUs, disk KB)
+                     it used before (see readResourceHistory); if given, every submit file requests
+                     what its module used, plus headroom, or the defaults if it hasn't run.
+        headroom -- The fraction to add to the memory and disk each module used before.
+        runtimes -- A dict mapping each module (submit file name) to how long an execution of it took
+                    before, in seconds (see readRuntimeHistory).
+        bundleSeconds -- If given, the executions of each module in runtimes that take less than this
+                         are run in bundles that should take about this long (see findBundles).
+        bundleCpus -- How many executions of a bundle run at once.
+        resultCache -- A ResultCache; if given, Jobs whose outputs are in it are restored from it
+                       instead of being run, and every other Job's outputs are stored in it.
 
         Variables:
-        jobList -- The list of Jobs to run.
-        dependencies -- The list of dependencies between the defined Jobs.
-        varList -- The list of variables that are passed to the different submit files.
+        jobList -- The names of the Jobs to run, in the order they were added.
+        jobs -- A dict mapping each Job name to its submit file.
+        children -- A dict mapping a Job (or a name that may not be a Job) to the list of names that depend on it.
+        childSets -- The same as children, as sets, so that dependencies are only added once.
+        moduleVars -- A dict mapping each module (submit file name) to a list of (variable, synopsis, file list, number of Jobs)
+                      passed to its Jobs' submit file; each Job's file is only looked up (see getVars) when it is needed.
+        clusterNames -- The submit file names of the modules, in the order they were added.
+        clusterJobs -- A dict mapping each submit file name to its Jobs, in execution order.
+        clusterSubmitFiles -- A dict mapping each submit file name to its CondorSubmitFile.
+        jobCluster -- A dict mapping each Job name to (submit file name, execution number).
+        bundled -- The submit file names of the modules that are run in bundles.
+        bundleNodes -- A dict mapping each bundle's DAG node to (CondorSubmitFile, first task, last task).
+        nodeOf -- A dict mapping each Job that is run by a bundle or cluster to its DAG node, once the DAG is written.
+        cachedJobs -- A dict mapping each Job that is restored from the result cache to its key.
+        storedJobs -- The Jobs whose outputs are stored in the result cache when they succeed.
+        moduleFiles -- A dict mapping each module (submit file name) to a list of (1 if read or 0 if written, file list,
+                       number of Jobs) for each file its Jobs read or write (see getJobFiles).
+        doneJobs -- The Jobs that are up to date, and won't be run.
+        unchangedModules -- The modules (submit file names) the manifest found unchanged since the last run.
         submitFiles -- The submit files that need to be created.
+        permissions -- A FilePermissionChecker for every file the Jobs read or write.
 
         """
         
         self.jobList = [];
-        self.dependencies = [];
-        self.varList = {};
+        self.jobs = {};
+        self.children = {};
+        self.childSets = {};
+        self.moduleVars = {};
+        self.clustered = clustered;
+        self.manifest = manifest;
+        self.upToDate = upToDate;
+        self.resources = resources;
+        self.headroom = headroom;
+        self.runtimes = runtimes or {};
+        self.bundleSeconds = bundleSeconds;
+        self.bundleCpus = bundleCpus;
+        self.bundled = set();
+        self.bundleNodes = {};
+        self.nodeOf = {};
+        self.resultCache = resultCache;
+        self.cachedJobs = {};
+        self.storedJobs = set();
+        self.moduleFiles = {};
+        self.doneJobs = set();
+        self.unchangedModules = set();
+        self.clusterNames = [];
+        self.clusterJobs = {};
+        self.clusterSubmitFiles = {};
+        self.jobCluster = {};
         self.submitFiles = [];
+        if( cache != None ):
+            self.permissions = FilePermissionChecker( cache.directories );
+        else:
+            self.permissions = FilePermissionChecker();
         self.dir = startDir;
+    def addJob( self, name, submitFile, cluster=None ):
+        """Add a Job to the DAG.
+
+        Arguments:
+        name -- The name of the Job.
+        submitFile -- The path of the submit file the Job runs.
+        cluster -- The CondorSubmitFile of the module this Job is the next execution of, if any.
+
+        """
+        if( not self.jobs.has_key( name ) ):
+            self.jobList.append( name );
+        self.jobs[name] = submitFile;
+        if( cluster != None ):
+            if( not self.clusterJobs.has_key( cluster.filename ) ):
+                self.clusterNames.append( cluster.filename );
+                self.clusterJobs[cluster.filename] = [];
+                self.clusterSubmitFiles[cluster.filename] = cluster;
+            self.jobCluster[name] = ( cluster.filename, len(self.clusterJobs[cluster.filename]) );
+            self.clusterJobs[cluster.filename].append( name );
+    def addDependency( self, parent, child ):
+        """Make child depend on parent.  Either name may be something that never becomes a Job
+           (i.e. a Module without a command); verifyAndCleanDag routes around those.
+
+        Arguments:
+        parent -- The name of the Job that must run first.
+        child -- The name of the Job that depends on it.
+
+        """
+        childSet = self.childSets.setdefault( parent, set() );
+        if( child not in childSet ):
+            childSet.add( child );
+            self.children.setdefault( parent, [] ).append( child );
+    def addVar( self, name, varName, synopsis, fileList, numJobs ):
+        """Pass a variable (a file, and its synopsis) to the submit file of each of a module's Jobs.
+
+        Arguments:
+        name -- The module's submit file name; its Jobs are name_0, name_1, ...
+        varName -- The name of the variable.
+        synopsis -- The synopsis (i.e. -i) that goes in front of the file.
+        fileList -- The LONI File's file list; Job j is passed file j, or the only file...
+        numJobs -- ...if j is less than this.
+
+        """
+        self.moduleVars.setdefault( name, [] ).append( (varName, synopsis, fileList, numJobs) );
+    def jobEntries( self, table, name ):
+        """Return the entries of a module table (see addVar and addJobFile) that a Job is passed,
+           with the file list and number of Jobs replaced by the Job's file.
+
+        Arguments:
+        table -- moduleVars or moduleFiles.
+        name -- The name of the Job.
+
+        """
+        parts = name.rsplit( '_', 1 );
+        if( (len(parts) != 2) or (not parts[1].isdigit()) ):
+            return [];
+        index = int( parts[1] );
+        entries = [];
+        for entry in table.get( parts[0], [] ):
+            fileList, numJobs = entry[-2:];
+            if( index < numJobs ):
+                if( len(fileList) == 1 ):
+                    entries.append( entry[:-2] + ( fileList[0], ) );
+                elif( index < len(fileList) ):
+                    entries.append( entry[:-2] + ( fileList[index], ) );
+        return entries;
+    def getVars( self, name ):
+        """Return the (variable, synopsis, filename) passed to a Job's submit file.
+
+        Arguments:
+        name -- The name of the Job.
+
+        """
+        return self.jobEntries( self.moduleVars, name );
+    def jobMacros( self, name ):
+        """Return the macros Condor would set for a Job: its variables, $(Process) and $(Cluster).
+
+        Arguments:
+        name -- The name of the Job.
+
+        """
+        submitName, index = self.jobCluster[name];
+        macros = { 'Process':str(index), 'Cluster':str( self.clusterNames.index( submitName )+1 ) };
+        for varName, synopsis, filename in self.getVars( name ):
+            macros[varName] = synopsis+" "+filename;
+        return macros;
+    def jobCommand( self, name, macros=None ):
+        """Return the command line (a list) a Job runs.
+
+        Arguments:
+        name -- The name of the Job.
+        macros -- The Job's macros, if they have already been looked up.
+
+        """
+        if( macros == None ):
+            macros = self.jobMacros( name );
+        submitFile = self.clusterSubmitFiles[self.jobCluster[name][0]];
+        return [ submitFile.parameters['Executable'] ] + expandCondorMacros( submitFile.arguments, macros ).split();
+    def addJobFile( self, name, fileList, numJobs, isInput ):
+        """Record a file that each of a module's Jobs reads or writes.
+
+        Arguments:
+        name -- The module's submit file name; its Jobs are name_0, name_1, ...
+        fileList -- The LONI File's file list; Job j uses file j, or the only file...
+        numJobs -- ...if j is less than this.
+        isInput -- 1 if the Jobs read the files, 0 if they write them.
+
+        """
+        self.moduleFiles.setdefault( name, [] ).append( (isInput, fileList, numJobs) );
+    def getJobFiles( self, name, isInput ):
+        """Return the files a Job reads, or writes.
+
+        Arguments:
+        name -- The name of the Job.
+        isInput -- 1 for the files it reads, 0 for those it writes.
+
+        """
+        return [ filename for fileIsInput, filename in self.jobEntries( self.moduleFiles, name ) if fileIsInput == isInput ];
+    def topologicalOrder( self ):
+        """Return the Jobs, each after every Job it depends on.
+
+        """
+        numParents = dict( [ (job, 0) for job in self.jobList ] );
+        for job in self.jobList:
+            for child in self.children.get( job, [] ):
+                numParents[child] = numParents[child]+1;
+        order = [ job for job in self.jobList if numParents[job] == 0 ];
+        i = 0;
+        while( i < len(order) ):
+            for child in self.children.get( order[i], [] ):
+                numParents[child] = numParents[child]-1;
+                if( numParents[child] == 0 ):
+                    order.append( child );
+            i = i+1;
+        return order;
+    def findUpToDateJobs( self ):
+        """Return the Jobs that don't need to run again, like make does.
+
+        Description:
+        A Job is up to date when it writes at least one file, all of its files exist, its oldest
+        output is no older than its newest input, and every Job it depends on is up to date too.
+        Each file is only looked at once.
+
+        """
+        mtimes = {};
+        def mtime( filename ):
+            if( not mtimes.has_key( filename ) ):
+                try:
+                    mtimes[filename] = os.stat( filename ).st_mtime;
+                except OSError:
+                    mtimes[filename] = None;
+            return mtimes[filename];
+
+        stale = set();
+        done = set();
+        for job in self.topologicalOrder():
+            if( job not in stale ):
+                outputs = [ mtime( filename ) for filename in self.getJobFiles( job, 0 ) ];
+                inputs = [ mtime( filename ) for filename in self.getJobFiles( job, 1 ) ];
+                if( (outputs != []) and (None not in outputs) and (None not in inputs) and (min( outputs ) >= max( [0] + inputs )) ):
+                    done.add( job );
+                    continue;
+            # everything that depends on a Job that runs has to run again too.
+            for child in self.children.get( job, [] ):
+                stale.add( child );
+        return done;
+    def pruneJobs( self, jobs ):
+        """Leave Jobs (which only depend on each other) out of the DAG.
+
+        Arguments:
+        jobs -- The Jobs to leave out.
+
+        """
+        self.jobList = [ job for job in self.jobList if job not in jobs ];
+        for job in jobs:
+            del self.jobs[job];
+            self.children.pop( job, None );
+            self.childSets.pop( job, None );
+            if( self.jobCluster.has_key( job ) ):
+                submitName, index = self.jobCluster.pop( job );
+                self.clusterJobs[submitName].remove( job );
     def write(self):
         """Write the DAG File.
 
@@ -738,83 +1836,372 @@ class CondorDag:
             os.mkdir( ''.join([self.dir,'condorFiles']) )
         
         self.verifyAndCleanDag();
-
-        dagFile = open( ''.join([self.dir, 'condorFiles/MASTER_CONDOR_SCRIPT.dag']), 'w' );
+        if( self.upToDate != None ):
+            self.doneJobs = self.findUpToDateJobs();
+            print str(len(self.doneJobs))+" of "+str(len(self.jobList))+" job(s) are up to date.";
+            for job in self.doneJobs:
+                self.permissions.skip( self.getJobFiles( job, 0 ) );
+            if( self.upToDate == 'prune' ):
+                self.pruneJobs( self.doneJobs );
+                self.doneJobs = set();
+        self.permissions.report();
+        # the DAG node each clustered Job is run by.
+        if( self.resultCache != None ):
+            self.findCachedJobs();
+        nodeOf = {};
+        if( self.bundleSeconds != None ):
+            nodeOf = self.findBundles();
+        if( self.clustered ):
+            nodeOf.update( self.findClusters() );
+
+        dagFilename = ''.join([self.dir, 'condorFiles/MASTER_CONDOR_SCRIPT.dag']);
+        # the variables of an unchanged module's Jobs are read back from the last run's DAG,
+        # rather than working out their file names again.
+        previousVars = {};
+        if( (self.unchangedModules != set()) and self.manifest.wroteLastTime( dagFilename ) ):
+            for line in open( dagFilename ):
+                if( line.startswith( 'VARS ' ) ):
+                    job = line[5:line.find( ' ', 5 )];
+                    if( (job.rsplit( '_', 1 )[0] in self.unchangedModules) and (not line.startswith( ''.join(['VARS ', job, ' Job="']) )) ):
+                        previousVars[job] = line;
+
+        dagFile = [];
+        # a node is only DONE if all of its Jobs are.
+        notDone = set( [ nodeOf.get( job, job ) for job in self.jobList if job not in self.doneJobs ] );
+        written = set();
+        for job in self.jobList :
+            node = nodeOf.get( job, job );
+            if( node not in written ):
+                written.add( node );
+                submitFile = self.jobs[job];
+                if( self.bundleNodes.has_key( node ) ):
+                    submitFile = ''.join([self.dir, 'condorFiles/', self.bundleNodes[node][0].filename, '.submit']);
+                elif( self.cachedJobs.has_key( job ) ):
+                    submitFile = ''.join([self.dir, 'condorFiles/loni2condor_restore.submit']);
+                if( node in notDone ):
+                    dagFile.append( ''.join(["JOB ", node, " ", submitFile, "\n"]) );
+                else:
+                    dagFile.append( ''.join(["JOB ", node, " ", submitFile, " DONE\n"]) );
+        written = set();
+        for job in self.jobList :
+            for child in self.children.get( job, [] ):
+                edge = ( nodeOf.get( job, job ), nodeOf.get( child, child ) );
+                if( (edge not in written) and (edge[0] != edge[1]) ):
+                    written.add( edge );
+                    dagFile.append( ''.join(["PARENT ", edge[0], " CHILD ", edge[1], "\n"]) );
         for job in self.jobList :
-            dagFile.write( job+"\n" );
-        for dependency in self.dependencies:
-            dagFile.write( dependency+"\n" );
-        for moduleName, paramArray in self.varList.iteritems():
-            if( paramArray != [] ):
-                dagFile.write( "VARS "+moduleName+" ");
-                dagFile.write( paramArray );
-            dagFile.write( "\n" );
-        dagFile.write("\n\nDOT "+self.dir+'condorFiles/visualGraph.dot' );
-        dagFile.close();
+            if( self.cachedJobs.has_key( job ) ):
+                dagFile.append( ''.join([ "VARS ", job, " Job=\"", job, "\" Key=\"", self.cachedJobs[job], "\"\n" ]) );
+            elif( previousVars.has_key( job ) & (not nodeOf.has_key( job )) ):
+                dagFile.append( previousVars[job] );
+            elif( not nodeOf.has_key( job ) ):
+                jobVars = self.getVars( job );
+                if( jobVars != [] ):
+                    dagFile.append( "VARS "+job+" ");
+                    dagFile.append( ''.join([ varName+"=\""+synopsis+" "+filename+"\" " for varName, synopsis, filename in jobVars ]) );
+                    dagFile.append( "\n" );
+        written = set();
+        for job in self.jobList :
+            node = nodeOf.get( job );
+            if( self.bundleNodes.has_key( node ) and (node not in written) ):
+                written.add( node );
+                submitFile, first, last = self.bundleNodes[node];
+                dagFile.append( ''.join([ "VARS ", node, " First=\"", str(first), "\" Last=\"", str(last), "\"\n" ]) );
+        if( self.resultCache != None ):
+            for job in self.jobList :
+                # a bundle or cluster runs many Jobs, so only Jobs with their own node can store their outputs.
+                if( (job in self.storedJobs) and (not nodeOf.has_key( job )) ):
+                    dagFile.append( ''.join([ "SCRIPT POST ", job, " ", ' '.join( self.cacheCommand( 'store', job, '$RETURN' ) ), "\n" ]) );
+        dagFile.append("\n\nDOT "+self.dir+'condorFiles/visualGraph.dot' );
+        self.nodeOf = nodeOf;
+        writeCondorFile( dagFilename, ''.join( dagFile ), self.manifest );
         for submitFile in self.submitFiles:
-            submitFile.printSubmitFile()
+            submitFile.printSubmitFile( self.manifest )
         
     def verifyAndCleanDag( self ):
         """Verify the DAG is appropriately constructed, and correct errors.
 
+        Description:
+        Dependencies on names that are not Jobs are replaced by dependencies on the Jobs
+        that those names lead to, variables for names that are not Jobs are dropped, and
+        the DAG is checked for cycles.  This takes time linear in the size of the DAG.
+
+        """
+        # the Jobs each non-Job name leads to, worked out once per name.
+        throughMissing = {};
+        def jobsReachedFrom( name ):
+            if( not throughMissing.has_key( name ) ):
+                throughMissing[name] = [];
+                reached = [];
+                seen = set();
+                for child in self.children.get( name, [] ):
+                    if( self.jobs.has_key( child ) ):
+                        found = [ child ];
+                    else:
+                        found = jobsReachedFrom( child );
+                    for job in found:
+                        if( job not in seen ):
+                            seen.add( job );
+                            reached.append( job );
+                throughMissing[name] = reached;
+            return throughMissing[name];
+
+        newChildren = {};
+        newChildSets = {};
+        for job in self.jobList:
+            newChildren[job] = [];
+            newChildSets[job] = set();
+            for child in self.children.get( job, [] ):
+                if( self.jobs.has_key( child ) ):
+                    found = [ child ];
+                else:
+                    found = jobsReachedFrom( child );
+                for newChild in found:
+                    if( newChild not in newChildSets[job] ):
+                        newChildSets[job].add( newChild );
+                        newChildren[job].append( newChild );
+        self.children = newChildren;
+        self.childSets = newChildSets;
+
+        newVars = {};
+        for name, moduleVars in self.moduleVars.iteritems():
+            if( self.clusterJobs.has_key( name ) ):
+                newVars[name] = moduleVars;
+        self.moduleVars = newVars;
+
+        cycle = self.findCycle();
+        if( cycle != [] ):
+            raise LONIPipelineError( "The DAG has a cycle, which Condor can not run:\n    "+" -> ".join( cycle ) );
+
+    def findCachedJobs( self ):
+        """Look each Job up in the result cache, and write the files that restore and store Jobs' outputs.
+
+        Description:
+        A Job that runs the same command on inputs with the same contents as one whose outputs are in
+        the cache is run by a restore step instead, which links or copies the cached outputs into place
+        (see CACHE_WRAPPER).  Every other Job that writes files stores them in the cache, from a POST
+        script, when it succeeds.  Jobs that are up to date are left alone.
+        Keys are worked out from the inputs as they are now, so a Job is only restored when every Job
+        it depends on is up to date or restored too; otherwise its inputs may be made again, differently.
+
+        """
+        cache = self.resultCache;
+        jobsFile = ''.join([self.dir, 'condorFiles/loni2condor_cache.json']);
+        wrapper = ''.join([self.dir, 'condorFiles/loni2condor_cache.py']);
+        parents = {};
+        for job in self.jobList:
+            for child in self.children.get( job, [] ):
+                parents.setdefault( child, [] ).append( job );
+        described = {};
+        for job in self.topologicalOrder():
+            outputs = self.getJobFiles( job, 0 );
+            if( (job in self.doneJobs) or (outputs == []) ):
+                continue;
+            inputs = self.getJobFiles( job, 1 );
+            described[job] = { 'commandKey':cache.commandKey( self.jobCommand( job ), outputs ), 'inputs':inputs, 'outputs':outputs };
+            key = None;
+            if( [ parent for parent in parents.get( job, [] ) if( (parent not in self.doneJobs) and (not self.cachedJobs.has_key( parent )) ) ] == [] ):
+                key = cache.jobKey( described[job]['commandKey'], inputs );
+            if( (key != None) and cache.lookup( key ) ):
+                self.cachedJobs[job] = key;
+                cache.restored( key, outputs );
+            else:
+                self.storedJobs.add( job );
+        print str(len(self.cachedJobs))+" of "+str(len(self.jobList))+" job(s) will be restored from the result cache.";
+        if( described == {} ):
+            return;
+        writeCondorFile( jobsFile, json.dumps( described, sort_keys=True ), self.manifest );
+        # it hashes strings as they are, like ResultCache does, so it is run by this python too.
+        writeCondorFile( wrapper, CACHE_WRAPPER.replace( '#!/usr/bin/env python', '#!'+sys.executable, 1 ), self.manifest );
+        os.chmod( wrapper, 0755 );
+        if( self.cachedJobs != {} ):
+            restore = [ "################################\n", "#loni2condor_restore\n",
+                "#    Restores the outputs of a Job from the result cache\n", "################################\n" ];
+            restore.append( "universe = local\n" );
+            restore.append( "Executable = "+wrapper+"\n" );
+            restore.append( ' '.join([ "Arguments = restore", cache.dir, cache.mode, jobsFile, "$(Job) $(Key)\n" ]) );
+            restore.append( "initialdir = "+self.dir+"\n" );
+            restore.append( ''.join([ "output = ", self.dir, "condorFiles/loni2condor_restore.$(Job).output\n" ]) );
+            restore.append( ''.join([ "error = ", self.dir, "condorFiles/loni2condor_restore.$(Job).error\n" ]) );
+            restore.append( ''.join([ "log = ", self.dir, "condorFiles/loni2condor_restore.log\n" ]) );
+            restore.append( "getenv = True\n" );
+            restore.append( "notification = never\n" );
+            restore.append( "queue" );
+            writeCondorFile( ''.join([self.dir, 'condorFiles/loni2condor_restore.submit']), ''.join( restore ), self.manifest );
+
+    def cacheCommand( self, action, job, returnValue=None ):
+        """Return the command line (a list) that restores a Job's outputs from the result cache, or stores them in it.
+
+        Arguments:
+        action -- 'restore' or 'store'.
+        job -- The name of the Job.
+        returnValue -- What the Job exited with, for 'store' (i.e. $RETURN in a POST script).
+
+        """
+        cache = self.resultCache;
+        wrapper = ''.join([self.dir, 'condorFiles/loni2condor_cache.py']);
+        jobsFile = ''.join([self.dir, 'condorFiles/loni2condor_cache.json']);
+        if( action == 'restore' ):
+            return [ wrapper, 'restore', cache.dir, cache.mode, jobsFile, job, self.cachedJobs[job] ];
+        return [ wrapper, 'store', cache.dir, str(cache.maxMB), cache.mode, jobsFile, job, str(returnValue) ];
+
+    def findBundles( self ):
+        """Choose the modules whose executions are short enough to run several to a Job, and write
+           their tasks files, bundle submit files and the wrapper that runs a bundle.
+
+        Description:
+        A module that took m seconds an execution before (see runtimes) is run in bundles of
+        k = bundleSeconds*bundleCpus/m executions, as long as k is at least 2, so that each bundle's
+        Job takes about bundleSeconds when bundleCpus executions run at once.  Each line of the
+        module's tasks file is one execution's command, so a bundle is the range of lines its
+        node's First and Last variables pick out.  Executions that are up to date, or restored from
+        the result cache, aren't bundled.
+        Dependencies are between bundles, so a bundle waits for every parent of each of its executions.
+
+        Returns:
+        A dict mapping each bundled Job to the name of its bundle's DAG node.
+
+        """
+        wrapper = ''.join([self.dir, 'condorFiles/loni2condor_bundle.py']);
+        nodeOf = {};
+        for name in self.clusterNames:
+            jobs = [ job for job in self.clusterJobs[name] if( (job not in self.doneJobs) and (not self.cachedJobs.has_key( job )) ) ];
+            seconds = self.runtimes.get( name );
+            if( (seconds == None) or (len(jobs) < 2) or self.jobs.has_key( name ) ):
+                continue;
+            if( seconds > 0 ):
+                numTasks = min( len(jobs), int( self.bundleSeconds*self.bundleCpus/seconds ) );
+            else:
+                numTasks = len(jobs);
+            if( numTasks < 2 ):
+                continue;
+
+            tasks = [];
+            for job in jobs:
+                index = self.jobCluster[job][1];
+                tasks.append( '\t'.join([ job, ''.join([self.dir, 'condorFiles/', name, '.', str(index), '.output']),
+                    ''.join([self.dir, 'condorFiles/', name, '.', str(index), '.error']), ' '.join( self.jobCommand( job ) ) ])+'\n' );
+            tasksFile = ''.join([self.dir, 'condorFiles/', name, '.tasks']);
+            writeCondorFile( tasksFile, ''.join( tasks ), self.manifest );
+            submitFile = self.clusterSubmitFiles[name].bundle( wrapper, tasksFile, numTasks, min( self.bundleCpus, numTasks ) );
+            self.submitFiles.append( submitFile );
+            self.bundled.add( name );
+            first = 0;
+            while( first < len(jobs) ):
+                last = min( first+numTasks, len(jobs) )-1;
+                node = ''.join([submitFile.filename, '_', str(first/numTasks)]);
+                self.bundleNodes[node] = ( submitFile, first, last );
+                for job in jobs[first:last+1]:
+                    nodeOf[job] = node;
+                first = last+1;
+        if( self.bundled != set() ):
+            writeCondorFile( wrapper, BUNDLE_WRAPPER, self.manifest );
+            os.chmod( wrapper, 0755 );
+        return nodeOf;
+
+    def findClusters( self ):
+        """Choose the modules whose Jobs can be run as one cluster, and write their item data files.
+
+        Description:
+        A module is clustered when each of its executions only depends on (and is only depended on by)
+        the same execution of modules with the same number of executions, i.e. its fan-out is one-to-one,
+        so a dependency between whole clusters is exactly as strict as the dependencies between Jobs.
+        Every execution must also set the same variables, to values that fit in a line of item data.
+
+        Returns:
+        A dict mapping each clustered Job to the name of its cluster.
+
         """
-        findParentChild = re.compile( r'^PARENT\s+(?P<parent>\S+)\s+CHILD\s+(?P<child>\S+)\s*$' );
-        findJobName = re.compile(r'^JOB\s+(?P<name>\S+)\s+\S+\s*$');
-
-        newDependencies = [];
-        for dependency in self.dependencies:
-            childFoundInJobList = 0;
-            parentFoundInJobList = 0;
-            myDependency = findParentChild.search( dependency );
-            for job in self.jobList:
-                job = findJobName.search( job );
-                job = job.group('name')
-                if( job == myDependency.group('child') ):
-                    childFoundInJobList = 1;
-                    if( parentFoundInJobList == 1 ):
+        parents = {};
+        for job in self.jobList:
+            for child in self.children.get( job, [] ):
+                parents.setdefault( child, [] ).append( job );
+        unsafe = re.compile( r'[\s,"]' );
+
+        nodeOf = {};
+        for name in self.clusterNames:
+            jobs = self.clusterJobs[name];
+            if( (jobs == []) or self.jobs.has_key( name ) or (name in self.bundled) ):
+                continue;
+            if( [ job for job in jobs if self.cachedJobs.has_key( job ) ] != [] ):
+                continue;
+            oneToOne = 1;
+            for job in jobs:
+                index = self.jobCluster[job][1];
+                for other in self.children.get( job, [] ) + parents.get( job, [] ):
+                    if( (not self.jobCluster.has_key( other )) or (self.jobCluster[other][0] in self.bundled) or self.cachedJobs.has_key( other ) ):
+                        oneToOne = 0;
                         break;
-                if( job == myDependency.group('parent') ):
-                    parentFoundInJobList = 1;
-                    if( childFoundInJobList == 1 ):
+                    otherName, otherIndex = self.jobCluster[other];
+                    if( (otherName == name) or (otherIndex != index) or (len(self.clusterJobs[otherName]) != len(jobs)) ):
+                        oneToOne = 0;
                         break;
-            if( childFoundInJobList != 1 ):
-                for dependencyToFix in self.dependencies:
-                    needsFixing = findParentChild.search( dependencyToFix );
-                    if( needsFixing.group('parent') == myDependency.group('child') ):
-                        newDependency = "PARENT "+myDependency.group('parent')+" CHILD "+needsFixing.group('child')
-                        newDependencies.append(newDependency);
-            if( parentFoundInJobList != 1 ):
-                for dependencyToFix in self.dependencies:
-                    needsFixing = findParentChild.search( dependencyToFix );
-                    if( needsFixing.group('child') == myDependency.group('parent') ):
-                        newDependency = "PARENT "+needsFixing.group('parent')+" CHILD "+myDependency.group('child')
-                        newDependencies.append( newDependency );
-            if( (parentFoundInJobList == 1) & (childFoundInJobList == 1) ):
-                newDependencies.append( dependency );
-        i=0;
-        while( i < len(newDependencies)-1 ):
-            j=i+1;
-            while( j < len(newDependencies) ):
-                if( newDependencies[i] == newDependencies[j] ):
-                    newDependencies.remove( newDependencies[i] )
-                    j=i+1;
-                j=j+1;
-            i=i+1;
-        self.dependencies = newDependencies;
-        
-        newVars = {};
-        for varName, paramArray in self.varList.iteritems():
-            varFound = 0;
-            for job in self.jobList:
-                job = findJobName.search( job );
-                job = job.group('name')
-                if( job == varName ):
-                    varFound = 1;
-                    newVars[varName] = paramArray;
+                if( oneToOne == 0 ):
+                    break;
+            if( oneToOne == 0 ):
+                continue;
+
+            firstVars = self.getVars( jobs[0] );
+            varNames = [ varName for varName, synopsis, filename in firstVars ];
+            synopses = [ synopsis for varName, synopsis, filename in firstVars ];
+            rows = [];
+            for job in jobs:
+                jobVars = self.getVars( job );
+                if( ([ varName for varName, synopsis, filename in jobVars ] != varNames) or
+                    ([ synopsis for varName, synopsis, filename in jobVars ] != synopses) ):
                     break;
-            varName = '';
-            paramArray = [];
-        self.varList = newVars;
+                values = [ filename for varName, synopsis, filename in jobVars ];
+                if( [ value for value in values if( (value == '') or unsafe.search( value ) ) ] != [] ):
+                    break;
+                rows.append( ",".join( values )+"\n" );
+            if( len(rows) != len(jobs) ):
+                continue;
+
+            itemFile = ''.join([self.dir, 'condorFiles/', name, '.items']);
+            if( varNames != [] ):
+                writeCondorFile( itemFile, ''.join( rows ), self.manifest );
+            self.clusterSubmitFiles[name].cluster( varNames, synopses, itemFile, len(jobs) );
+            for job in jobs:
+                nodeOf[job] = name;
+        return nodeOf;
+
+    def findCycle( self ):
+        """Return a list of Job names that form a cycle, or [] if the DAG is acyclic.
+
+        """
+        # Kahn's algorithm: peel off Jobs with no remaining parents.
+        numParents = dict( [ (job, 0) for job in self.jobList ] );
+        for job in self.jobList:
+            for child in self.children.get( job, [] ):
+                numParents[child] = numParents[child]+1;
+        ready = [ job for job in self.jobList if numParents[job] == 0 ];
+        numDone = 0;
+        while( ready != [] ):
+            job = ready.pop();
+            numDone = numDone+1;
+            for child in self.children.get( job, [] ):
+                numParents[child] = numParents[child]-1;
+                if( numParents[child] == 0 ):
+                    ready.append( child );
+        if( numDone == len(self.jobList) ):
+            return [];
+        # every leftover Job has a leftover parent; walk back until one repeats.
+        leftover = set( [ job for job in self.jobList if numParents[job] > 0 ] );
+        parentOf = {};
+        for job in leftover:
+            for child in self.children.get( job, [] ):
+                if( child in leftover ):
+                    parentOf[child] = job;
+        job = iter(leftover).next();
+        path = [];
+        onPath = {};
+        while( not onPath.has_key( job ) ):
+            onPath[job] = len(path);
+            path.append( job );
+            job = parentOf[job];
+        cycle = path[onPath[job]:];
+        cycle.reverse();
+        return cycle + [ cycle[0] ];
     
     def createCondorFromLoni(self, topModule ):
         """Convert a LONI Pipeline Module into a Condor DAG Module.
@@ -838,13 +2225,18 @@ class CondorDag:
             submitFilename = getRidOfParenthases.sub( '__', submitFilename );
             if( hasattr( curModule, 'CHILD' ) ):
                 self.createCondorFromLoni( curModule )
+            # the Jobs of a module that hasn't changed are passed the same variables as last time.
+            if( self.manifest != None ):
+                if( self.manifest.isUnchanged( 'module', submitFilename, curModule.fingerprint() ) ):
+                    self.unchangedModules.add( submitFilename );
             if( curModule.PARAMS['COMMAND'] != '' ):
                 submitFile = CondorSubmitFile( self.dir, submitFilename, curModule )
+                if( self.resources != None ):
+                    submitFile.requestResources( self.resources.get( submitFilename ), self.headroom );
                 self.submitFiles.append( submitFile );
                 j=0;
                 while( j < curModule.numExecutions ):
-                    job = ''.join(["JOB ", submitFilename, "_", str(j), " ", self.dir, 'condorFiles/', submitFilename, ".submit"] )
-                    self.jobList.append( job )
+                    self.addJob( ''.join([submitFilename, "_", str(j)]), ''.join([self.dir, 'condorFiles/', submitFilename, ".submit"]), submitFile )
                     j = j+1;
 
             if( hasattr( curModule, 'INFILE' ) ):
@@ -890,12 +2282,12 @@ class CondorDag:
                     parentFile = getRidOfSlashes.sub( '__', parentFile );
                     parentFile = getRidOfParenthases.sub( '__', parentFile );
                     
-                    dependency = ''.join(["PARENT ", parentFile, "_", str(j), " CHILD ", moduleName, "_", str(j)])
-                    self.dependencies.append( dependency )
+                    self.addDependency( ''.join([parentFile, "_", str(j)]), ''.join([moduleName, "_", str(j)]) )
                     j = j+1;
             if( myFile.fileList != '' ):
-                myFile.checkFilePermissions()
-                curVal = {}
+                myFile.checkFilePermissions( self.permissions )
+                if( (myFile.PARAMS['TYPE'].lower() == 'file') & (len(myFile.fileList) > 0) ):
+                    self.addJobFile( moduleName, myFile.fileList, curModule.numExecutions, myFile.isInput );
                 if( myFile.isInput == 1 ):
                     paramName = 'InFile';
                 else:
@@ -908,73 +2300,1048 @@ class CondorDag:
                         else:
                         # I added this after I got back... and it might be wrong.
                             numIter = myFile.PARENT_OUTPUT[0].numExecutions;
-                        j=0;
-                        while( j < numIter ):
-                            curModuleName = moduleName+"_"+str(j)
-                            if( self.varList.has_key(curModuleName) != True ):
-                                self.varList[curModuleName] = '';
-                            curVal = myFile.PARAMS['SYNOPSIS']+" "+myFile.fileList[0];
-                            self.varList[curModuleName] = self.varList[curModuleName]+paramName+"=\""+curVal+"\" "
-                            curVal = ''
-                            j=j+1;
+                        self.addVar( moduleName, paramName, myFile.PARAMS['SYNOPSIS'], myFile.fileList, numIter )
                     else:
-                        j=0;
-                        while( j < len(myFile.fileList) ):
-                            curModuleName = moduleName+"_"+str(j)
-                            if( self.varList.has_key(curModuleName) != True ):
-                                self.varList[curModuleName] = '';
-                            curVal = myFile.PARAMS['SYNOPSIS']+" "+myFile.fileList[j];
-                            self.varList[curModuleName] = self.varList[curModuleName]+paramName+"=\""+curVal+"\" "
-                            curVal = ''
-                            j=j+1;
-    
-def ReadListOfFiles( filename ):
-    """Read a list of files and return an array that contains the list.
+                        self.addVar( moduleName, paramName, myFile.PARAMS['SYNOPSIS'], myFile.fileList, len(myFile.fileList) )
     
+class CondorManifest:
+    """A record of what the Condor files were last created from, and of what was written,
+       so that a run can leave everything that hasn't changed alone.
+
+    """
+    def __init__( self, dir ):
+        """Read the manifest left in dir by the last run, if there is one.
+
+        Arguments:
+        dir -- The directory the Condor files are created in.
+
+        Variables:
+        filename -- The manifest file.
+        old -- A dict mapping (kind, key) to the fingerprint recorded by the last run.
+        new -- The same, for this run.
+
+        """
+        self.filename = ''.join([dir, 'condorFiles/loni2condor.manifest']);
+        self.old = {};
+        self.new = {};
+        if( os.access( self.filename, os.F_OK ) ):
+            for line in open( self.filename ):
+                fields = line.rstrip('\n').split('\t');
+                if( len(fields) == 3 ):
+                    self.old[(fields[0], fields[1])] = fields[2];
+    def hashFile( filename ):
+        """Return the sha1 of a file's contents, or '' if it can't be read.
+
+        Arguments:
+        filename -- The file to hash.
+
+        """
+        digest = hashlib.sha1();
+        try:
+            f = open( filename, 'rb' );
+        except IOError:
+            return '';
+        block = f.read( 1<<20 );
+        while( block != '' ):
+            digest.update( block );
+            block = f.read( 1<<20 );
+        f.close();
+        return digest.hexdigest();
+    hashFile = staticmethod( hashFile );
+    def isUnchanged( self, kind, key, fingerprint ):
+        """Record a fingerprint, and return True if the last run recorded the same one.
+
+        Arguments:
+        kind -- What is being fingerprinted (i.e. 'module').
+        key -- Its name.
+        fingerprint -- Its fingerprint.
+
+        """
+        self.new[(kind, key)] = fingerprint;
+        return self.old.get( (kind, key) ) == fingerprint;
+    def upToDate( self, xmlFile, settings ):
+        """Return True if the XML, the .list files it read and the settings are the same as the last run's,
+           and every file the last run wrote is still there.
+
+        Arguments:
+        xmlFile -- The LONI XML Pipeline.
+        settings -- A string describing the options that change the Condor files.
+
+        """
+        if( self.old.get( ('input', xmlFile) ) == None ):
+            return False;
+        if( self.old.get( ('settings', '') ) != settings ):
+            return False;
+        for (kind, key), fingerprint in self.old.iteritems():
+            if( kind in ('input', 'list') ):
+                if( self.hashFile( key ) != fingerprint ):
+                    return False;
+            elif( kind == 'artifact' ):
+                if( (not os.path.isfile( key )) or (str(os.path.getsize( key )) != fingerprint.split(' ')[1]) ):
+                    return False;
+        return True;
+    def recordInputs( self, xmlFile, listFiles, settings ):
+        """Record what this run's Condor files were created from.
+
+        Arguments:
+        xmlFile -- The LONI XML Pipeline.
+        listFiles -- The .list files the pipeline read.
+        settings -- A string describing the options that change the Condor files.
+
+        """
+        self.new[('input', xmlFile)] = self.hashFile( xmlFile );
+        for listFile in listFiles:
+            self.new[('list', listFile)] = self.hashFile( listFile );
+        self.new[('settings', '')] = settings;
+    def wroteLastTime( self, filename ):
+        """Return True if a file still holds exactly what the last run wrote there.
+
+        Arguments:
+        filename -- The file.
+
+        """
+        fingerprint = self.old.get( ('artifact', filename) );
+        if( (fingerprint == None) or (not os.path.isfile( filename )) ):
+            return False;
+        return ''.join([ self.hashFile( filename ), ' ', str(os.path.getsize( filename )) ]) == fingerprint;
+    def writeIfChanged( self, filename, contents ):
+        """Write a file, unless it already holds exactly what the last run wrote there.
+
+        Arguments:
+        filename -- The file to write.
+        contents -- What to write.
+
+        Returns:
+        1 if the file was written, 0 if it was left alone.
+
+        """
+        fingerprint = hashlib.sha1( contents ).hexdigest()+' '+str(len(contents));
+        self.new[('artifact', filename)] = fingerprint;
+        if( (self.old.get( ('artifact', filename) ) == fingerprint) and os.path.isfile( filename ) ):
+            if( os.path.getsize( filename ) == len(contents) ):
+                return 0;
+        outFile = open( filename, 'w' );
+        outFile.write( contents );
+        outFile.close();
+        return 1;
+    def save( self ):
+        """Remove the files the last run wrote that this run didn't, and write the manifest.
+
+        """
+        for (kind, key) in self.old.keys():
+            if( (kind == 'artifact') and (not self.new.has_key( (kind, key) )) and os.path.isfile( key ) ):
+                os.remove( key );
+        manifest = open( self.filename, 'w' );
+        for (kind, key), fingerprint in sorted( self.new.items() ):
+            manifest.write( '\t'.join([ kind, key, fingerprint ])+'\n' );
+        manifest.close();
+
+class ResultCache:
+    """A directory holding the outputs of Jobs that have run, keyed by the Job's command and the contents of its inputs,
+       so that the same command on the same inputs (i.e. in another study) doesn't have to run again.
+
+    """
+    def __init__( self, dir, maxMB, link=0 ):
+        """Use (and create, if needed) a result cache.
+
+        Arguments:
+        dir -- The cache directory.
+        maxMB -- The most the cache may hold; the least recently used outputs are removed to keep it under this.
+        link -- 1 to hardlink outputs into and out of the cache (where it is on the same filesystem) instead of
+                copying them.  Only safe when nothing rewrites a Job's outputs in place.
+
+        Variables:
+        hashes -- A dict mapping each input file to the sha1 of its contents, so each is only read once; the
+                  outputs of a Job that is restored map to the contents they are restored with (see restored).
+
+        """
+        self.dir = os.path.abspath( dir );
+        self.maxMB = maxMB;
+        self.mode = ( link and 'link' ) or 'copy';
+        self.hashes = {};
+        if( not os.path.isdir( self.dir ) ):
+            os.makedirs( self.dir );
+    def commandKey( self, command, outputs ):
+        """Return the part of a Job's key that comes from its command line.
+
+        Arguments:
+        command -- The Job's command line (a list).
+        outputs -- The files it writes; where they appear in the command they are left out of the key,
+                   so the same Job writing somewhere else has the same key.
+
+        """
+        command = [ (arg in outputs) and ('<output '+str(outputs.index( arg ))+'>') or arg for arg in command ];
+        return hashlib.sha1( '\0'.join( command ) ).hexdigest();
+    def jobKey( self, commandKey, inputs ):
+        """Return a Job's key, or None if one of its inputs can't be read (i.e. it hasn't been made yet).
+
+        Arguments:
+        commandKey -- The key of the Job's command line (see commandKey).
+        inputs -- The files it reads.
+
+        Note: This must match jobKey in CACHE_WRAPPER.
+
+        """
+        digest = hashlib.sha1( commandKey );
+        for filename in inputs:
+            if( not self.hashes.has_key( filename ) ):
+                self.hashes[filename] = CondorManifest.hashFile( filename );
+            if( self.hashes[filename] == '' ):
+                return None;
+            digest.update( '\0'+self.hashes[filename] );
+        return digest.hexdigest();
+    def lookup( self, key ):
+        """Return True if the outputs of the Job with this key are in the cache, and mark them as just used.
+
+        """
+        done = os.path.join( self.dir, key, 'done' );
+        if( not os.path.isfile( done ) ):
+            return False;
+        os.utime( done, None );
+        return True;
+    def restored( self, key, outputs ):
+        """Record that a Job's outputs will be restored from the cache, so that the Jobs that read them
+           are keyed by what they will read, rather than what is there now.
+
+        Arguments:
+        key -- The Job's key.
+        outputs -- The files it writes.
+
+        """
+        for i, output in enumerate( outputs ):
+            self.hashes[output] = CondorManifest.hashFile( os.path.join( self.dir, key, str(i) ) );
+
+class LocalDagRunner:
+    """Runs the Jobs of a CondorDag on this machine, instead of submitting them to Condor.
+
+    """
+    def __init__( self, dag, numSlots, retries=0 ):
+        """Get ready to run a DAG that has been written (and so verified and cleaned).
+
+        Arguments:
+        dag -- The CondorDag.
+        numSlots -- The most Jobs to run at once.
+        retries -- How many times to rerun a Job that fails, like a DAG RETRY.
+
+        Variables:
+        units -- What is started, in DAG order: each Job on its own, except that the Jobs of a bundle
+                 are run together, by the bundle's DAG node, as Condor would.
+        unitJobs -- A dict mapping each unit to its Jobs.
+        children -- A dict mapping each unit to the units that depend on it.
+
+        """
+        self.dag = dag;
+        self.numSlots = numSlots;
+        self.retries = retries;
+        self.units = [];
+        self.unitJobs = {};
+        unitOf = {};
+        for job in dag.jobList:
+            unit = dag.nodeOf.get( job, job );
+            if( not dag.bundleNodes.has_key( unit ) ):
+                # a cluster's Jobs run the same commands one at a time as they do together.
+                unit = job;
+            if( not self.unitJobs.has_key( unit ) ):
+                self.units.append( unit );
+                self.unitJobs[unit] = [];
+            self.unitJobs[unit].append( job );
+            unitOf[job] = unit;
+        self.children = {};
+        for job in dag.jobList:
+            for child in dag.children.get( job, [] ):
+                if( (unitOf[child] != unitOf[job]) and (unitOf[child] not in self.children.get( unitOf[job], [] )) ):
+                    self.children.setdefault( unitOf[job], [] ).append( unitOf[child] );
+    def expandMacros( self, text, macros ):
+        """Replace each $(name) in text by macros[name], or nothing, like Condor does.
+
+        """
+        return expandCondorMacros( text, macros );
+    def jobPath( self, path, macros ):
+        """Return where a Job's output, error or log file goes.  Files that every execution
+           of a module would share get the execution number, like the clustered submit files.
+
+        """
+        if( path.find( '$(Process)' ) == -1 ):
+            root, extension = os.path.splitext( path );
+            path = root+'.$(Process)'+extension;
+        return self.expandMacros( path, macros );
+    def jobCommand( self, unit ):
+        """Return (command, initialdir, output, error, log, cluster, process) for a unit: a Job, the restore
+           step of a Job whose outputs are in the result cache, or a bundle.
+
+        Arguments:
+        unit -- The name of the Job, or of the bundle's DAG node.
+
+        """
+        if( self.dag.bundleNodes.has_key( unit ) ):
+            submitFile, first, last = self.dag.bundleNodes[unit];
+            macros = { 'First':str(first), 'Last':str(last) };
+            cluster = int( self.dag.jobMacros( self.unitJobs[unit][0] )['Cluster'] );
+            return ( [ submitFile.parameters['Executable'] ] + self.expandMacros( submitFile.parameters['Arguments'], macros ).split(),
+                     submitFile.parameters['initialdir'], self.expandMacros( submitFile.parameters['output'], macros ),
+                     self.expandMacros( submitFile.parameters['error'], macros ), submitFile.parameters['log'], cluster, first );
+        submitName, index = self.dag.jobCluster[unit];
+        submitFile = self.dag.clusterSubmitFiles[submitName];
+        macros = self.dag.jobMacros( unit );
+        if( self.dag.cachedJobs.has_key( unit ) ):
+            return ( self.dag.cacheCommand( 'restore', unit ), self.dag.dir,
+                     ''.join([self.dag.dir, 'condorFiles/loni2condor_restore.', unit, '.output']),
+                     ''.join([self.dag.dir, 'condorFiles/loni2condor_restore.', unit, '.error']),
+                     ''.join([self.dag.dir, 'condorFiles/loni2condor_restore.log']), int( macros['Cluster'] ), index );
+        return ( self.dag.jobCommand( unit, macros ), submitFile.parameters['initialdir'],
+                 self.jobPath( submitFile.parameters['output'], macros ),
+                 self.jobPath( submitFile.parameters['error'], macros ),
+                 submitFile.parameters['log'], int( macros['Cluster'] ), index );
+    def slots( self, unit ):
+        """Return how many of the slots a unit takes up: a bundle runs several Jobs at once.
+
+        """
+        if( self.dag.bundleNodes.has_key( unit ) ):
+            return max( 1, min( self.numSlots, int( self.dag.bundleNodes[unit][0].parameters['request_cpus'] ) ) );
+        return 1;
+    def criticalPathLengths( self ):
+        """Return a dict mapping each unit to the number of units on the longest path from it to the end of the DAG.
+
+        """
+        numParents = dict( [ (unit, 0) for unit in self.units ] );
+        for unit in self.units:
+            for child in self.children.get( unit, [] ):
+                numParents[child] = numParents[child]+1;
+        order = [ unit for unit in self.units if numParents[unit] == 0 ];
+        i = 0;
+        while( i < len(order) ):
+            for child in self.children.get( order[i], [] ):
+                numParents[child] = numParents[child]-1;
+                if( numParents[child] == 0 ):
+                    order.append( child );
+            i = i+1;
+        lengths = {};
+        for unit in reversed( order ):
+            lengths[unit] = 1 + max( [0] + [ lengths[child] for child in self.children.get( unit, [] ) ] );
+        return lengths;
+    def logEvent( self, log, code, cluster, process, text ):
+        """Append an event to a Job's log, in the format of a Condor user log.
+
+        """
+        logFile = open( log, 'a' );
+        logFile.write( '%03d (%03d.%03d.000) %s %s\n...\n' % ( code, cluster, process, time.strftime( '%m/%d %H:%M:%S' ), text ) );
+        logFile.close();
+    def start( self, unit ):
+        """Start a unit, and return its process (or None if it couldn't be started).
+
+        """
+        command, initialdir, output, error, log, cluster, process = self.jobCommand( unit );
+        self.logEvent( log, 1, cluster, process, 'Job executing on host: <127.0.0.1>' );
+        outFile = open( output, 'w' );
+        errFile = open( error, 'w' );
+        try:
+            try:
+                return subprocess.Popen( command, cwd=initialdir, stdout=outFile, stderr=errFile );
+            except OSError, e:
+                errFile.write( "Error: Can't run "+command[0]+": "+str(e)+"\n" );
+                return None;
+        finally:
+            outFile.close();
+            errFile.close();
+    def finish( self, unit, status ):
+        """Log that a unit finished with a wait() status, and return its exit code (or -signal).
+           A Job whose outputs go in the result cache is then stored, like its POST script does,
+           and the store's exit code is returned instead.
+
+        """
+        command, initialdir, output, error, log, cluster, process = self.jobCommand( unit );
+        if( os.WIFSIGNALED( status ) ):
+            self.logEvent( log, 5, cluster, process, 'Job terminated.\n\t(0) Abnormal termination (signal %d)' % os.WTERMSIG( status ) );
+            code = -os.WTERMSIG( status );
+        else:
+            self.logEvent( log, 5, cluster, process, 'Job terminated.\n\t(1) Normal termination (return value %d)' % os.WEXITSTATUS( status ) );
+            code = os.WEXITSTATUS( status );
+        if( (unit in self.dag.storedJobs) and (not self.dag.nodeOf.has_key( unit )) ):
+            errFile = open( error, 'a' );
+            try:
+                code = subprocess.call( self.dag.cacheCommand( 'store', unit, code ), cwd=initialdir, stderr=errFile );
+            except OSError, e:
+                errFile.write( "Error: Can't store the outputs in the result cache: "+str(e)+"\n" );
+                code = 127;
+            errFile.close();
+        return code;
+    def run( self ):
+        """Run every unit, each once its parents have succeeded, longest critical path first.
+
+        Returns:
+        A list of the Jobs (or bundles) that failed (even after retrying), or that never ran because a parent failed.
+
+        """
+        lengths = self.criticalPathLengths();
+        # Jobs marked DONE have already finished, and a bundle only holds Jobs that haven't.
+        toRun = [ unit for unit in self.units if( [ job for job in self.unitJobs[unit] if job not in self.dag.doneJobs ] != [] ) ];
+        numParents = dict( [ (unit, 0) for unit in self.units ] );
+        for unit in toRun:
+            for child in self.children.get( unit, [] ):
+                numParents[child] = numParents[child]+1;
+        # a heap of (-critical path length, position, unit), so ties run in DAG order.
+        position = dict( [ (unit, i) for i, unit in enumerate( self.units ) ] );
+        ready = [ (-lengths[unit], position[unit], unit) for unit in toRun if numParents[unit] == 0 ];
+        heapq.heapify( ready );
+        for unit in toRun:
+            command, initialdir, output, error, log, cluster, process = self.jobCommand( unit );
+            self.logEvent( log, 0, cluster, process, 'Job submitted from host: <127.0.0.1>\n    DAG Node: '+unit );
+
+        running = {};
+        busy = 0;
+        attempts = {};
+        failed = [];
+        while( (ready != []) or (running != {}) ):
+            # a unit that needs more slots than are free waits for them, unless nothing is running.
+            while( (ready != []) and ((busy + self.slots( ready[0][2] ) <= self.numSlots) or (running == {})) ):
+                unit = heapq.heappop( ready )[2];
+                attempts[unit] = attempts.get( unit, 0 )+1;
+                process = self.start( unit );
+                if( process == None ):
+                    # it can't be started, so retrying won't help.
+                    self.finish( unit, 127<<8 );
+                    failed.append( unit );
+                else:
+                    # keep the process, or subprocess may reap it before os.wait does.
+                    running[process.pid] = ( unit, process );
+                    busy = busy + self.slots( unit );
+            if( running == {} ):
+                continue;
+            pid, status = os.wait();
+            if( not running.has_key( pid ) ):
+                continue;
+            unit, process = running.pop( pid );
+            busy = busy - self.slots( unit );
+            if( self.finish( unit, status ) == 0 ):
+                print "Finished "+unit;
+                for child in self.children.get( unit, [] ):
+                    numParents[child] = numParents[child]-1;
+                    if( numParents[child] == 0 ):
+                        heapq.heappush( ready, (-lengths[child], position[child], child) );
+            elif( attempts[unit] <= self.retries ):
+                print "Retrying "+unit;
+                heapq.heappush( ready, (-lengths[unit], position[unit], unit) );
+            else:
+                print "Error: "+unit+" failed; see "+self.jobCommand( unit )[3];
+                failed.append( unit );
+        # the units that never ran, because one of their parents failed.
+        failed.extend( [ unit for unit in self.units if numParents[unit] > 0 ] );
+        return failed;
+
+class CondorUserLog:
+    """A Condor user log (the 'log' of a submit file), read one event at a time.
+
+    """
+    eventHeader = re.compile( r'^(\d\d\d) \((\d+)\.(\d+)\.\d+\) (\S+ \S+) (.*)$' );
+    dagNode = re.compile( r'^\s*DAG Node: (\S+)' );
+    def __init__( self, filename ):
+        """Get ready to read a log.
+
+        Arguments:
+        filename -- The log file.
+
+        """
+        self.filename = filename;
+    def parseTime( stamp, lastModified=None ):
+        """Return a log timestamp (either MM/DD HH:MM:SS or YYYY-MM-DD HH:MM:SS) in seconds.
+
+        Arguments:
+        stamp -- The timestamp.
+        lastModified -- When the log was last written (now, if it is not given).  An MM/DD stamp has no
+                        year, so it is put in the year up to then: in the same year, unless that would be
+                        after the log was written (i.e. a log that spans New Year), then the year before.
+
+        """
+        stamp = stamp.split('.')[0];
+        if( stamp.find('-') != -1 ):
+            return time.mktime( time.strptime( stamp[:19], '%Y-%m-%d %H:%M:%S' ) );
+        if( lastModified == None ):
+            lastModified = time.time();
+        year = time.localtime( lastModified ).tm_year;
+        seconds = time.mktime( time.strptime( str(year)+'/'+stamp, '%Y/%m/%d %H:%M:%S' ) );
+        # allow a day for the clocks of the machines writing the log to disagree.
+        if( seconds > lastModified + 86400 ):
+            seconds = time.mktime( time.strptime( str(year-1)+'/'+stamp, '%Y/%m/%d %H:%M:%S' ) );
+        return seconds;
+    parseTime = staticmethod( parseTime );
+    def events( self ):
+        """Yield each event as (code, cluster, proc, seconds, text, body), where body is the event's other lines.
+           A log that doesn't exist (yet) has no events.
+
+        """
+        if( not os.path.isfile( self.filename ) ):
+            return;
+        lastModified = os.path.getmtime( self.filename );
+        header = None;
+        body = [];
+        for line in open( self.filename ):
+            line = line.rstrip('\n');
+            if( line == '...' ):
+                if( header != None ):
+                    yield ( int(header.group(1)), int(header.group(2)), int(header.group(3)),
+                            self.parseTime( header.group(4), lastModified ), header.group(5), body );
+                header = None;
+                body = [];
+            elif( header == None ):
+                header = self.eventHeader.match( line );
+            else:
+                body.append( line );
+
+class CondorDagProfile:
+    """How long each Job and module of a DAG waited, ran and how much memory it used, from its Condor user logs.
+
+    """
+    returnValue = re.compile( r'\(return value (-?\d+)\)' );
+    memoryUsage = re.compile( r'^\s*(\d+)\s+-\s+MemoryUsage of job \(MB\)' );
+    memoryTable = re.compile( r'^\s*Memory \(MB\)\s*:\s*(\d+)' );
+    cpusTable = re.compile( r'^\s*Cpus\s*:\s*(\d+(?:\.\d*)?)' );
+    diskTable = re.compile( r'^\s*Disk \(KB\)\s*:\s*(\d+)' );
+    bundleVars = re.compile( r'^VARS\s+(\S+)\s+First="(\d+)"\s+Last="(\d+)"' );
+    def __init__( self, dagFile ):
+        """Read the Jobs and dependencies of a DAG file, and where their submit files put their logs.
+
+        Arguments:
+        dagFile -- The DAG file, i.e. condorFiles/MASTER_CONDOR_SCRIPT.dag.
+
+        Variables:
+        nodes -- The DAG node names, in the order they appear.
+        module -- A dict mapping each node to its module (i.e. the name of its submit file); a bundle's
+                  node (see CondorDag.findBundles) maps to the module it runs the executions of.
+        tasks -- A dict mapping each bundle's node to (the number of executions it runs, how many at once).
+        children -- A dict mapping each node to the nodes that depend on it.
+        logs -- A dict mapping each log file to the nodes whose submit files use it.
+        attempts -- A dict mapping (log, cluster, proc) to what happened to that execution.
+
+        """
+        self.nodes = [];
+        self.module = {};
+        self.tasks = {};
+        self.children = {};
+        self.logs = {};
+        self.attempts = {};
+        logOf = {};
+        cpusOf = {};
+        bundles = {};
+        for line in open( dagFile ):
+            fields = line.split();
+            if( (len(fields) >= 3) and (fields[0] == 'JOB') ):
+                node, submitFile = fields[1], fields[2];
+                self.nodes.append( node );
+                self.module[node] = os.path.splitext( os.path.basename( submitFile ) )[0];
+                if( not logOf.has_key( submitFile ) ):
+                    logOf[submitFile] = None;
+                    cpusOf[submitFile] = 1;
+                    if( os.path.isfile( submitFile ) ):
+                        for submitLine in open( submitFile ):
+                            if( submitLine.split('=')[0].strip().lower() == 'log' ):
+                                logOf[submitFile] = submitLine.split('=', 1)[1].strip();
+                            elif( submitLine.split('=')[0].strip().lower() == 'request_cpus' ):
+                                cpusOf[submitFile] = max( 1, int( submitLine.split('=', 1)[1] ) );
+                if( self.module[node].endswith( '__bundle' ) ):
+                    self.module[node] = self.module[node][:-len('__bundle')];
+                    bundles[node] = cpusOf[submitFile];
+                if( logOf[submitFile] != None ):
+                    self.logs.setdefault( logOf[submitFile], [] ).append( node );
+            elif( (len(fields) >= 2) and (fields[0] == 'VARS') and bundles.has_key( fields[1] ) and self.bundleVars.match( line ) ):
+                node, first, last = self.bundleVars.match( line ).groups();
+                numTasks = int( last )-int( first )+1;
+                self.tasks[node] = ( numTasks, min( bundles[node], numTasks ) );
+            elif( (len(fields) >= 4) and (fields[0] == 'PARENT') ):
+                split = fields.index('CHILD');
+                for parent in fields[1:split]:
+                    self.children.setdefault( parent, [] ).extend( fields[split+1:] );
+    def readLogs( self ):
+        """Read every log, one event at a time.
+
+        """
+        for log, logNodes in self.logs.iteritems():
+            nodeOfCluster = {};
+            for code, cluster, proc, seconds, text, body in CondorUserLog( log ).events():
+                key = ( log, cluster, proc );
+                if( code == 0 ):
+                    node = None;
+                    for line in body:
+                        match = CondorUserLog.dagNode.match( line );
+                        if( match ):
+                            node = match.group(1);
+                    if( node == None ):
+                        # not submitted by DAGMan; guess from the execution number.
+                        if( len(logNodes) == 1 ):
+                            node = logNodes[0];
+                        elif( ''.join([ self.module[logNodes[0]], '_', str(proc) ]) in logNodes ):
+                            node = ''.join([ self.module[logNodes[0]], '_', str(proc) ]);
+                    nodeOfCluster[cluster] = node;
+                    self.attempts[key] = { 'node':node, 'cluster':cluster, 'proc':proc, 'submitted':seconds,
+                        'started':None, 'running':None, 'ended':None, 'execution':0.0, 'evictions':0,
+                        'holds':0, 'memory':0, 'cpus':0.0, 'disk':0, 'returnValue':None, 'aborted':0 };
+                    continue;
+                if( not self.attempts.has_key( key ) ):
+                    continue;
+                attempt = self.attempts[key];
+                if( code == 1 ):
+                    if( attempt['started'] == None ):
+                        attempt['started'] = seconds;
+                    attempt['running'] = seconds;
+                elif( code in (4, 5, 9, 12) ):
+                    if( attempt['running'] != None ):
+                        attempt['execution'] = attempt['execution'] + seconds - attempt['running'];
+                        attempt['running'] = None;
+                    if( code == 4 ):
+                        attempt['evictions'] = attempt['evictions']+1;
+                    elif( code == 12 ):
+                        attempt['holds'] = attempt['holds']+1;
+                    else:
+                        attempt['ended'] = seconds;
+                        attempt['aborted'] = int( code == 9 );
+                        for line in body:
+                            match = self.returnValue.search( line );
+                            if( match ):
+                                attempt['returnValue'] = int( match.group(1) );
+                            match = self.memoryTable.match( line );
+                            if( match ):
+                                attempt['memory'] = max( attempt['memory'], int( match.group(1) ) );
+                            match = self.cpusTable.match( line );
+                            if( match ):
+                                attempt['cpus'] = max( attempt['cpus'], float( match.group(1) ) );
+                            match = self.diskTable.match( line );
+                            if( match ):
+                                attempt['disk'] = max( attempt['disk'], int( match.group(1) ) );
+                if( code in (5, 6) ):
+                    for line in body:
+                        match = self.memoryUsage.match( line );
+                        if( match ):
+                            attempt['memory'] = max( attempt['memory'], int( match.group(1) ) );
+    def moduleUsage( self ):
+        """Return a dict mapping each module to the most (memory MB, CPUs, disk KB) any of its executions
+           used, from the logs read by readLogs.  Usage a log doesn't report is 0.
+
+        """
+        usage = {};
+        for attempt in self.attempts.itervalues():
+            if( attempt['node'] == None ):
+                continue;
+            module = self.module.get( attempt['node'] );
+            if( module == None ):
+                continue;
+            memory, cpus, disk = usage.get( module, (0, 0.0, 0) );
+            # a bundle's executions ran a few at a time, and each left its files behind.
+            numTasks, slots = self.tasks.get( attempt['node'], (1, 1) );
+            usage[module] = ( max( memory, int( math.ceil( float( attempt['memory'] )/slots ) ) ), max( cpus, attempt['cpus']/slots ),
+                max( disk, int( math.ceil( float( attempt['disk'] )/numTasks ) ) ) );
+        return usage;
+    def jobTable( self ):
+        """Return one row per execution (attempt) of each Job, in the order they were submitted.
+
+        """
+        rows = [];
+        for attempt in sorted( self.attempts.values(), key=lambda attempt: ( attempt['submitted'], attempt['cluster'], attempt['proc'] ) ):
+            if( attempt['node'] == None ):
+                continue;
+            queueWait = None;
+            if( attempt['started'] != None ):
+                queueWait = attempt['started'] - attempt['submitted'];
+            failed = int( attempt['aborted'] or ((attempt['returnValue'] != None) and (attempt['returnValue'] != 0)) );
+            rows.append( { 'job':attempt['node'], 'module':self.module.get( attempt['node'], '' ),
+                'cluster':attempt['cluster'], 'proc':attempt['proc'], 'queueWait':queueWait,
+                'execution':attempt['execution'], 'memoryMB':attempt['memory'], 'cpus':attempt['cpus'],
+                'diskKB':attempt['disk'], 'evictions':attempt['evictions'],
+                'holds':attempt['holds'], 'returnValue':attempt['returnValue'], 'failed':failed,
+                'submitted':attempt['submitted'], 'ended':attempt['ended'] } );
+        return rows;
+    def criticalPath( self, jobs ):
+        """Return (nodes, seconds): the chain of dependent nodes that took the most wall-clock time,
+           where each node takes from its first submission to its last execution ending.
+
+        Arguments:
+        jobs -- The rows of jobTable().
+
+        """
+        span = {};
+        for row in jobs:
+            start, end = span.get( row['job'], (row['submitted'], row['submitted']) );
+            span[row['job']] = ( min( start, row['submitted'] ), max( end, row['ended'] or row['submitted'] ) );
+        weight = dict( [ (node, span[node][1]-span[node][0]) for node in span ] );
+        numParents = dict( [ (node, 0) for node in self.nodes ] );
+        for node in self.nodes:
+            for child in self.children.get( node, [] ):
+                numParents[child] = numParents[child]+1;
+        order = [ node for node in self.nodes if numParents[node] == 0 ];
+        i = 0;
+        while( i < len(order) ):
+            for child in self.children.get( order[i], [] ):
+                numParents[child] = numParents[child]-1;
+                if( numParents[child] == 0 ):
+                    order.append( child );
+            i = i+1;
+        # the longest path ending at each node, and the node before it.
+        longest = {};
+        previous = {};
+        for node in order:
+            longest.setdefault( node, 0.0 );
+            longest[node] = longest[node] + weight.get( node, 0.0 );
+            for child in self.children.get( node, [] ):
+                if( longest[node] > longest.get( child, -1.0 ) ):
+                    longest[child] = longest[node];
+                    previous[child] = node;
+        if( longest == {} ):
+            return ( [], 0.0 );
+        # on a tie, prefer the path that goes furthest.
+        node = max( reversed( order ), key=lambda node: longest[node] );
+        path = [ node ];
+        while( previous.has_key( path[-1] ) ):
+            path.append( previous[path[-1]] );
+        path.reverse();
+        return ( [ (each, weight.get( each, 0.0 )) for each in path ], longest[node] );
+    def moduleTable( self, jobs, criticalPath ):
+        """Return one row per module, in DAG order, summarising its Jobs.  A bundle's Job counts as each of
+           the executions it ran, each taking its share of the bundle's time, memory, CPUs and disk.
+
+        Arguments:
+        jobs -- The rows of jobTable().
+        criticalPath -- The nodes (and their times) from criticalPath().
+
+        """
+        onPath = {};
+        for node, seconds in criticalPath:
+            onPath[self.module[node]] = onPath.get( self.module[node], 0.0 ) + seconds;
+        rows = {};
+        order = [];
+        for node in self.nodes:
+            if( not rows.has_key( self.module[node] ) ):
+                order.append( self.module[node] );
+                rows[self.module[node]] = { 'module':self.module[node], 'jobs':0, 'attempts':0, 'retries':0,
+                    'evictions':0, 'holds':0, 'failures':0, 'queueWaitMean':None, 'queueWaitMax':None,
+                    'executionTotal':0.0, 'executionMean':None, 'executionMax':None, 'memoryMaxMB':0,
+                    'cpusMax':0.0, 'diskMaxKB':0,
+                    'wallSeconds':None, 'criticalPathSeconds':onPath.get( self.module[node], 0.0 ) };
+        final = {};
+        waits = {};
+        spans = {};
+        for row in jobs:
+            # logs left over from an older DAG can name nodes this one doesn't have.
+            if( not rows.has_key( row['module'] ) ):
+                continue;
+            module = rows[row['module']];
+            numTasks, slots = self.tasks.get( row['job'], (1, 1) );
+            module['attempts'] = module['attempts']+numTasks;
+            module['evictions'] = module['evictions']+row['evictions'];
+            module['holds'] = module['holds']+row['holds'];
+            module['executionTotal'] = module['executionTotal']+row['execution']*slots;
+            module['executionMax'] = max( module['executionMax'], row['execution']*slots/numTasks );
+            module['memoryMaxMB'] = max( module['memoryMaxMB'], int( math.ceil( float( row['memoryMB'] )/slots ) ) );
+            module['cpusMax'] = max( module['cpusMax'], row['cpus']/slots );
+            module['diskMaxKB'] = max( module['diskMaxKB'], int( math.ceil( float( row['diskKB'] )/numTasks ) ) );
+            if( row['queueWait'] != None ):
+                waits.setdefault( row['module'], [] ).append( row['queueWait'] );
+            start, end = spans.get( row['module'], (row['submitted'], row['submitted']) );
+            spans[row['module']] = ( min( start, row['submitted'] ), max( end, row['ended'] or row['submitted'] ) );
+            final[(row['job'], row['proc'])] = row;
+        for (node, proc), row in final.iteritems():
+            module = rows[row['module']];
+            module['jobs'] = module['jobs']+self.tasks.get( node, (1, 1) )[0];
+            module['failures'] = module['failures']+row['failed'];
+        for name, module in rows.iteritems():
+            module['retries'] = module['attempts']-module['jobs'];
+            if( module['jobs'] > 0 ):
+                module['executionMean'] = module['executionTotal']/module['attempts'];
+            if( waits.has_key( name ) ):
+                module['queueWaitMean'] = sum( waits[name] )/len( waits[name] );
+                module['queueWaitMax'] = max( waits[name] );
+            if( spans.has_key( name ) ):
+                module['wallSeconds'] = spans[name][1]-spans[name][0];
+        return [ rows[name] for name in order ];
+    def write( self, filename ):
+        """Read the logs, and write the profile as JSON (everything) or, if filename ends in .csv,
+           as a CSV table of the modules.  Print a summary of the critical path.
+
+        Arguments:
+        filename -- The file to write.
+
+        """
+        self.readLogs();
+        jobs = self.jobTable();
+        path, pathSeconds = self.criticalPath( jobs );
+        modules = self.moduleTable( jobs, path );
+        if( filename.lower().endswith('.csv') ):
+            columns = [ 'module', 'jobs', 'attempts', 'retries', 'evictions', 'holds', 'failures',
+                'queueWaitMean', 'queueWaitMax', 'executionTotal', 'executionMean', 'executionMax',
+                'memoryMaxMB', 'cpusMax', 'diskMaxKB', 'wallSeconds', 'criticalPathSeconds' ];
+            outFile = open( filename, 'wb' );
+            writer = csv.writer( outFile );
+            writer.writerow( columns );
+            for module in modules:
+                writer.writerow( [ module[column] for column in columns ] );
+            outFile.close();
+        else:
+            outFile = open( filename, 'w' );
+            json.dump( { 'modules':modules, 'jobs':jobs,
+                'criticalPath':{ 'seconds':pathSeconds, 'jobs':[ { 'job':node, 'module':self.module[node], 'seconds':seconds } for node, seconds in path ] } },
+                outFile, indent=1, sort_keys=True );
+            outFile.close();
+        print "Critical path: "+str(int(pathSeconds))+" seconds through "+str(len(path))+" job(s)";
+        for module in sorted( modules, key=lambda module: -module['criticalPathSeconds'] ):
+            if( module['criticalPathSeconds'] > 0 ):
+                print "    "+module['module']+": "+str(int(module['criticalPathSeconds']))+" seconds";
+
+def readResourceHistory( dirs ):
+    """Return the most (memory MB, CPUs, disk KB) each module used in earlier runs.
+
     Arguments:
-    filename -- The the path to the file you wish to read.
+    dirs -- The output directories of the earlier runs; their condorFiles/MASTER_CONDOR_SCRIPT.dag
+            and the logs of its submit files are read.  Directories without a DAG are skipped.
+
+    """
+    usage = {};
+    for dir in dirs:
+        dagFile = ''.join([dir, 'condorFiles/MASTER_CONDOR_SCRIPT.dag']);
+        if( not os.path.isfile( dagFile ) ):
+            continue;
+        profile = CondorDagProfile( dagFile );
+        profile.readLogs();
+        for module, (memory, cpus, disk) in profile.moduleUsage().iteritems():
+            oldMemory, oldCpus, oldDisk = usage.get( module, (0, 0.0, 0) );
+            usage[module] = ( max( memory, oldMemory ), max( cpus, oldCpus ), max( disk, oldDisk ) );
+    return usage;
+
+def readRuntimeHistory( dirs ):
+    """Return how long, in seconds, an execution of each module took on average in earlier runs.
+
+    Arguments:
+    dirs -- The output directories of the earlier runs, as for readResourceHistory.
+
+    """
+    totals = {};
+    for dir in dirs:
+        dagFile = ''.join([dir, 'condorFiles/MASTER_CONDOR_SCRIPT.dag']);
+        if( not os.path.isfile( dagFile ) ):
+            continue;
+        profile = CondorDagProfile( dagFile );
+        profile.readLogs();
+        for module in profile.moduleTable( profile.jobTable(), [] ):
+            if( module['attempts'] > 0 ):
+                seconds, attempts = totals.get( module['module'], (0.0, 0) );
+                totals[module['module']] = ( seconds+module['executionTotal'], attempts+module['attempts'] );
+    return dict( [ (module, seconds/attempts) for module, (seconds, attempts) in totals.iteritems() ] );
+
+def expandCondorMacros( text, macros ):
+    """Replace each $(name) in text by macros[name], or nothing, like Condor does.
+
+    """
+    return re.sub( r'\$\((\w+)\)', lambda match: macros.get( match.group(1), '' ), text );
+
+def writeCondorFile( filename, contents, manifest=None ):
+    """Write one of the Condor files.
+
+    Arguments:
+    filename -- The file to write.
+    contents -- What to write.
+    manifest -- A CondorManifest; if given, the file is only rewritten when it has changed.
+
+    """
+    if( manifest != None ):
+        manifest.writeIfChanged( filename, contents );
+    else:
+        outFile = open( filename, 'w' );
+        outFile.write( contents );
+        outFile.close();
+
+class TranslationCache:
+    """What can be shared between the translations of many LONI Pipelines in one process.
 
     Note:
-    Any line beginning with a $ # or % is ignored.
+    Compiled FILENAME templates are always shared (see LONIFilenameTemplate).
 
     """
-    tmp = [];
-    isComment = re.compile( r'^[$|#|%]' );
-    for line in open(filename):
-        if( isComment.search(line) == None ):
-            tmp.append( line.strip() );
-    return tmp;
-        
+    def __init__( self ):
+        """Create a new, empty, cache.
 
-# Specify availible options.
-parser = OptionParser();
-parser.add_option( "-i", "--loniXML", "--xml", "--in", "--input", action="store", type="string", dest="i", help="The input LONI Pipeline XML File", metavar="FILENAME")
-parser.add_option( "-o", "--out", "--condorDir", "--output", "--outDir", action="store", type="string", dest="o", help="The output directory where condor_files will be created.", metavar="DIR_NAME")
-(options, args) = parser.parse_args();
+        Variables:
+        listFiles -- A dict mapping each .list file to (modification time, size, ListFileList).
+        directories -- A dict of the directories probed for file permissions (see FilePermissionChecker).
 
+        """
+        self.listFiles = {};
+        self.directories = {};
+    def readListOfFiles( self, filename ):
+        """Return the files in a .list file, as a ListFileList, only reading the file again if it has changed.
 
-# Ensure required positional arguments are used.
-if( cmp(str(options.o),'None') & cmp(str(options.i),'None')  ):
-    print "Reading from:", options.i
-    print "Writing to:", options.o
-else:
-    print "Error: Incorrect Usage\n"
+        Arguments:
+        filename -- The .list file.
 
-    print "Usage: loni2condor.py --input=FILENAME --output==DIR_NAME \n    -h, --help\n\tshow this help message and exit\n    -iFILENAME, --loniXML=FILENAME, --xml=FILENAME, --in=FILENAME, --input=FILENAME\n\t The input LONI Pipeline XML File\n    -oDIR_NAME, --out=DIR_NAME, --condorDir=DIR_NAME, --output=DIR_NAME, --outDir=DIR_NAME\n\t The output directory where condor_files will be created.\n";
-    sys.exit();
+        """
+        try:
+            info = os.stat( filename );
+            stamp = ( info.st_mtime, info.st_size );
+        except OSError:
+            stamp = None;
+        cached = self.listFiles.get( filename );
+        if( (stamp == None) or (cached == None) or (cached[:2] != stamp) ):
+            files = ListFileList( filename );
+            if( stamp == None ):
+                return files;
+            cached = stamp + ( files, );
+            self.listFiles[filename] = cached;
+        return cached[2];
+
+def translate( xmlFile, outDir, clustered=0, incremental=0, upToDate=None, cache=None, skipIfUnchanged=1, resources=None, headroom=0.2,
+               runtimes=None, bundleSeconds=None, bundleCpus=1, resultCache=None ):
+    """Translate a LONI XML Pipeline into the files needed to submit a Condor DAG.
 
+    Arguments:
+    xmlFile -- The LONI XML Pipeline.
+    outDir -- The directory (ending in /) to create the condorFiles directory in.
+    clustered -- 1 to run modules as clusters where possible (see CondorDag).
+    incremental -- 1 to only rewrite what has changed since the last incremental translation.
+    upToDate -- None, 'done' or 'prune' (see CondorDag).
+    cache -- A TranslationCache to share with other translations, or None.
+    skipIfUnchanged -- 0 to always parse the pipeline, even if incremental finds nothing has changed.
+    resources, headroom -- What each module used before, to size its requests (see CondorDag).
+    runtimes, bundleSeconds, bundleCpus -- How long each module took before, to bundle short executions (see CondorDag).
+    resultCache -- A ResultCache to restore Jobs' outputs from, and store them in, or None.
+
+    Returns:
+    The CondorDag, or None if nothing had changed.
 
-xmlFile = xml.dom.minidom.parse( options.i )
+    Note:
+    A LONIPipelineError is raised if the pipeline can't be translated.
 
-node = xmlFile.firstChild
-myPipeline = LONIXML();
-myPipeline.traverse( node, '' )
-myPipeline.completeInFiles(myPipeline);
-myPipeline.completeParse(myPipeline);
+    """
+    manifest = None;
+    settings = 'cluster='+str(bool(clustered))+' upToDate='+str(upToDate);
+    if( resources != None ):
+        settings = settings+' resources='+hashlib.sha1( repr( sorted( resources.items() ) ) ).hexdigest()+' headroom='+str(headroom);
+    if( bundleSeconds != None ):
+        settings = settings+' runtimes='+hashlib.sha1( repr( sorted( (runtimes or {}).items() ) ) ).hexdigest()+' bundle='+str(bundleSeconds)+'x'+str(bundleCpus);
+    manifestFile = ''.join([outDir, 'condorFiles/loni2condor.manifest']);
+    if( incremental ):
+        manifest = CondorManifest( outDir );
+        # what is up to date, or in the result cache, can change without the pipeline changing.
+        if( skipIfUnchanged and (upToDate == None) and (resultCache == None) and manifest.upToDate( xmlFile, settings ) ):
+            print "Nothing has changed since the Condor files were created."
+            return None;
+    elif( os.access( manifestFile, os.F_OK ) ):
+        # the files are about to be rewritten behind the manifest's back.
+        os.remove( manifestFile );
+    # split paths are only shared within a pipeline, so they don't pile up over many.
+    LONIFilenameTemplate.splitPaths.clear();
+
+    myPipeline = LONIXML();
+    myPipeline.cache = cache;
+    myPipeline.traverse( xmlFile )
+    myPipeline.completeInFiles(myPipeline);
+    myPipeline.completeParse(myPipeline);
+
+    myDag = CondorDag(outDir, clustered, manifest, upToDate, cache, resources, headroom, runtimes, bundleSeconds, bundleCpus, resultCache);
+    myDag.createCondorFromLoni( myPipeline )
+    myDag.write()
+    if( manifest != None ):
+        manifest.recordInputs( xmlFile, myPipeline.getListFiles(), settings );
+        manifest.save();
+    return myDag;
+
+def translateMany( pipelines, clustered=0, incremental=0, upToDate=None, cache=None, resources=None, headroom=0.2,
+                   runtimes=None, bundleSeconds=None, bundleCpus=1, resultCache=None ):
+    """Translate many LONI XML Pipelines in this process, sharing list files and permission probes between them.
 
-myDag = CondorDag(options.o);
-myDag.createCondorFromLoni( myPipeline )
-myDag.write()
+    Arguments:
+    pipelines -- A list of (xmlFile, outDir) pairs.
+    clustered, incremental, upToDate, resources, headroom, runtimes, bundleSeconds, bundleCpus, resultCache -- As for translate.
+    cache -- A TranslationCache; a new one is used if it is not given.
 
+    Returns:
+    A list of the CondorDags, one for each pipeline: None where nothing had changed, and the
+    LONIPipelineError where the pipeline couldn't be translated (the others are still translated).
 
+    """
+    if( cache == None ):
+        cache = TranslationCache();
+    dags = [];
+    for xmlFile, outDir in pipelines:
+        print "Reading from:", xmlFile
+        print "Writing to:", outDir
+        try:
+            dags.append( translate( xmlFile, outDir, clustered, incremental, upToDate, cache, 1, resources, headroom,
+                runtimes, bundleSeconds, bundleCpus, resultCache ) );
+        except LONIPipelineError, e:
+            print "\nERROR:\n    "+str(e)+"\n"
+            dags.append( e );
+    return dags;
+
+def main( argv=None ):
+    """Run loni2condor.py from the command line.
 
+    Arguments:
+    argv -- The command line arguments (without the program name); sys.argv[1:] if not given.
+
+    Returns:
+    The exit status.
+
+    """
+    # Specify availible options.
+    parser = OptionParser();
+    parser.add_option( "-i", "--loniXML", "--xml", "--in", "--input", action="store", type="string", dest="i", help="The input LONI Pipeline XML File", metavar="FILENAME")
+    parser.add_option( "-o", "--out", "--condorDir", "--output", "--outDir", action="store", type="string", dest="o", help="The output directory where condor_files will be created.", metavar="DIR_NAME")
+    parser.add_option( "-c", "--cluster", action="store_true", dest="cluster", default=False, help="Run each module whose executions line up one-to-one with its neighbours' as one Condor cluster, queued from an item data file.")
+    parser.add_option( "-u", "--incremental", "--update", action="store_true", dest="incremental", default=False, help="Only rewrite the Condor files whose XML, .list files or parsed file lists changed since the last (incremental) run; file permissions are still checked.")
+    parser.add_option( "-l", "--local", action="store", type="int", dest="local", default=None, help="Run the DAG on this machine, with at most NUM jobs at once (0 for one per CPU), instead of leaving it for Condor.", metavar="NUM")
+    parser.add_option( "-r", "--retries", action="store", type="int", dest="retries", default=0, help="How many times to rerun a job that fails when running locally.", metavar="NUM")
+    parser.add_option( "-p", "--profile", action="store", type="string", dest="profile", default=None, help="Instead of creating the Condor files, read the Condor logs of the DAG in the output directory and write how long each module waited and ran, and the critical path, to FILENAME (.json or .csv).", metavar="FILENAME")
+    parser.add_option( "-s", "--skipUpToDate", action="store", type="choice", choices=["done", "prune"], dest="upToDate", default=None, help="Like make, don't rerun jobs whose outputs exist and are newer than their inputs: either mark them DONE in the DAG, or prune them from it.", metavar="done|prune")
+    parser.add_option( "--history", action="append", type="string", dest="history", default=None, help="Size each module's request_memory, request_cpus and request_disk from what it used in the DAG (and Condor logs) of an earlier run in DIR_NAME; may be given more than once.", metavar="DIR_NAME")
+    parser.add_option( "--headroom", action="store", type="float", dest="headroom", default=0.2, help="The fraction to add to the memory and disk used in earlier runs (default 0.2).", metavar="FRACTION")
+    parser.add_option( "-b", "--bundle", action="store", type="float", dest="bundle", default=None, help="Run the executions of modules that took less than SECONDS in the --history runs several to a Condor job, so that each job takes about SECONDS.", metavar="SECONDS")
+    parser.add_option( "--bundleCpus", action="store", type="int", dest="bundleCpus", default=1, help="How many executions of a bundle run at once, and so how many CPUs each bundled job requests (default 1).", metavar="NUM")
+    parser.add_option( "--cache", action="store", type="string", dest="cache", default=None, help="Restore the outputs of jobs that run the same command on inputs with the same contents as an earlier job from the result cache in DIR_NAME, instead of running them, and store every other job's outputs there.", metavar="DIR_NAME")
+    parser.add_option( "--cacheSize", action="store", type="float", dest="cacheSize", default=10240, help="The most the result cache may hold, in MB; the least recently used outputs are removed first (default 10240).", metavar="MB")
+    parser.add_option( "--cacheLink", action="store_true", dest="cacheLink", default=False, help="Hardlink outputs into and out of the result cache instead of copying them; only safe if no job rewrites its outputs in place.")
+    (options, args) = parser.parse_args( argv );
+
+
+    if( (options.profile != None) & cmp(str(options.o),'None') ):
+        CondorDagProfile( ''.join([options.o, 'condorFiles/MASTER_CONDOR_SCRIPT.dag']) ).write( options.profile );
+        return 0;
+
+    # Ensure required positional arguments are used.
+    if( cmp(str(options.o),'None') & cmp(str(options.i),'None')  ):
+        print "Reading from:", options.i
+        print "Writing to:", options.o
+    else:
+        print "Error: Incorrect Usage\n"
+
+        print "Usage: loni2condor.py --input=FILENAME --output==DIR_NAME \n    -h, --help\n\tshow this help message and exit\n    -iFILENAME, --loniXML=FILENAME, --xml=FILENAME, --in=FILENAME, --input=FILENAME\n\t The input LONI Pipeline XML File\n    -oDIR_NAME, --out=DIR_NAME, --condorDir=DIR_NAME, --output=DIR_NAME, --outDir=DIR_NAME\n\t The output directory where condor_files will be created.\n";
+        return 1;
+
+
+    resources = None;
+    runtimes = None;
+    resultCache = None;
+    if( options.cache != None ):
+        resultCache = ResultCache( options.cache, options.cacheSize, options.cacheLink );
+    if( options.history != None ):
+        resources = readResourceHistory( options.history );
+        if( options.bundle != None ):
+            runtimes = readRuntimeHistory( options.history );
+    elif( options.bundle != None ):
+        print "Warning: --bundle needs --history, to know how long each module takes; nothing will be bundled.";
+    try:
+        myDag = translate( options.i, options.o, options.cluster, options.incremental, options.upToDate,
+            skipIfUnchanged=(options.local == None), resources=resources, headroom=options.headroom,
+            runtimes=runtimes, bundleSeconds=options.bundle, bundleCpus=max( 1, options.bundleCpus ), resultCache=resultCache );
+    except LONIPipelineError, e:
+        print "\nERROR:\n    "+str(e)+"\n"
+        return 1;
+
+    if( options.local != None ):
+        numSlots = options.local;
+        if( numSlots < 1 ):
+            import multiprocessing
+            numSlots = multiprocessing.cpu_count();
+        failed = LocalDagRunner( myDag, numSlots, options.retries ).run();
+        if( failed != [] ):
+            print "\nError: "+str(len(failed))+" job(s) failed or could not run: "+", ".join( failed );
+            return 1;
+    return 0;
+
+
+if __name__ == '__main__':
+    sys.exit( main() );
@@ -0,0 +1,333 @@
+#!/apps/linux/bin/python
+"""loni2condor_benchmark.py
+  Program:    Scaling benchmarks for loni2condor.py.
+
+  Description:  This program writes synthetic LONI Pipeline XML files
+                (and the .list files they read) of growing size, translates
+                each one with loni2condor, and reports how long each phase
+                of the translation took, how much memory it needed, and how
+                fast each phase (and the peak memory) grows with the size
+                of the pipeline.  Each translation runs in a fresh process,
+                so its peak memory isn't left over from another.
+
+  Usage:        loni2condor_benchmark.py --vary=listSize --sizes=500,1000,2000
+"""
+__author__ = 'Andrew S. Fox'
+
+
+import sys
+import os
+import math
+import random
+import shutil
+import resource
+import tempfile
+import time
+import json
+import subprocess
+from optparse import OptionParser, SUPPRESS_HELP
+
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ) );
+import loni2condor
+
+# the phases of a translation, in the order they run.
+PHASES = [ 'traverse', 'completeInFiles', 'completeParse', 'createCondorFromLoni', 'verifyAndCleanDag', 'write' ];
+
+
+def generatePipeline( dir, numModules=20, depth=2, fanIn=2, listSize=100, varDensity=0.5, outFileDensity=0.5, seed=0 ):
+    """Write a synthetic LONI Pipeline XML file, and the .list file it reads.
+
+    Arguments:
+    dir -- The directory to write the files in.
+    numModules -- The number of Modules that run a command.
+    depth -- How deeply the Modules are nested in (command-less) groups.
+    fanIn -- The most Modules each Module reads from.
+    listSize -- The number of files in the .list file, i.e. the number of executions of each Module.
+    varDensity -- The chance that a file refers to another with ${n:p}.
+    outFileDensity -- The chance that an input reads another Module's -OutFile (rather than one of its inputs).
+    seed -- The seed of the random choices.
+
+    Returns:
+    The path of the XML file.
+
+    """
+    rand = random.Random( seed );
+    listFile = os.path.join( dir, 'subjects.list' );
+    out = open( listFile, 'w' );
+    out.write( '# synthetic subjects\n' );
+    for subject in xrange( listSize ):
+        out.write( os.path.join( dir, 'in', 'subject%06d.nii.gz\n' % subject ) );
+    out.close();
+
+    # put each Module in a group, nested up to depth deep.
+    groups = [ 'g%d' % (module % max( 1, depth*2 )) for module in xrange( numModules ) ];
+    names = [];
+    for module in xrange( numModules ):
+        path = [ 'bench' ];
+        for level in xrange( depth ):
+            path.append( '%s_%d' % (groups[module], level) );
+        path.append( 'm%d' % module );
+        names.append( '/'.join( path ) );
+
+    xml = [ '<?xml version="1.0"?>\n<Pipeline name="bench">\n' ];
+    openGroups = [];
+    for module in xrange( numModules ):
+        groupPath = names[module].split('/')[1:-1];
+        while( openGroups != groupPath[:len(openGroups)] ):
+            xml.append( '  '*len(openGroups)+'</Module>\n' );
+            openGroups.pop();
+        while( len(openGroups) < len(groupPath) ):
+            xml.append( '  '*(len(openGroups)+1)+'<Module name="%s">\n' % groupPath[len(openGroups)] );
+            openGroups.append( groupPath[len(openGroups)] );
+        indent = '  '*(len(openGroups)+1);
+        numInputs = 1;
+        if( module > 0 ):
+            numInputs = rand.randint( 1, fanIn );
+        command = '/bin/true '+' '.join( [ '-InFile%d' % i for i in xrange( numInputs ) ] )+' -OutFile0';
+        xml.append( indent+'<Module name="m%d" command="%s">\n' % ( module, command ) );
+        for i in xrange( numInputs ):
+            if( module == 0 ):
+                xml.append( indent+'  <InFile index="%d" type="File" filename="%s" synopsis="-i"/>\n' % ( i, listFile ) );
+                continue;
+            parent = names[ rand.randint( 0, module-1 ) ];
+            if( (rand.random() < outFileDensity) or (i == 0) ):
+                xml.append( indent+'  <InFile index="%d" type="File" filename="-OutFile0" readfrom="%s" synopsis="-in%d"/>\n' % ( i, parent, i ) );
+            elif( rand.random() < varDensity ):
+                xml.append( indent+'  <InFile index="%d" type="File" filename="${0:d} + aux_ + ${0:b}" readfrom="%s" synopsis="-aux%d"/>\n' % ( i, parent, i ) );
+            else:
+                xml.append( indent+'  <InFile index="%d" type="File" filename="%s" synopsis="-ref%d"/>\n' % ( i, os.path.join( dir, 'in', 'template.nii' ), i ) );
+        if( rand.random() < varDensity ):
+            outName = '${0:d} + m%d_ + ${0:b} - .nii + .out.nii' % module;
+        else:
+            outName = '${0:r}_m%d.nii' % module;
+        xml.append( indent+'  <OutFile index="0" type="File" filename="%s" synopsis="-o"/>\n' % outName );
+        xml.append( indent+'</Module>\n' );
+    while( openGroups != [] ):
+        xml.append( '  '*len(openGroups)+'</Module>\n' );
+        openGroups.pop();
+    xml.append( '</Pipeline>\n' );
+
+    xmlFile = os.path.join( dir, 'bench.xml' );
+    out = open( xmlFile, 'w' );
+    out.write( ''.join( xml ) );
+    out.close();
+    return xmlFile;
+
+def peakMemory():
+    """Return the peak resident memory of this process, in MB.
+
+    """
+    peak = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss;
+    if( sys.platform == 'darwin' ):
+        return peak/1048576.0;
+    return peak/1024.0;
+
+def currentMemory():
+    """Return the resident memory of this process now, in MB (or its peak so far, where /proc can't be read).
+
+    """
+    try:
+        statm = open( '/proc/self/statm' );
+        try:
+            pages = int( statm.read().split()[1] );
+        finally:
+            statm.close();
+    except (IOError, ValueError, IndexError):
+        return peakMemory();
+    return pages*resource.getpagesize()/1048576.0;
+
+def profileTranslation( xmlFile, outDir ):
+    """Translate a pipeline, one phase at a time, as loni2condor.translate does.
+
+    Arguments:
+    xmlFile -- The LONI XML Pipeline.
+    outDir -- The directory (ending in /) to write the Condor files in.
+
+    Returns:
+    A dict mapping each phase to (seconds, MB of memory it left in use), 'jobs' to the number of
+    Jobs, and 'peakMB' to how far the peak memory of the process rose during the translation.
+
+    Note:
+    The peak of a process never falls, so it can only be measured for the whole translation,
+    and only once per process; what each phase leaves in use is measured instead.
+
+    """
+    results = {};
+    def timed( phase, function ):
+        def run( *args ):
+            memory = currentMemory();
+            start = time.time();
+            value = function( *args );
+            results[phase] = ( time.time()-start, currentMemory()-memory );
+            return value;
+        return run;
+    startMemory = currentMemory();
+
+    # the translation prints every permission problem; nobody needs to see them here.
+    stdout = sys.stdout;
+    sys.stdout = open( os.devnull, 'w' );
+    try:
+        pipeline = loni2condor.LONIXML();
+        timed( 'traverse', pipeline.traverse )( xmlFile );
+        timed( 'completeInFiles', pipeline.completeInFiles )( pipeline );
+        timed( 'completeParse', pipeline.completeParse )( pipeline );
+        dag = loni2condor.CondorDag( outDir );
+        timed( 'createCondorFromLoni', dag.createCondorFromLoni )( pipeline );
+        dag.verifyAndCleanDag = timed( 'verifyAndCleanDag', dag.verifyAndCleanDag );
+        timed( 'write', dag.write )();
+    finally:
+        sys.stdout.close();
+        sys.stdout = stdout;
+    # write includes verifyAndCleanDag.
+    seconds, memory = results['write'];
+    results['write'] = ( seconds-results['verifyAndCleanDag'][0], memory );
+    results['jobs'] = len( dag.jobList );
+    results['peakMB'] = max( 0.0, peakMemory()-startMemory );
+    return results;
+
+def benchmarkOne( settings ):
+    """Generate and translate one pipeline in a fresh process (this script, run with --single),
+       so that the peak memory it reports isn't left over from other sizes.
+
+    Arguments:
+    settings -- The keyword arguments of generatePipeline.
+
+    Returns:
+    The results of profileTranslation.
+
+    """
+    process = subprocess.Popen( [ sys.executable, os.path.abspath( __file__ ), '--single', json.dumps( settings ) ], stdout=subprocess.PIPE );
+    output = process.communicate()[0];
+    if( process.returncode != 0 ):
+        raise RuntimeError( 'translating a pipeline with '+json.dumps( settings )+' failed' );
+    results = json.loads( output );
+    for phase in PHASES:
+        results[phase] = tuple( results[phase] );
+    return results;
+
+def translateOne( settings ):
+    """Generate and translate one pipeline in this process, and print the results as JSON (see benchmarkOne).
+
+    """
+    dir = tempfile.mkdtemp( prefix='loni2condor_benchmark' );
+    try:
+        xmlFile = generatePipeline( dir, **settings );
+        os.mkdir( os.path.join( dir, 'in' ) );
+        print json.dumps( profileTranslation( xmlFile, dir+'/' ) );
+    finally:
+        shutil.rmtree( dir, True );
+
+def benchmark( vary, sizes, settings, repeat=1 ):
+    """Translate pipelines of growing size.
+
+    Arguments:
+    vary -- The generatePipeline argument to grow (i.e. listSize or numModules).
+    sizes -- The values it takes.
+    settings -- The other generatePipeline arguments.
+    repeat -- How many times to translate each size; the fastest time (and the least memory) is kept.
+
+    Returns:
+    A list of dicts, one for each size, with the size, number of jobs, peak memory (peakMB)
+    and (seconds, MB) for each phase.
+
+    """
+    rows = [];
+    for size in sizes:
+        runSettings = dict( settings );
+        runSettings[vary] = size;
+        best = None;
+        for run in xrange( repeat ):
+            results = benchmarkOne( runSettings );
+            if( best == None ):
+                best = results;
+            else:
+                for phase in PHASES:
+                    best[phase] = ( min( best[phase][0], results[phase][0] ), min( best[phase][1], results[phase][1] ) );
+                best['peakMB'] = min( best['peakMB'], results['peakMB'] );
+        best['size'] = size;
+        rows.append( best );
+    return rows;
+
+def scalingExponents( rows ):
+    """Return, for each phase, how its time grows with size between the smallest and largest sizes,
+       as the exponent k in time ~ size^k (so 1 is linear, 2 quadratic), and the same for the peak
+       memory (as 'peakMB').
+
+    Arguments:
+    rows -- The results of benchmark.
+
+    """
+    exponents = {};
+    first, last = rows[0], rows[-1];
+    # times too short to measure, and memory too small to see past the interpreter's, say nothing about growth.
+    measures = [ (phase, first[phase][0], last[phase][0], 0.001) for phase in PHASES ];
+    measures.append( ('peakMB', first['peakMB'], last['peakMB'], 1.0) );
+    for name, firstValue, lastValue, smallest in measures:
+        if( (len(rows) < 2) or (firstValue < smallest) or (last['size'] == first['size']) ):
+            exponents[name] = None;
+        else:
+            exponents[name] = math.log( max( lastValue, 1e-6 )/firstValue )/math.log( float(last['size'])/first['size'] );
+    return exponents;
+
+def report( vary, rows, exponents ):
+    """Print a table of the time (and memory left in use) of each phase at each size, and the peak memory,
+       and the scaling exponents.
+
+    """
+    print "%10s %8s" % ( vary, 'jobs' ) + ''.join( [ " %22s" % phase for phase in PHASES ] ) + " %10s" % 'peak';
+    for row in rows:
+        print "%10d %8d" % ( row['size'], row['jobs'] ) + ''.join( [ " %11.3fs %7.1fMB" % row[phase] for phase in PHASES ] ) + " %8.1fMB" % row['peakMB'];
+    print "%19s" % 'exponent' + ''.join( [ (" %22.2f" % exponents[phase]) if( exponents[phase] != None ) else (" %22s" % '-') for phase in PHASES + ['peakMB'] ] );
+
+
+def main( argv=None ):
+    """Run the benchmarks from the command line.
+
+    Arguments:
+    argv -- The command line arguments (without the program name); sys.argv[1:] if not given.
+
+    Returns:
+    The exit status: 1 if a phase grew faster than --maxExponent allows.
+
+    """
+    parser = OptionParser();
+    parser.add_option( "-v", "--vary", action="store", type="choice", choices=["listSize", "numModules", "fanIn", "depth"], dest="vary", default="listSize", help="The size to grow: listSize, numModules, fanIn or depth.")
+    parser.add_option( "-s", "--sizes", action="store", type="string", dest="sizes", default="250,500,1000,2000", help="Comma separated values of the size to grow.", metavar="N,N,...")
+    parser.add_option( "-m", "--modules", action="store", type="int", dest="numModules", default=20, help="The number of Modules (when they aren't being grown).", metavar="NUM")
+    parser.add_option( "-d", "--depth", action="store", type="int", dest="depth", default=2, help="How deeply Modules are nested in groups.", metavar="NUM")
+    parser.add_option( "-f", "--fanIn", action="store", type="int", dest="fanIn", default=2, help="The most Modules each Module reads from.", metavar="NUM")
+    parser.add_option( "-n", "--listSize", action="store", type="int", dest="listSize", default=100, help="The number of files in the .list file (when it isn't being grown).", metavar="NUM")
+    parser.add_option( "--varDensity", action="store", type="float", dest="varDensity", default=0.5, help="The chance that a file refers to another with ${n:p}.", metavar="P")
+    parser.add_option( "--outFileDensity", action="store", type="float", dest="outFileDensity", default=0.5, help="The chance that an extra input reads another Module's -OutFile.", metavar="P")
+    parser.add_option( "-r", "--repeat", action="store", type="int", dest="repeat", default=1, help="How many times to time each size (the fastest is kept).", metavar="NUM")
+    parser.add_option( "-o", "--out", action="store", type="string", dest="out", default=None, help="Also write the results to FILENAME, as JSON.", metavar="FILENAME")
+    parser.add_option( "-x", "--maxExponent", action="store", type="float", dest="maxExponent", default=None, help="Fail if any phase's time (or the peak memory) grows faster than size^K.", metavar="K")
+    parser.add_option( "--single", action="store", type="string", dest="single", default=None, help=SUPPRESS_HELP)
+    (options, args) = parser.parse_args( argv );
+
+    if( options.single != None ):
+        settings = dict( [ (str(name), value) for name, value in json.loads( options.single ).iteritems() ] );
+        translateOne( settings );
+        return 0;
+
+    settings = { 'numModules':options.numModules, 'depth':options.depth, 'fanIn':options.fanIn,
+        'listSize':options.listSize, 'varDensity':options.varDensity, 'outFileDensity':options.outFileDensity };
+    sizes = [ int(size) for size in options.sizes.split(',') ];
+    rows = benchmark( options.vary, sizes, settings, options.repeat );
+    exponents = scalingExponents( rows );
+    report( options.vary, rows, exponents );
+
+    if( options.out != None ):
+        out = open( options.out, 'w' );
+        json.dump( { 'vary':options.vary, 'settings':settings, 'phases':PHASES, 'results':rows, 'exponents':exponents }, out, indent=1, sort_keys=True );
+        out.close();
+    if( options.maxExponent != None ):
+        slow = [ phase for phase in PHASES + ['peakMB'] if( (exponents[phase] != None) and (exponents[phase] > options.maxExponent) ) ];
+        if( slow != [] ):
+            print "\nError: these phases grew faster than size^"+str(options.maxExponent)+": "+", ".join( slow );
+            return 1;
+    return 0;
+
+
+if __name__ == '__main__':
+    sys.exit( main() );